@@ -0,0 +1,101 @@
+"""
+Задержка обработчиков не растёт, пока уходят алерты.
+
+Поднимает медленный SMTP-сервер (aiosmtpd, по --smtp-delay на письмо)
+и бота в одном процессе (bench/harness.py). Сначала меряет /start без
+ошибок, затем шлёт поток снов, на которые заглушка OpenAI отвечает 503,
+и параллельно продолжает мерить /start. Проверка проходит, если ни
+обработчик с ошибкой, ни /start не ждали SMTP, а письма при этом ушли.
+
+Нужен aiosmtpd (только для этой проверки):
+    pip install aiosmtpd
+    python bench/alert_latency.py [--errors 40] [--smtp-delay 0.5]
+"""
+
+import argparse
+import asyncio
+import statistics
+
+from harness import BenchBot, free_port, run
+
+try:
+    from aiosmtpd.controller import Controller
+    from aiosmtpd.smtp import AuthResult
+except ImportError:
+    Controller = None
+
+
+class SlowMailbox:
+    """
+    Принимает письма с задержкой, как перегруженный почтовый сервер.
+    """
+
+    def __init__(self, delay: float) -> None:
+        self.delay = delay
+        self.messages = []
+
+    async def handle_DATA(self, server, session, envelope) -> str:
+        await asyncio.sleep(self.delay)
+        self.messages.append(envelope.content)
+        return "250 OK"
+
+
+async def main() -> bool:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--errors", type=int, default=40, help="снов с ошибкой OpenAI")
+    parser.add_argument("--interval", type=float, default=0.05, help="пауза между ними, сек")
+    parser.add_argument("--smtp-delay", type=float, default=0.5, help="приём одного письма, сек")
+    args = parser.parse_args()
+    if Controller is None:
+        print("Нужен aiosmtpd: pip install aiosmtpd")
+        return False
+
+    mailbox = SlowMailbox(args.smtp_delay)
+    smtp_port = free_port()
+    smtp = Controller(mailbox, hostname="127.0.0.1", port=smtp_port, auth_require_tls=False,
+                      authenticator=lambda *_: AuthResult(success=True))
+    smtp.start()
+
+    env = {
+        "OPENAI_STREAM": "0", "MODEL_TIERS": "gpt-4o", "OPENAI_RATE_LIMIT_RETRIES": "0",
+        "EMAIL_SMTP_SERVER": "127.0.0.1", "EMAIL_SMTP_PORT": str(smtp_port), "EMAIL_STARTTLS": "0",
+        "EMAIL_USER": "bench", "EMAIL_PASSWORD": "bench", "EMAIL_TO": "admin@example.com",
+        # Короткие окна склейки, чтобы письма уходили прямо во время замера
+        "ALERT_BATCH_DELAY": "0.2", "ALERT_DIGEST_INTERVAL": "1",
+    }
+    try:
+        async with BenchBot(median=0.1, env=env) as harness:
+            await harness.send_text(4999, "/start")   # Прогрев: первое соединение с заглушкой Bot API
+            quiet = [await harness.send_text(5000 + i, "/start") for i in range(20)]
+
+            harness.openai.err5xx = 1.0
+            failing, busy = [], []
+
+            async def fail(i: int) -> None:
+                failing.append(await harness.send_text(6000 + i, f"Мне снилось число {i}"))
+
+            tasks = []
+            for i in range(args.errors):
+                tasks.append(asyncio.create_task(fail(i)))
+                busy.append(await harness.send_text(7000 + i, "/start"))
+                await asyncio.sleep(args.interval)
+            await asyncio.gather(*tasks)
+            sent_during_run = len(mailbox.messages)
+            stats = dict(harness.bot.alert_pipeline.stats)
+        sent_total = len(mailbox.messages)
+    finally:
+        smtp.stop()
+
+    for title, values in (("/start без ошибок", quiet), ("/start во время алертов", busy),
+                          ("Сон с ошибкой OpenAI", failing)):
+        print(f"{title + ':':25} медиана {statistics.median(values) * 1000:6.1f} мс, "
+              f"макс {max(values) * 1000:6.1f} мс")
+    print(f"Писем: {sent_during_run} во время замера, {sent_total} всего; алертов: {stats}")
+    # Ни один обработчик не должен ждать приёма письма
+    ok = sent_during_run > 0 and max(busy + failing) < args.smtp_delay
+    print("OK" if ok else "FAIL")
+    return ok
+
+
+if __name__ == "__main__":
+    run(main)
@@ -0,0 +1,57 @@
+"""
+Одинаковые одновременные сны — один запрос к OpenAI и один алерт.
+
+K чатов одновременно присылают один и тот же сон (bench/harness.py):
+  - при рабочей заглушке OpenAI должен уйти ровно один запрос, а каждый
+    чат — получить свой ответ и свою запись в истории;
+  - при заглушке, отвечающей 503 на всё, ошибку получают все K, но
+    в конвейер алертов попадает одна.
+
+Запуск из корня репозитория:
+    python bench/coalescing_check.py [--copies 8]
+"""
+
+import argparse
+import asyncio
+
+from harness import BenchBot, run
+
+
+async def main() -> bool:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--copies", type=int, default=8)
+    args = parser.parse_args()
+
+    # Одна модель и без повторов 5xx — чтобы считать ровно запросы ведущего
+    env = {"OPENAI_STREAM": "0", "MODEL_TIERS": "gpt-4o", "OPENAI_RATE_LIMIT_RETRIES": "0"}
+    async with BenchBot(median=0.5, env=env) as harness:
+        chats = [3000 + i for i in range(args.copies)]
+        await asyncio.gather(*(harness.send_text(chat, "Мне снилось, что я опоздал на поезд")
+                               for chat in chats))
+        upstream = harness.openai.stats["requests"]
+        histories = sum(len(harness.application.user_data[chat].get("history", [])) == 1 for chat in chats)
+        print(f"Успех: запросов к OpenAI {upstream} на {args.copies} одинаковых снов, "
+              f"свои записи в истории у {histories}/{args.copies}")
+        ok = upstream == 1 and histories == args.copies
+
+        # Ошибка приходит не мгновенно, как у перегруженного API, — иначе
+        # ведущий упал бы раньше, чем остальные копии успели к нему присоединиться
+        harness.openai.err5xx = 1.0
+        harness.openai.error_delay = 0.5
+        chats = [4000 + i for i in range(args.copies)]
+        before = harness.openai.stats["requests"]
+        await asyncio.gather(*(harness.send_text(chat, "Мне снилось, что я потерял ключи от дома")
+                               for chat in chats))
+        upstream = harness.openai.stats["requests"] - before
+        alerts = harness.bot.alert_pipeline.stats["alerts"]
+        answered = sum(len(harness.replies(chat)) >= 2 for chat in chats)
+        print(f"Ошибка: запросов к OpenAI {upstream}, алертов {alerts}, "
+              f"заглушку получили {answered}/{args.copies}")
+        ok = ok and upstream == 1 and alerts == 1 and answered == args.copies
+
+    print("OK" if ok else "FAIL")
+    return ok
+
+
+if __name__ == "__main__":
+    run(main)
@@ -0,0 +1,52 @@
+"""
+N одновременных снов обрабатываются примерно за время одного.
+
+Бот с общим пулом AsyncOpenAI (bench/harness.py) получает N разных снов
+сразу и один сон отдельно; заглушка OpenAI отвечает с фиксированной
+задержкой. Проверка проходит, если N снов заняли не больше
+--max-ratio времени одного.
+
+Запуск из корня репозитория:
+    python bench/concurrent_dreams.py [--dreams 20] [--median 1.0]
+"""
+
+import argparse
+import asyncio
+import time
+
+from harness import BenchBot, run
+
+
+async def main() -> bool:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dreams", type=int, default=20)
+    parser.add_argument("--median", type=float, default=1.0, help="задержка ответа OpenAI, сек")
+    parser.add_argument("--max-ratio", type=float, default=1.5)
+    args = parser.parse_args()
+
+    # Потоковый режим правит сообщение по частям — для замера он не нужен;
+    # лимит одновременных запросов планировщика поднимаем до N
+    env = {"OPENAI_STREAM": "0", "OPENAI_MAX_CONCURRENCY": str(args.dreams)}
+    async with BenchBot(median=args.median, env=env) as harness:
+        single = await harness.send_text(1000, "Мне снилась вода, и я стоял на берегу")
+
+        started = time.monotonic()
+        await asyncio.gather(*(
+            harness.send_text(2000 + i, f"Мне снилось, что я лечу над городом номер {i}")
+            for i in range(args.dreams)
+        ))
+        together = time.monotonic() - started
+        answered = sum("sendMessage" in harness.replies(2000 + i) for i in range(args.dreams))
+        upstream = harness.openai.stats["requests"]
+
+    ratio = together / single
+    print(f"Один сон:            {single:.2f} сек")
+    print(f"{args.dreams} снов одновременно: {together:.2f} сек (x{ratio:.2f})")
+    print(f"Ответов: {answered}/{args.dreams}, запросов к OpenAI: {upstream}")
+    ok = answered == args.dreams and ratio <= args.max_ratio
+    print("OK" if ok else "FAIL")
+    return ok
+
+
+if __name__ == "__main__":
+    run(main)
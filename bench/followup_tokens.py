@@ -0,0 +1,103 @@
+"""
+Промпт уточняющих вопросов: сводка разговора против полного контекста.
+
+Офлайн прогоняет разговор о сне из нескольких уточняющих вопросов через
+те же функции, что и handle_followup (start_thread, gist, сводка с
+вытеснением старых ходов), и печатает по каждому ходу число токенов
+промпта со сводкой и при пересылке всей переписки.
+
+Запуск из корня репозитория:
+    python bench/followup_tokens.py [--turns 8] [--reply-sentences 12]
+"""
+
+import argparse
+import os
+import random
+import sys
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+DREAM = ("Мне снилась большая тёмная вода. Я стоял на берегу и боялся войти, а за спиной был "
+         "старый дом бабушки с открытой дверью. Потом над водой пролетела белая птица, "
+         "и я почувствовал, что должен идти за ней, но ноги не слушались.")
+SENTENCES = [
+    "Вода во сне — символ эмоций и того, что скрыто под поверхностью сознания.",
+    "Тёмная вода говорит о чувствах, которые ты пока не готов рассмотреть внимательно.",
+    "Берег — граница между привычным и новым, и ты стоишь ровно на ней.",
+    "Страх войти в воду показывает осторожность перед переменами, которые уже назрели.",
+    "Дом бабушки — образ опоры, тепла и родовой памяти.",
+    "Открытая дверь за спиной означает, что путь назад всегда доступен.",
+    "Белая птица — вестник, символ лёгкости и новой идеи.",
+    "Желание идти за птицей и тяжесть в ногах отражают внутренний конфликт.",
+    "Часть тебя стремится вперёд, а другая часть держится за безопасность.",
+    "Этот сон приходит, когда в жизни назревает важный выбор.",
+    "Обрати внимание на то, какие чувства вызвала у тебя птица.",
+    "Сон мягко подсказывает, что перемены не обязательно означают потерю.",
+]
+QUESTIONS = [
+    "А что значит вода?", "Почему я боялся войти?", "А дом бабушки к чему?",
+    "Что значит белая птица?", "Почему ноги не слушались?", "Что мне делать завтра?",
+    "А открытая дверь?", "Это хороший знак?", "Сон может повториться?", "Как понять, какой выбор?",
+]
+
+
+def make_reply(rng: random.Random, sentences: int) -> str:
+    body = " ".join(rng.choice(SENTENCES) for _ in range(sentences))
+    return f"{body}\n\nСовет: найди вечером полчаса тишины и запиши, что тебя волнует."
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, default=8)
+    parser.add_argument("--reply-sentences", type=int, default=12, help="длина толкования (предложений)")
+    parser.add_argument("--answer-sentences", type=int, default=4, help="длина ответа на вопрос")
+    parser.add_argument("--style", default=bot.DEFAULT_STYLE)
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    context = SimpleNamespace(user_data={})
+    prompt = bot.STYLE_PROMPTS[args.style]
+    reply = make_reply(rng, args.reply_sentences)
+    thread_id, thread = bot.start_thread(context, 1, DREAM, reply, args.style)
+    full_conversation = [
+        {"role": "system", "content": prompt},
+        {"role": "user", "content": DREAM},
+        {"role": "assistant", "content": reply},
+    ]
+    tokenizer = "tiktoken" if bot._get_encoder() is not None else "оценка по длине, см. TIKTOKEN_CACHE_DIR"
+    print(f"Толкование: {bot.count_tokens(reply)} токенов, сон: {bot.count_tokens(DREAM)} (подсчёт: {tokenizer})")
+    print("Ход  со сводкой  полный контекст  экономия")
+
+    totals = [0, 0]
+    for turn in range(args.turns):
+        question = QUESTIONS[turn % len(QUESTIONS)]
+        answer = make_reply(rng, args.answer_sentences)
+        messages = [
+            {"role": "system", "content": f"{prompt}\n\n{bot.FOLLOWUP_PROMPT}"},
+            {"role": "system", "content": f"Контекст разговора:\n{bot.thread_summary(thread)}"},
+            {"role": "user", "content": question},
+        ]
+        summary_tokens = bot.count_message_tokens(messages)
+        full_conversation.append({"role": "user", "content": question})
+        full_tokens = bot.count_message_tokens(full_conversation)
+        totals[0] += summary_tokens
+        totals[1] += full_tokens
+        print(f"{turn + 1:>3}  {summary_tokens:>10}  {full_tokens:>15}  {100 - summary_tokens * 100 // full_tokens:>7}%")
+
+        # То же обновление сводки, что в handle_followup
+        full_conversation.append({"role": "assistant", "content": answer})
+        thread["turns"].append(
+            f"Вопрос: {bot.trim_to_tokens(question, bot.FOLLOWUP_TURN_TOKENS)[0]}\n"
+            f"Ответ: {bot.gist(answer, bot.FOLLOWUP_TURN_TOKENS)}"
+        )
+        while len(thread["turns"]) > 1 and bot.count_tokens(bot.thread_summary(thread)) > bot.FOLLOWUP_SUMMARY_TOKENS:
+            thread["turns"].pop(0)
+
+    print(f"Всего: {totals[0]} против {totals[1]} токенов промпта (экономия {100 - totals[0] * 100 // totals[1]}%)")
+
+
+if __name__ == "__main__":
+    main()
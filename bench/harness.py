@@ -0,0 +1,118 @@
+"""
+Бот в одном процессе с заглушками Bot API и OpenAI — для проверок
+поведения (bench/concurrent_dreams.py и др.).
+
+В отличие от bench/loadtest.py бот не запускается отдельным процессом:
+Application собирается через bot.build_application(), апдейты передаются
+прямо в process_update, а заглушки доступны для подсчёта вызовов.
+Окружение задаётся до импорта bot, поэтому модуль bot импортируется
+только внутри BenchBot.start().
+"""
+
+import asyncio
+import importlib
+import os
+import socket
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mock_openai  # noqa: E402
+import mock_telegram  # noqa: E402
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class BenchBot:
+    """
+    Бот с заглушками на свободных портах. Использование:
+        async with BenchBot(median=0.5) as harness:
+            await harness.send_dream(chat_id, "Мне снилась вода")
+    """
+
+    def __init__(self, median: float = 0.5, sigma: float = 0.0, err5xx: float = 0.0,
+                 env: dict = None) -> None:
+        self.openai = mock_openai.MockConfig(median=median, sigma=sigma, err5xx=err5xx)
+        self.telegram = mock_telegram.TelegramRecorder()
+        self.env = env or {}
+        self.bot = None
+        self.application = None
+        self._update_id = 0
+
+    async def start(self) -> "BenchBot":
+        openai_port, tg_port = free_port(), free_port()
+        mock_openai.make_app(self.openai).listen(openai_port, "127.0.0.1")
+        mock_telegram.make_app(self.telegram).listen(tg_port, "127.0.0.1")
+
+        workdir = tempfile.mkdtemp(prefix="intui-bench-")
+        os.chdir(workdir)   # error.log и базы — во временном каталоге
+        os.environ.update({
+            "TELEGRAM_TOKEN": "123456:BENCH",
+            "TELEGRAM_API_BASE_URL": f"http://127.0.0.1:{tg_port}",
+            "OPENAI_API_KEY": "bench",
+            "OPENAI_BASE_URL": f"http://127.0.0.1:{openai_port}/v1",
+            "DB_PATH": os.path.join(workdir, "intui.db"),
+            "METRICS_PORT": "0",
+            "OPENAI_RPM_LIMIT": "1000000",
+            "OPENAI_TPM_LIMIT": "1000000000",
+            "DAILY_TOKEN_QUOTA": "0",
+            "MONTHLY_TOKEN_QUOTA": "0",
+        })
+        os.environ.update(self.env)
+
+        self.bot = importlib.import_module("bot")
+        self.application = self.bot.build_application()
+        await self.bot.start_application(self.application)
+        return self
+
+    async def stop(self) -> None:
+        application = self.application
+        await application.stop()
+        await self.bot.post_stop(application)
+        await application.shutdown()
+        await self.bot.post_shutdown(application)
+
+    async def __aenter__(self) -> "BenchBot":
+        return await self.start()
+
+    async def __aexit__(self, *exc) -> None:
+        await self.stop()
+
+    async def send_text(self, chat_id: int, text: str) -> float:
+        """
+        Передаёт боту сообщение и ждёт окончания обработки; возвращает время, сек.
+        """
+        from telegram import Update
+
+        self._update_id += 1
+        data = {
+            "update_id": self._update_id,
+            "message": {
+                "message_id": self._update_id, "date": int(time.time()), "text": text,
+                "chat": {"id": chat_id, "type": "private"},
+                "from": {"id": chat_id, "is_bot": False, "first_name": "Bench", "language_code": "ru"}
+            }
+        }
+        started = time.monotonic()
+        await self.application.process_update(Update.de_json(data, self.application.bot))
+        return time.monotonic() - started
+
+    def replies(self, chat_id: int) -> list:
+        """
+        Методы Bot API, вызванные для чата, по порядку.
+        """
+        return [method for _, method in self.telegram.calls.get(chat_id, [])]
+
+
+def run(main) -> None:
+    """
+    Запускает проверку; ненулевой код выхода, если она не прошла.
+    """
+    sys.exit(0 if asyncio.run(main()) else 1)
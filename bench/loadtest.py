@@ -0,0 +1,532 @@
+"""
+Офлайн нагрузочный стенд Интуи.
+
+Поднимает заглушки Bot API и OpenAI (bench/mock_telegram.py,
+bench/mock_openai.py), запускает bot.py отдельным процессом в режиме
+webhook и шлёт ему апдейты (/start, нажатия кнопок, сны) с заданной
+частотой. В конце печатает:
+  - пропускную способность (апдейтов в секунду);
+  - задержки до первого и до последнего ответа пользователю по типам апдейтов;
+  - время обработки по обработчикам (из /metrics бота);
+  - задержку подтверждения webhook;
+  - запаздывание event loop и рост памяти процесса бота.
+
+Каждый апдейт приходит от своего чата, чтобы задержку ответа можно было
+однозначно сопоставить апдейту.
+
+Примеры (из корня репозитория):
+    python bench/loadtest.py --rate 20 --duration 30
+    python bench/loadtest.py --rate 50 --median 2 --err429 0.05 --json after.json
+    python bench/loadtest.py --replay updates.jsonl --rate 10
+    python bench/loadtest.py --env OPENAI_STREAM=0 --env CONCURRENT_UPDATES=8
+    python bench/loadtest.py --env WORKER_PROCESSES=4 --mock-processes 4 --rate 400
+
+С --mock-processes заглушки работают отдельными процессами, чтобы стенд
+не упирался в одно ядро; журнал вызовов Bot API тогда недоступен, и
+завершение апдейтов считается по метрикам бота (без задержек по типам).
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import mock_openai  # noqa: E402
+import mock_telegram  # noqa: E402
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DREAMS = [
+    "Мне снилось, что у меня выпадают зубы",
+    "Летал над городом и не мог приземлиться",
+    "Бежал и не мог убежать от кого-то в темноте",
+    "Снилась большая вода, я стоял на берегу",
+    "Опоздал на поезд, а вещи остались в вагоне",
+    "Во сне я снова в школе и не готов к экзамену",
+    "Снился покойный дедушка, он что-то говорил, но я не расслышал",
+    "Заблудился в огромном доме с бесконечными коридорами",
+    "Мне снилась змея в траве, она не нападала",
+    "Падал с высоты и проснулся перед ударом",
+]
+
+BUTTONS = ["write_dream", "choose_style", "show_history", "style_Мистик", "style_Психоаналитик"]
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+#                             Синтетические апдейты
+# ─────────────────────────────────────────────────────────────────────────────
+
+def _user(chat_id: int) -> dict:
+    return {"id": chat_id, "is_bot": False, "first_name": "Bench", "language_code": "ru"}
+
+
+def make_message_update(update_id: int, chat_id: int, text: str) -> dict:
+    message = {
+        "message_id": update_id, "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"}, "from": _user(chat_id), "text": text
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+
+def make_callback_update(update_id: int, chat_id: int, data: str) -> dict:
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id), "from": _user(chat_id), "chat_instance": str(chat_id), "data": data,
+            "message": {"message_id": 1, "date": int(time.time()),
+                        "chat": {"id": chat_id, "type": "private"},
+                        "from": {"id": 1, "is_bot": True, "first_name": "Intui"}, "text": "menu"}
+        }
+    }
+
+
+def update_kind(update: dict) -> str:
+    if "callback_query" in update:
+        return "button"
+    text = update.get("message", {}).get("text", "")
+    return text.split()[0].lstrip("/") if text.startswith("/") else "dream"
+
+
+def rewrite_ids(update: dict, update_id: int, chat_id: int) -> dict:
+    """
+    Подставляет в записанный апдейт свои update_id и chat_id.
+    """
+    update = json.loads(json.dumps(update))
+    update["update_id"] = update_id
+    for key in ("message", "edited_message", "callback_query"):
+        if key in update:
+            body = update[key]
+            if "from" in body:
+                body["from"]["id"] = chat_id
+            message = body.get("message", body)
+            if "chat" in message:
+                message["chat"]["id"] = chat_id
+    return update
+
+
+class UpdateSource:
+    """
+    Поток апдейтов: синтетическая смесь или повтор записанных (JSONL).
+    """
+
+    def __init__(self, mix: dict, unique_share: float, replay: list = None) -> None:
+        self.mix = mix
+        self.unique_share = unique_share
+        self.replay = replay
+        self.counter = 0
+
+    def next(self) -> tuple:
+        self.counter += 1
+        update_id = 10_000_000 + self.counter
+        chat_id = 500_000_000 + self.counter
+        if self.replay:
+            update = rewrite_ids(self.replay[(self.counter - 1) % len(self.replay)], update_id, chat_id)
+            return update_kind(update), chat_id, update
+
+        kind = random.choices(list(self.mix), weights=list(self.mix.values()))[0]
+        if kind == "start":
+            update = make_message_update(update_id, chat_id, "/start")
+        elif kind == "button":
+            update = make_callback_update(update_id, chat_id, random.choice(BUTTONS))
+        else:
+            text = random.choice(DREAMS)
+            if random.random() < self.unique_share:
+                text += f", и ещё там было число {self.counter}"
+            update = make_message_update(update_id, chat_id, text)
+        return update_kind(update), chat_id, update
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+#                                 Измерения
+# ─────────────────────────────────────────────────────────────────────────────
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def histogram_quantiles(metrics_text: str, name: str, label: str) -> dict:
+    """
+    Квантили гистограммы из текста /metrics (линейная интерполяция по корзинам).
+    Текст может быть склейкой метрик нескольких процессов — корзины суммируются.
+    """
+    buckets = {}
+    pattern = re.compile(rf'^{name}_bucket\{{{label}="([^"]*)",le="([^"]+)"\}} (\S+)$')
+    for line in metrics_text.splitlines():
+        match = pattern.match(line)
+        if match:
+            value, le, count = match.groups()
+            per_bound = buckets.setdefault(value, {})
+            per_bound[float(le)] = per_bound.get(float(le), 0.0) + float(count)
+
+    result = {}
+    for value, per_bound in buckets.items():
+        pairs = sorted(per_bound.items())
+        total = pairs[-1][1]
+        if not total:
+            continue
+        quantiles = {}
+        for q in (0.5, 0.95, 0.99):
+            rank = q * total
+            lower_bound, lower_count = 0.0, 0.0
+            for bound, count in pairs:
+                if count >= rank:
+                    if bound == float("inf"):
+                        quantiles[q] = lower_bound
+                    else:
+                        share = (rank - lower_count) / max(count - lower_count, 1e-9)
+                        quantiles[q] = lower_bound + (bound - lower_bound) * share
+                    break
+                lower_bound, lower_count = bound, count
+        result[value] = (int(total), quantiles)
+    return result
+
+
+def metric_value(metrics_text: str, name: str) -> float:
+    match = re.search(rf"^{name} (\S+)$", metrics_text, re.M)
+    return float(match.group(1)) if match else 0.0
+
+
+def handled_updates(metrics_text: str) -> int:
+    """
+    Сколько апдейтов обработали все обработчики (по склейке /metrics процессов).
+    """
+    return int(sum(float(count) for count in re.findall(
+        r"^intui_update_handling_seconds_count\{[^}]*\} (\S+)$", metrics_text, re.M
+    )))
+
+
+def process_tree(pid: int) -> list:
+    """
+    pid процесса и всех его потомков (по /proc).
+    """
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            for child in f.read().split():
+                pids.extend(process_tree(int(child)))
+    except OSError:
+        pass
+    return pids
+
+
+def rss_mb(pid: int) -> float:
+    """
+    Суммарный RSS процесса бота и его рабочих процессов, МБ.
+    """
+    total = 0
+    for process_id in process_tree(pid):
+        try:
+            with open(f"/proc/{process_id}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return total / 1024
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def wait_port(port: int, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"бот не открыл порт {port} за {timeout} сек")
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+#                                   Прогон
+# ─────────────────────────────────────────────────────────────────────────────
+
+async def run(args) -> dict:
+    random.seed(args.seed)
+    tg_port, openai_port, bot_port, metrics_port = (free_port() for _ in range(4))
+
+    mocks = []
+    if args.mock_processes:
+        openai_config = recorder = None
+        bench_dir = os.path.dirname(os.path.abspath(__file__))
+        mocks.append(await asyncio.create_subprocess_exec(
+            sys.executable, os.path.join(bench_dir, "mock_openai.py"), "--port", str(openai_port),
+            "--median", str(args.median), "--sigma", str(args.sigma), "--err429", str(args.err429),
+            "--err5xx", str(args.err5xx), "--processes", str(args.mock_processes),
+            start_new_session=True
+        ))
+        mocks.append(await asyncio.create_subprocess_exec(
+            sys.executable, os.path.join(bench_dir, "mock_telegram.py"), "--port", str(tg_port),
+            "--latency", str(args.telegram_latency), "--processes", str(args.mock_processes),
+            start_new_session=True
+        ))
+        await wait_port(openai_port, 10)
+        await wait_port(tg_port, 10)
+    else:
+        openai_config = mock_openai.MockConfig(
+            median=args.median, sigma=args.sigma, err429=args.err429, err5xx=args.err5xx,
+            model_latency=dict(
+                (model, float(scale)) for model, scale in (item.split("=") for item in args.model_latency)
+            )
+        )
+        recorder = mock_telegram.TelegramRecorder(latency=args.telegram_latency)
+        mock_openai.make_app(openai_config).listen(openai_port, "127.0.0.1")
+        mock_telegram.make_app(recorder).listen(tg_port, "127.0.0.1")
+
+    workdir = tempfile.mkdtemp(prefix="intui-bench-")
+    env = dict(os.environ)
+    env.update({
+        "TELEGRAM_TOKEN": "123456:BENCH",
+        "TELEGRAM_API_BASE_URL": f"http://127.0.0.1:{tg_port}",
+        "WEBHOOK_URL": f"http://127.0.0.1:{bot_port}/",
+        "PORT": str(bot_port),
+        "METRICS_PORT": str(metrics_port),
+        "OPENAI_API_KEY": "bench",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{openai_port}/v1",
+        "DB_PATH": os.path.join(workdir, "intui.db"),
+        # Меряем бота, а не лимиты аккаунта: квоты и бакеты по умолчанию снимаем
+        "OPENAI_RPM_LIMIT": "1000000",
+        "OPENAI_TPM_LIMIT": "1000000000",
+        "DAILY_TOKEN_QUOTA": "0",
+        "MONTHLY_TOKEN_QUOTA": "0",
+    })
+    env.update(item.split("=", 1) for item in args.env)
+
+    bot_process = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.join(REPO_ROOT, "bot.py"), cwd=workdir, env=env
+    )
+    # Метрики отдают приёмный процесс и каждый процесс-обработчик (на следующих портах)
+    processes = int(env.get("WORKER_PROCESSES", "1"))
+    metrics_ports = [metrics_port] + ([metrics_port + 1 + i for i in range(processes)] if processes > 1 else [])
+    try:
+        await wait_port(bot_port, 30)
+        if recorder is not None:
+            await asyncio.wait_for(recorder.webhook_set.wait(), 30)
+        for port in metrics_ports:
+            await wait_port(port, 60)
+        return await drive(args, recorder, openai_config, bot_port, metrics_ports, bot_process.pid)
+    finally:
+        bot_process.send_signal(signal.SIGINT)
+        try:
+            await asyncio.wait_for(bot_process.wait(), 60)
+        except asyncio.TimeoutError:
+            bot_process.kill()
+        for mock in mocks:
+            os.killpg(mock.pid, signal.SIGTERM)
+            await mock.wait()
+
+
+async def drive(args, recorder, openai_config, bot_port: int, metrics_ports: list, bot_pid: int) -> dict:
+    replay = None
+    if args.replay:
+        with open(args.replay, encoding="utf-8") as f:
+            replay = [json.loads(line) for line in f if line.strip()]
+    mix = dict((kind, float(weight)) for kind, weight in (item.split("=") for item in args.mix.split(",")))
+    source = UpdateSource(mix, args.unique, replay)
+
+    sent = {}        # chat_id -> (вид, время отправки)
+    acks = []
+    rejected = 0     # Ответы webhook не 200 (очередь бота полна)
+    lag_samples = []
+    rss_start = rss_mb(bot_pid)
+    rss_peak = rss_start
+    webhook_url = f"http://127.0.0.1:{bot_port}/"
+
+    async with httpx.AsyncClient(limits=httpx.Limits(max_connections=args.connections),
+                                 timeout=30) as client:
+
+        async def post(chat_id: int, kind: str, update: dict) -> None:
+            nonlocal rejected
+            started = time.monotonic()
+            sent[chat_id] = (kind, started)
+            try:
+                response = await client.post(webhook_url, json=update)
+                if response.status_code == 200:
+                    acks.append(time.monotonic() - started)
+                else:
+                    rejected += 1
+            except httpx.HTTPError as e:
+                rejected += 1
+                print(f"webhook POST не удался: {e}", file=sys.stderr)
+
+        async def scrape() -> list:
+            texts = []
+            for port in metrics_ports:
+                try:
+                    texts.append((await client.get(f"http://127.0.0.1:{port}/metrics")).text)
+                except httpx.HTTPError:
+                    pass
+            return texts
+
+        async def sample() -> None:
+            nonlocal rss_peak
+            while True:
+                await asyncio.sleep(0.5)
+                texts = await scrape()
+                if texts:
+                    lag_samples.append(max(metric_value(t, "intui_event_loop_lag_seconds") for t in texts))
+                rss_peak = max(rss_peak, rss_mb(bot_pid))
+
+        sampler = asyncio.create_task(sample())
+        tasks = []
+        started = time.monotonic()
+        total = int(args.rate * args.duration)
+        next_at = started
+        for _ in range(total):
+            next_at += random.expovariate(args.rate) if args.poisson else 1 / args.rate
+            delay = next_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            kind, chat_id, update = source.next()
+            tasks.append(asyncio.create_task(post(chat_id, kind, update)))
+        await asyncio.gather(*tasks)
+        send_finished = time.monotonic()
+
+        # Ждём, пока бот ответит всем и затихнет
+        deadline = time.monotonic() + args.drain_timeout
+        handled = 0
+        handled_at = time.monotonic()
+        while time.monotonic() < deadline:
+            expected = len(sent) - rejected
+            if recorder is not None:
+                last_call = max((calls[-1][0] for calls in recorder.calls.values()), default=0)
+                answered = sum(1 for chat_id in sent if chat_id in recorder.calls)
+                if answered >= expected and time.monotonic() - last_call > args.drain_idle:
+                    break
+            else:
+                count = handled_updates("".join(await scrape()))
+                if count != handled:
+                    handled, handled_at = count, time.monotonic()
+                if handled >= expected:
+                    break
+            await asyncio.sleep(0.2)
+
+        sampler.cancel()
+        metrics_text = "".join(await scrape())
+        rss_end = rss_mb(bot_pid)
+
+    first_latency = {}
+    final_latency = {}
+    if recorder is not None:
+        completed_at = []
+        for chat_id, (kind, sent_at) in sent.items():
+            calls = [t for t, _ in recorder.calls.get(chat_id, []) if t >= sent_at]
+            if not calls:
+                continue
+            first_latency.setdefault(kind, []).append(calls[0] - sent_at)
+            final_latency.setdefault(kind, []).append(calls[-1] - sent_at)
+            completed_at.append(calls[-1])
+        answered = len(completed_at)
+        elapsed = (max(completed_at) - started) if completed_at else float("nan")
+    else:
+        answered = handled_updates(metrics_text)
+        elapsed = handled_at - started
+
+    return {
+        "config": vars(args),
+        "sent": len(sent),
+        "rejected": rejected,
+        "answered": answered,
+        "send_seconds": send_finished - started,
+        "throughput": answered / elapsed if answered else 0.0,
+        "ack": {q: percentile(acks, q) for q in (0.5, 0.95, 0.99)},
+        "first_response": {k: {q: percentile(v, q) for q in (0.5, 0.95, 0.99)} for k, v in first_latency.items()},
+        "final_response": {k: {q: percentile(v, q) for q in (0.5, 0.95, 0.99)} for k, v in final_latency.items()},
+        "handlers": histogram_quantiles(metrics_text, "intui_update_handling_seconds", "handler"),
+        "event_loop_lag": {"max": max(lag_samples, default=0.0),
+                           "mean": sum(lag_samples) / len(lag_samples) if lag_samples else 0.0},
+        "memory_mb": {"start": rss_start, "peak": rss_peak, "end": rss_end, "growth": rss_end - rss_start},
+        "openai": openai_config.stats if openai_config else None,
+        "telegram_methods": recorder.methods if recorder else None,
+    }
+
+
+def report(result: dict) -> None:
+    ms = lambda value: f"{value * 1000:8.1f}"  # noqa: E731
+    print(f"\nОтправлено апдейтов: {result['sent']}, отклонено ботом: {result['rejected']}, "
+          f"обработано: {result['answered']}")
+    print(f"Пропускная способность: {result['throughput']:.2f} апдейтов/сек")
+    print(f"Подтверждение webhook, мс: p50 {ms(result['ack'][0.5])}  p95 {ms(result['ack'][0.95])}  "
+          f"p99 {ms(result['ack'][0.99])}")
+    if result["first_response"]:
+        print("\nЗадержка ответа пользователю, мс (первый ответ / последний ответ):")
+    for kind, first in sorted(result["first_response"].items()):
+        final = result["final_response"][kind]
+        print(f"  {kind:<8} p50 {ms(first[0.5])} / {ms(final[0.5])}   p95 {ms(first[0.95])} / "
+              f"{ms(final[0.95])}   p99 {ms(first[0.99])} / {ms(final[0.99])}")
+    print("\nОбработчики (из /metrics), мс:")
+    for handler, (count, quantiles) in sorted(result["handlers"].items()):
+        print(f"  {handler:<15} n={count:<6} p50 {ms(quantiles[0.5])}  p95 {ms(quantiles[0.95])}  "
+              f"p99 {ms(quantiles[0.99])}")
+    lag = result["event_loop_lag"]
+    memory = result["memory_mb"]
+    print(f"\nЗапаздывание event loop, мс: max {ms(lag['max'])}, среднее {ms(lag['mean'])}")
+    print(f"Память бота, МБ: старт {memory['start']:.1f}, пик {memory['peak']:.1f}, "
+          f"конец {memory['end']:.1f}, рост {memory['growth']:+.1f}")
+    openai_stats = result["openai"]
+    if openai_stats is None:
+        return
+    print(f"OpenAI-заглушка: запросов {openai_stats['requests']} (поток {openai_stats['streamed']}), "
+          f"429: {openai_stats['429']}, 5xx: {openai_stats['5xx']}, "
+          f"отменено: {openai_stats['cancelled']}, по моделям {openai_stats['by_model']}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rate", type=float, default=10, help="апдейтов в секунду")
+    parser.add_argument("--duration", type=float, default=20, help="длительность подачи, сек")
+    parser.add_argument("--poisson", action="store_true", help="пуассоновский поток вместо равномерного")
+    parser.add_argument("--mix", default="start=0.1,button=0.2,dream=0.7", help="доли видов апдейтов")
+    parser.add_argument("--unique", type=float, default=0.5, help="доля уникальных снов (мимо кэша)")
+    parser.add_argument("--replay", help="JSONL с записанными апдейтами вместо синтетики")
+    parser.add_argument("--median", type=float, default=1.5, help="медиана задержки OpenAI, сек")
+    parser.add_argument("--sigma", type=float, default=0.4, help="разброс задержки OpenAI")
+    parser.add_argument("--model-latency", action="append", default=[],
+                        help="множитель задержки модели, например gpt-4o-mini=0.4")
+    parser.add_argument("--err429", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--err5xx", type=float, default=0.0, help="доля ответов 503")
+    parser.add_argument("--telegram-latency", type=float, default=0.02, help="задержка Bot API, сек")
+    parser.add_argument("--mock-processes", type=int, default=0,
+                        help="запустить заглушки в N отдельных процессах (0 — в процессе стенда)")
+    parser.add_argument("--connections", type=int, default=200, help="соединений к webhook")
+    parser.add_argument("--drain-idle", type=float, default=2.0)
+    parser.add_argument("--drain-timeout", type=float, default=120.0)
+    parser.add_argument("--env", action="append", default=[], help="переменная окружения бота KEY=VALUE")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="сохранить результат в файл")
+    return parser.parse_args(argv)
+
+
+def main() -> None:
+    args = parse_args()
+    result = asyncio.run(run(args))
+    report(result)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2, default=str)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+Накладные расходы инструментирования на один апдейт.
+
+Сравнивает пустой обработчик с обёрнутым в @instrumented, меряет стоимость
+записи в лог через QueueHandler и выдачу /metrics.
+
+Запуск из корня репозитория:
+    python bench/metrics_overhead.py [--iterations 200000]
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+
+async def noop(update, context) -> None:
+    return None
+
+
+async def timed(handler, iterations: int) -> float:
+    started = time.perf_counter()
+    for _ in range(iterations):
+        await handler(None, None)
+    return (time.perf_counter() - started) / iterations
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=200_000)
+    args = parser.parse_args()
+
+    plain = await timed(noop, args.iterations)
+    wrapped = await timed(bot.instrumented("bench")(noop), args.iterations)
+    print(f"Пустой обработчик:          {plain * 1e6:7.2f} мкс")
+    print(f"С @instrumented:            {wrapped * 1e6:7.2f} мкс")
+    print(f"Накладные на апдейт:        {(wrapped - plain) * 1e6:7.2f} мкс")
+
+    started = time.perf_counter()
+    for i in range(args.iterations // 10):
+        logging.info(f"bench {i}")
+    per_log = (time.perf_counter() - started) / (args.iterations // 10)
+    print(f"logging.info (QueueHandler): {per_log * 1e6:7.2f} мкс на вызове event loop")
+
+    started = time.perf_counter()
+    text = bot.render_metrics()
+    print(f"Выдача /metrics:            {(time.perf_counter() - started) * 1000:7.2f} мс "
+          f"({len(text.splitlines())} строк)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
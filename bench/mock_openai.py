@@ -0,0 +1,160 @@
+"""
+Локальная заглушка OpenAI chat-completions для нагрузочного стенда.
+
+Поддерживает обычные и потоковые ответы, настраиваемое распределение
+задержек (логнормальное) и инъекцию ошибок 429/5xx. Можно запустить
+отдельно:
+    python bench/mock_openai.py --port 18081 --median 1.5 --err429 0.02
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+
+import tornado.httpserver
+import tornado.iostream
+import tornado.netutil
+import tornado.process
+import tornado.web
+
+REPLY_TEXT = (
+    "Вода во сне — символ эмоций и того, что скрыто под поверхностью. "
+    "Твой сон говорит о переменах, к которым ты уже готов, хотя пока "
+    "не признаёшься себе в этом. Образ берега — опора и безопасность. "
+    "Совет: найди вечером полчаса тишины и запиши, что тебя волнует."
+)
+
+
+class MockConfig:
+    """
+    Параметры поведения заглушки.
+    """
+
+    def __init__(self, median: float = 1.5, sigma: float = 0.4, ttft_share: float = 0.25,
+                 chunks: int = 24, err429: float = 0.0, err5xx: float = 0.0,
+                 model_latency: dict = None, error_delay: float = 0.0) -> None:
+        self.median = median
+        self.sigma = sigma
+        self.ttft_share = ttft_share
+        self.chunks = chunks
+        self.err429 = err429
+        self.err5xx = err5xx
+        self.model_latency = model_latency or {}
+        self.error_delay = error_delay   # Через сколько приходит ответ с ошибкой, сек
+        self.stats = {"requests": 0, "streamed": 0, "429": 0, "5xx": 0, "cancelled": 0, "by_model": {}}
+
+    def sample_latency(self, model: str) -> float:
+        scale = self.model_latency.get(model, 1.0)
+        return self.median * scale * math.exp(random.gauss(0, self.sigma))
+
+
+def _usage(body: dict) -> dict:
+    prompt = sum(len(m.get("content", "")) for m in body.get("messages", [])) // 3 + 10
+    completion = len(REPLY_TEXT) // 3
+    return {"prompt_tokens": prompt, "completion_tokens": completion,
+            "total_tokens": prompt + completion}
+
+
+class CompletionsHandler(tornado.web.RequestHandler):
+
+    async def post(self) -> None:
+        config = self.application.settings["mock_config"]
+        body = json.loads(self.request.body)
+        model = body.get("model", "gpt-4o")
+        config.stats["requests"] += 1
+        config.stats["by_model"][model] = config.stats["by_model"].get(model, 0) + 1
+
+        roll = random.random()
+        if roll < config.err429 + config.err5xx and config.error_delay:
+            await asyncio.sleep(config.error_delay)
+        if roll < config.err429:
+            config.stats["429"] += 1
+            self.set_status(429)
+            self.set_header("retry-after", "0.5")
+            self.write({"error": {"message": "Rate limit reached", "type": "requests"}})
+            return
+        if roll < config.err429 + config.err5xx:
+            config.stats["5xx"] += 1
+            self.set_status(503)
+            self.write({"error": {"message": "The server is overloaded", "type": "server_error"}})
+            return
+
+        latency = config.sample_latency(model)
+        created = int(time.time())
+        if not body.get("stream"):
+            await asyncio.sleep(latency)
+            self.set_header("Content-Type", "application/json")
+            self.write(json.dumps({
+                "id": "chatcmpl-mock", "object": "chat.completion", "created": created, "model": model,
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": REPLY_TEXT}}],
+                "usage": _usage(body)
+            }))
+            return
+
+        config.stats["streamed"] += 1
+        self.set_header("Content-Type", "text/event-stream")
+        words = REPLY_TEXT.split(" ")
+        per_chunk = max(1, len(words) // config.chunks)
+        pieces = [" ".join(words[i:i + per_chunk]) + " " for i in range(0, len(words), per_chunk)]
+        ttft = latency * config.ttft_share
+        interval = (latency - ttft) / max(1, len(pieces))
+        await asyncio.sleep(ttft)
+        for piece in pieces:
+            chunk = {"id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": created,
+                     "model": model,
+                     "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}
+            self.write(f"data: {json.dumps(chunk)}\n\n")
+            try:
+                await self.flush()
+            except tornado.iostream.StreamClosedError:
+                # Клиент отменил запрос (проигравший хедж) — это нормально
+                config.stats["cancelled"] += 1
+                return
+            await asyncio.sleep(interval)
+        final = {"id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": created,
+                 "model": model, "choices": [], "usage": _usage(body)}
+        self.write(f"data: {json.dumps(final)}\n\ndata: [DONE]\n\n")
+
+
+def make_app(config: MockConfig) -> tornado.web.Application:
+    return tornado.web.Application(
+        [(r"/v1/chat/completions", CompletionsHandler)], mock_config=config
+    )
+
+
+def serve(app: tornado.web.Application, port: int, processes: int) -> None:
+    """
+    Запускает приложение на порту; при processes > 1 — в нескольких
+    процессах на одном сокете, чтобы заглушка не упиралась в одно ядро.
+    """
+    sockets = tornado.netutil.bind_sockets(port, "127.0.0.1", reuse_port=True)
+    if processes > 1:
+        tornado.process.fork_processes(processes)
+
+    async def run() -> None:
+        server = tornado.httpserver.HTTPServer(app)
+        server.add_sockets(sockets)
+        await asyncio.Event().wait()
+
+    asyncio.run(run())
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=18081)
+    parser.add_argument("--median", type=float, default=1.5, help="медиана задержки ответа, сек")
+    parser.add_argument("--sigma", type=float, default=0.4, help="разброс (логнормальный)")
+    parser.add_argument("--err429", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--err5xx", type=float, default=0.0, help="доля ответов 503")
+    parser.add_argument("--processes", type=int, default=1, help="процессов заглушки")
+    args = parser.parse_args()
+    config = MockConfig(args.median, args.sigma, err429=args.err429, err5xx=args.err5xx)
+    serve(make_app(config), args.port, args.processes)
+
+
+if __name__ == "__main__":
+    main()
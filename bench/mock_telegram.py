@@ -0,0 +1,97 @@
+"""
+Локальная заглушка Bot API для нагрузочного стенда.
+
+Отвечает на вызовы бота (getMe, setWebhook, sendMessage, editMessageText,
+answerCallbackQuery, ...) и записывает время каждого вызова по чатам —
+по этим записям стенд считает задержку ответа пользователю.
+
+Отдельный запуск (журнал вызовов при этом никто не читает):
+    python bench/mock_telegram.py --port 18082 --processes 4
+"""
+
+import argparse
+import asyncio
+import json
+import time
+import urllib.parse
+
+import tornado.web
+
+
+class TelegramRecorder:
+    """
+    Журнал вызовов Bot API: chat_id -> [(время, метод)].
+    """
+
+    def __init__(self, latency: float = 0.0) -> None:
+        self.latency = latency
+        self.calls = {}
+        self.methods = {}
+        self.webhook_set = asyncio.Event()
+        self._message_id = 0
+
+    def next_message_id(self) -> int:
+        self._message_id += 1
+        return self._message_id
+
+
+def _parse_params(request) -> dict:
+    content_type = request.headers.get("Content-Type", "")
+    if "application/json" in content_type:
+        return json.loads(request.body or b"{}")
+    if request.body and "multipart" not in content_type:
+        return {k: v[-1] for k, v in urllib.parse.parse_qs(request.body.decode()).items()}
+    return {k: request.get_argument(k) for k in request.arguments}
+
+
+class BotApiHandler(tornado.web.RequestHandler):
+
+    async def post(self, token: str, method: str) -> None:
+        recorder = self.application.settings["recorder"]
+        params = _parse_params(self.request)
+        name = method.lower()
+        recorder.methods[method] = recorder.methods.get(method, 0) + 1
+        if recorder.latency:
+            await asyncio.sleep(recorder.latency)
+
+        chat_id = params.get("chat_id")
+        if chat_id is not None:
+            recorder.calls.setdefault(int(chat_id), []).append((time.monotonic(), method))
+
+        if name == "getme":
+            result = {"id": 1, "is_bot": True, "first_name": "Intui", "username": "intui_bench_bot",
+                      "can_join_groups": True, "can_read_all_group_messages": False,
+                      "supports_inline_queries": False}
+        elif name in ("sendmessage", "editmessagetext"):
+            message_id = int(params.get("message_id") or recorder.next_message_id())
+            result = {"message_id": message_id, "date": int(time.time()),
+                      "chat": {"id": int(chat_id), "type": "private"},
+                      "from": {"id": 1, "is_bot": True, "first_name": "Intui"},
+                      "text": params.get("text", "")}
+        elif name == "setwebhook":
+            recorder.webhook_set.set()
+            result = True
+        elif name == "getwebhookinfo":
+            result = {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+        else:
+            result = True
+        self.write({"ok": True, "result": result})
+
+
+def make_app(recorder: TelegramRecorder) -> tornado.web.Application:
+    return tornado.web.Application([(r"/bot([^/]+)/(\w+)", BotApiHandler)], recorder=recorder)
+
+
+def main() -> None:
+    from mock_openai import serve
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=18082)
+    parser.add_argument("--latency", type=float, default=0.02, help="задержка ответа, сек")
+    parser.add_argument("--processes", type=int, default=1, help="процессов заглушки")
+    args = parser.parse_args()
+    serve(make_app(TelegramRecorder(args.latency)), args.port, args.processes)
+
+
+if __name__ == "__main__":
+    main()
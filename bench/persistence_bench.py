@@ -0,0 +1,117 @@
+"""
+Бенчмарк SQLitePersistence на 100k пользователей.
+
+Меряет:
+  - время старта: ленивая загрузка (как в боте) против чтения всей базы;
+  - накладные расходы на апдейт: подгрузка пользователя, запись user_data
+    и сна в историю, включая пакетный сброс в SQLite.
+
+Запуск из корня репозитория:
+    python bench/persistence_bench.py [--users 100000] [--updates 20000]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+
+def populate(path: str, users: int, dreams_per_user: int) -> None:
+    """
+    Заполняет базу пользователями и историей снов.
+    """
+    persistence = bot.SQLitePersistence(path, flush_interval=1)
+    db = persistence._connect()
+    now = time.time()
+    with db:
+        db.executemany(
+            "INSERT INTO users (user_id, data) VALUES (?, ?)",
+            ((user_id, json.dumps({"style": "Мастер"})) for user_id in range(users))
+        )
+        db.executemany(
+            "INSERT INTO history (user_id, dream, reply, style, created_at) VALUES (?, ?, ?, ?, ?)",
+            (
+                (user_id, f"Мне снилось море номер {i}", "Толкование. Совет: отдохни.", "Мастер", now)
+                for i in range(dreams_per_user)
+                for user_id in range(users)
+            )
+        )
+    persistence.close()
+
+
+async def bench_startup(path: str) -> None:
+    started = time.perf_counter()
+    persistence = bot.SQLitePersistence(path, flush_interval=1)
+    await persistence.get_user_data()
+    lazy = time.perf_counter() - started
+    persistence.close()
+
+    started = time.perf_counter()
+    db = sqlite3.connect(path)
+    eager = {user_id: json.loads(data) for user_id, data in db.execute("SELECT user_id, data FROM users")}
+    eager_time = time.perf_counter() - started
+    db.close()
+
+    print(f"Старт (ленивая загрузка):   {lazy * 1000:8.2f} мс")
+    print(f"Старт (чтение всей базы):   {eager_time * 1000:8.2f} мс ({len(eager)} пользователей)")
+
+
+async def bench_updates(path: str, users: int, updates: int) -> None:
+    persistence = bot.SQLitePersistence(path, flush_interval=0.5)
+    user_data = {}
+    timings = []
+
+    started = time.perf_counter()
+    for n in range(updates):
+        user_id = random.randrange(users)
+        data = user_data.setdefault(user_id, {})
+        t0 = time.perf_counter()
+        await persistence.refresh_user_data(user_id, data)
+        data["style"] = "Мистик"
+        await persistence.update_user_data(user_id, data)
+        persistence.add_dream(user_id, f"Сон {n}", "Толкование", "Мистик")
+        timings.append(time.perf_counter() - t0)
+        if n % 500 == 0:
+            await asyncio.sleep(0)   # Даём отработать фоновому сбросу
+    t0 = time.perf_counter()
+    await persistence.flush()
+    final_flush = time.perf_counter() - t0
+    total = time.perf_counter() - started
+    persistence.close()
+
+    timings.sort()
+    print(f"Апдейтов:                   {updates}")
+    print(f"Накладные на апдейт, p50:   {timings[len(timings) // 2] * 1e6:8.1f} мкс")
+    print(f"Накладные на апдейт, p99:   {timings[int(len(timings) * 0.99)] * 1e6:8.1f} мкс")
+    print(f"В среднем с учётом сброса:  {total / updates * 1e6:8.1f} мкс")
+    print(f"Финальный сброс:            {final_flush * 1000:8.2f} мс")
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--dreams", type=int, default=5, help="снов в истории каждого пользователя")
+    parser.add_argument("--updates", type=int, default=20_000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        t0 = time.perf_counter()
+        populate(path, args.users, args.dreams)
+        print(f"База: {args.users} пользователей, {args.users * args.dreams} снов "
+              f"(заполнение {time.perf_counter() - t0:.1f} сек)")
+        await bench_startup(path)
+        await bench_updates(path, args.users, args.updates)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,72 @@
+"""
+Масштабирование по процессам-обработчикам (WORKER_PROCESSES).
+
+Для каждого числа процессов запускает нагрузочный стенд (bench/loadtest.py)
+с быстрой заглушкой OpenAI и нагрузкой выше возможностей бота, так что
+пропускная способность упирается в CPU обработчиков, а не в задержку модели.
+Заглушки работают в отдельных процессах. Печатает пропускную способность,
+ускорение и эффективность относительно одного процесса.
+
+Осмысленно только на машине, где ядер не меньше, чем процессов бота
+плюс процессы заглушек и стенда.
+
+Пример (из корня репозитория):
+    python bench/scaleout.py --workers 1,2,4 --rate 800 --duration 15
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import loadtest  # noqa: E402
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", default="1,2,4", help="числа процессов через запятую")
+    parser.add_argument("--rate", type=float, default=800, help="апдейтов в секунду (выше возможностей бота)")
+    parser.add_argument("--duration", type=float, default=15, help="длительность подачи, сек")
+    parser.add_argument("--median", type=float, default=0.05, help="медиана задержки OpenAI, сек")
+    parser.add_argument("--mock-processes", type=int, default=max(1, (os.cpu_count() or 2) // 4))
+    parser.add_argument("--env", action="append", default=[], help="переменная окружения бота KEY=VALUE")
+    parser.add_argument("--json", help="сохранить результаты в файл")
+    args = parser.parse_args()
+
+    results = []
+    for workers in (int(n) for n in args.workers.split(",")):
+        run_args = loadtest.parse_args([
+            "--rate", str(args.rate), "--duration", str(args.duration),
+            "--median", str(args.median), "--sigma", "0.2", "--telegram-latency", "0.005",
+            "--mock-processes", str(args.mock_processes), "--drain-timeout", "300",
+            "--env", f"WORKER_PROCESSES={workers}",
+            # Очередь вмещает весь прогон: меряем обработку, а не отказы приёма
+            "--env", f"INGEST_QUEUE_SIZE={int(args.rate * args.duration) + 1}",
+            "--env", "OPENAI_MAX_CONCURRENCY=256",
+            "--env", "SCHEDULER_MAX_QUEUE=100000",
+            *(item for env in args.env for item in ("--env", env)),
+        ])
+        print(f"\n=== Процессов-обработчиков: {workers} ===")
+        result = asyncio.run(loadtest.run(run_args))
+        loadtest.report(result)
+        results.append((workers, result))
+
+    base = results[0][1]["throughput"] / results[0][0] if results and results[0][1]["throughput"] else None
+    print("\nПроцессов  апдейтов/сек  ускорение  эффективность  p95 handle_message, мс")
+    for workers, result in results:
+        throughput = result["throughput"]
+        speedup = throughput / base if base else float("nan")
+        handler = result["handlers"].get("handle_message")
+        p95 = handler[1][0.95] * 1000 if handler else float("nan")
+        print(f"{workers:>9}  {throughput:>12.1f}  {speedup:>9.2f}  {speedup / workers:>13.0%}  {p95:>10.1f}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump([{"workers": w, **r} for w, r in results], f, ensure_ascii=False, indent=2, default=str)
+
+
+if __name__ == "__main__":
+    main()
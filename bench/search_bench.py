@@ -0,0 +1,155 @@
+"""
+Бенчмарк поиска по архиву снов (/search и /symbols).
+
+Меряет:
+  - стоимость инкрементальной индексации: сброс пачек снов в SQLite
+    с обновлением индекса и без него;
+  - задержку /search (первая и дальняя страницы) и /symbols на пользователе
+    с большим архивом среди других пользователей;
+  - для сравнения — линейный просмотр архива (LIKE) без ранжирования.
+
+Запуск из корня репозитория:
+    python bench/search_bench.py [--dreams 10000] [--other-users 1000]
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+MOTIFS = [
+    "вода", "море", "река", "змея", "зубы", "полёт", "падение", "дом", "лестница", "поезд",
+    "экзамен", "школа", "дедушка", "мама", "собака", "кошка", "лес", "дорога", "огонь", "зеркало",
+    "ребёнок", "свадьба", "кровь", "деньги", "ключи", "дверь", "окно", "город", "мост", "гора",
+]
+VERBS = ["видел", "искал", "убегал от", "держал", "потерял", "нашёл", "боялся", "шёл через", "смотрел на"]
+QUERIES = ["вода", "воду", "змеи зубы", "полёт над городом", "дедушкин дом", "потерял ключи", "зеркала"]
+
+
+def make_dream(rng: random.Random) -> tuple:
+    motifs = rng.sample(MOTIFS, 3)
+    dream = (f"Мне снилось, что я {rng.choice(VERBS)} {motifs[0]}, потом {rng.choice(VERBS)} "
+             f"{motifs[1]}, а вокруг был {motifs[2]} и было тревожно")
+    reply = (f"Образ «{motifs[0]}» говорит о переменах, а {motifs[1]} — о том, что тебя волнует. "
+             f"Совет: обрати внимание на чувства, связанные с образом «{motifs[2]}».")
+    return dream, reply
+
+
+def percentile(values: list, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def populate(persistence, user_ids: list, dreams: int, rng: random.Random, batch: int) -> float:
+    """
+    Добавляет сны пачками по batch через обычный путь add_dream/flush.
+    Возвращает время на сон, мкс.
+    """
+    started = time.perf_counter()
+    count = 0
+    for user_id in user_ids:
+        for _ in range(dreams):
+            persistence.add_dream(user_id, *make_dream(rng), "Мастер")
+            count += 1
+            if count % batch == 0:
+                await persistence.flush()
+    await persistence.flush()
+    return (time.perf_counter() - started) / max(count, 1) * 1e6
+
+
+async def bench_indexing(path: str, rng: random.Random) -> None:
+    """
+    Запись пачек снов с обновлением индекса и без (индексацию подменяем пустышкой).
+    """
+    persistence = bot.SQLitePersistence(path, flush_interval=60)
+    with_index = await populate(persistence, range(10_000_000, 10_000_050), 40, rng, 100)
+    persistence.close()
+
+    original = bot.index_dream
+    bot.index_dream = lambda *args: None
+    try:
+        persistence = bot.SQLitePersistence(path, flush_interval=60)
+        without_index = await populate(persistence, range(20_000_000, 20_000_050), 40, rng, 100)
+        persistence.close()
+    finally:
+        bot.index_dream = original
+
+    print(f"Запись сна с индексом:      {with_index:8.1f} мкс")
+    print(f"Запись сна без индекса:     {without_index:8.1f} мкс")
+
+
+async def bench_queries(path: str, user_id: int, repeats: int) -> None:
+    persistence = bot.SQLitePersistence(path, flush_interval=60)
+    await persistence.search(user_id, "вода")   # Прогрев (сверка архива с индексом)
+
+    for label, offset in (("первая страница", 0), ("страница 20", 100)):
+        timings = []
+        for _ in range(repeats):
+            for query in QUERIES:
+                t0 = time.perf_counter()
+                rows, total = await persistence.search(user_id, query, offset, bot.SEARCH_PAGE_SIZE)
+                timings.append(time.perf_counter() - t0)
+        print(f"/search, {label:<16} p50 {percentile(timings, 0.5) * 1000:6.2f} мс, "
+              f"p95 {percentile(timings, 0.95) * 1000:6.2f} мс, p99 {percentile(timings, 0.99) * 1000:6.2f} мс")
+
+    rows, total = await persistence.search(user_id, "змеи зубы", 0, 3)
+    print(f"Пример: «змеи зубы» — найдено {total}, лучший: {rows[0][1][:80]}…")
+
+    timings = []
+    for _ in range(repeats * len(QUERIES)):
+        t0 = time.perf_counter()
+        symbols, total = await persistence.symbols(user_id, bot.SYMBOLS_LIMIT)
+        timings.append(time.perf_counter() - t0)
+    print(f"/symbols                    p50 {percentile(timings, 0.5) * 1000:6.2f} мс, "
+          f"p95 {percentile(timings, 0.95) * 1000:6.2f} мс")
+    print(f"Образы: {', '.join(f'{word} ({n})' for word, n in symbols[:6])}, … из {total} снов")
+
+    timings = []
+    for _ in range(repeats):
+        for query in QUERIES:
+            t0 = time.perf_counter()
+            await asyncio.to_thread(
+                persistence._execute,
+                "SELECT id FROM history WHERE user_id = ? AND (dream LIKE ? OR reply LIKE ?)",
+                (user_id, f"%{query}%", f"%{query}%")
+            )
+            timings.append(time.perf_counter() - t0)
+    print(f"Линейный LIKE (без ранжир.) p50 {percentile(timings, 0.5) * 1000:6.2f} мс, "
+          f"p95 {percentile(timings, 0.95) * 1000:6.2f} мс")
+    persistence.close()
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dreams", type=int, default=10_000, help="снов в архиве пользователя")
+    parser.add_argument("--other-users", type=int, default=1000)
+    parser.add_argument("--other-dreams", type=int, default=20, help="снов у каждого другого пользователя")
+    parser.add_argument("--repeats", type=int, default=30)
+    args = parser.parse_args()
+
+    bot.MAX_STORED_HISTORY = max(bot.MAX_STORED_HISTORY, args.dreams)
+    rng = random.Random(1)
+    stemmer = "snowball" if bot.snowballstemmer is not None else "упрощённый"
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        persistence = bot.SQLitePersistence(path, flush_interval=60)
+        t0 = time.perf_counter()
+        await populate(persistence, range(args.other_users), args.other_dreams, rng, 5000)
+        per_dream = await populate(persistence, [42], args.dreams, rng, 5000)
+        persistence.close()
+        print(f"База: {args.dreams} снов у пользователя + {args.other_users}×{args.other_dreams} у других "
+              f"(заполнение {time.perf_counter() - t0:.1f} сек, {per_dream:.0f} мкс на сон; стемминг: {stemmer})")
+
+        await bench_indexing(path, rng)
+        await bench_queries(path, 42, args.repeats)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,62 +1,358 @@
 import os
+import re
+import html
+import queue
+import atexit
+import asyncio
+import functools
+import hashlib
+import heapq
+import json
 import logging
+import math
+import multiprocessing
 import smtplib
+import sys
+import sqlite3
 import random
+import signal
+import threading
 import time
-from collections import deque
+from collections import OrderedDict, deque
+from dataclasses import dataclass, replace
+from typing import Optional
+from urllib.parse import urlparse
 from email.mime.text import MIMEText
-from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
+from logging.handlers import QueueHandler, QueueListener
+import httpx
+import tornado.web
+import tornado.httpserver
+from telegram import Bot, Update, Message, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram.constants import ParseMode
+from telegram.error import RetryAfter, TelegramError
 from telegram.ext import (
     Application,
+    BasePersistence,
+    PersistenceInput,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
     ContextTypes,
     filters
 )
-from openai import OpenAI
+from telegram.request import HTTPXRequest
+from openai import AsyncOpenAI, APIConnectionError, APIStatusError, RateLimitError
+
+try:
+    import tiktoken
+except ImportError:   # Без tiktoken токены оцениваются по длине текста
+    tiktoken = None
+
+try:
+    import snowballstemmer
+except ImportError:   # Без snowballstemmer — упрощённое отсечение окончаний
+    snowballstemmer = None
 
 # ─────────────────────────────────────────────────────────────────────────────
 #                    Настройка логирования и email-уведомлений
 # ─────────────────────────────────────────────────────────────────────────────
 
-# Логируем ошибки и информацию о токенах
-logging.basicConfig(
-    filename="error.log",
-    filemode="a",
-    format="%(asctime)s | %(levelname)s | %(message)s",
-    level=logging.INFO
-)
+# Логируем ошибки и информацию о токенах. Запись в файл идёт в отдельном
+# потоке QueueListener: обработчики только кладут запись в очередь.
+_log_queue = queue.SimpleQueue()
+_log_file_handler = logging.FileHandler("error.log", mode="a", encoding="utf-8")
+_log_file_handler.setFormatter(logging.Formatter("%(asctime)s | %(levelname)s | %(message)s"))
+# QueueHandler форматирует запись до постановки в очередь: оставляем только
+# текст (с traceback), префикс со временем и уровнем добавит файловый обработчик
+_log_queue_handler = QueueHandler(_log_queue)
+_log_queue_handler.setFormatter(logging.Formatter("%(message)s"))
+logging.basicConfig(handlers=[_log_queue_handler], level=logging.INFO)
+logging.getLogger("httpx").setLevel(logging.WARNING)   # Не пишем строку на каждый HTTP-запрос
+log_listener = QueueListener(_log_queue, _log_file_handler, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
 
-# Функция для отправки письма с текстом ошибки (если настроен SMTP)
-def send_error_email(subject: str, body: str) -> None:
+# Отправка писем с текстом ошибки (если настроен SMTP).
+# Соединение переиспользуется между письмами; вызывается только из фонового
+# обработчика алертов через asyncio.to_thread, поэтому event loop не блокирует.
+class SMTPMailer:
     """
     Отправляет email с указанной темой и текстом (body).
     Требуются переменные окружения:
       EMAIL_SMTP_SERVER, EMAIL_SMTP_PORT,
       EMAIL_USER, EMAIL_PASSWORD, EMAIL_TO
     """
-    try:
-        smtp_server = os.getenv("EMAIL_SMTP_SERVER")
-        smtp_port = int(os.getenv("EMAIL_SMTP_PORT", "587"))
-        email_user = os.getenv("EMAIL_USER")
-        email_pass = os.getenv("EMAIL_PASSWORD")
-        email_to = os.getenv("EMAIL_TO")
 
-        if not all([smtp_server, smtp_port, email_user, email_pass, email_to]):
+    def __init__(self) -> None:
+        self.smtp_server = os.getenv("EMAIL_SMTP_SERVER")
+        self.smtp_port = int(os.getenv("EMAIL_SMTP_PORT", "587"))
+        self.email_user = os.getenv("EMAIL_USER")
+        self.email_pass = os.getenv("EMAIL_PASSWORD")
+        self.email_to = os.getenv("EMAIL_TO")
+        self.use_tls = os.getenv("EMAIL_STARTTLS", "1") == "1"
+        self._server = None
+
+    @property
+    def configured(self) -> bool:
+        return all([self.smtp_server, self.smtp_port, self.email_user,
+                    self.email_pass, self.email_to])
+
+    def _connect(self) -> smtplib.SMTP:
+        server = smtplib.SMTP(self.smtp_server, self.smtp_port, timeout=SMTP_TIMEOUT)
+        if self.use_tls:
+            server.starttls()
+        server.login(self.email_user, self.email_pass)
+        return server
+
+    def send(self, subject: str, body: str) -> None:
+        if not self.configured:
             return
 
         msg = MIMEText(body, _charset="utf-8")
         msg["Subject"] = subject
-        msg["From"] = email_user
-        msg["To"] = email_to
+        msg["From"] = self.email_user
+        msg["To"] = self.email_to
 
-        with smtplib.SMTP(smtp_server, smtp_port) as server:
-            server.starttls()
-            server.login(email_user, email_pass)
-            server.sendmail(email_user, [email_to], msg.as_string())
-    except Exception as e:
-        logging.error(f"Не удалось отправить email: {e}")
+        try:
+            # Одна попытка переподключения: сервер мог закрыть простаивающее соединение
+            for attempt in range(2):
+                try:
+                    if self._server is None:
+                        self._server = self._connect()
+                    self._server.sendmail(self.email_user, [self.email_to], msg.as_string())
+                    return
+                except (smtplib.SMTPServerDisconnected, ConnectionError):
+                    self._server = None
+                    if attempt:
+                        raise
+        except Exception as e:
+            self._server = None
+            logging.error(f"Не удалось отправить email: {e}")
+
+    def close(self) -> None:
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except Exception:
+                pass
+            self._server = None
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+#                 Метрики в формате Prometheus (эндпоинт /metrics)
+# ─────────────────────────────────────────────────────────────────────────────
+
+# Границы корзин гистограмм задержек (секунды)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40)
+
+
+class _Metric:
+    """
+    Базовая метрика с метками. Значения хранятся по кортежу значений меток.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._values = {}
+        METRICS.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _format_labels(self, key: tuple, extra: str = "") -> str:
+        pairs = [f'{name}="{value}"' for name, value in zip(self.labelnames, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{self._format_labels(key)} {value}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """
+    Gauge: значение задаётся через set/add или вычисляется при выдаче
+    функцией (set_function) — так в /metrics попадают живые очереди и кэш.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()) -> None:
+        super().__init__(name, help_text, labelnames)
+        self._function = None
+
+    def set(self, value: float, **labels) -> None:
+        self._values[self._key(labels)] = value
+
+    def add(self, amount: float, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def set_function(self, function) -> None:
+        self._function = function
+
+    def render(self) -> list:
+        if self._function is not None:
+            try:
+                self._values = {self._key(labels): value for labels, value in self._function()}
+            except Exception as e:
+                logging.warning(f"Не удалось вычислить метрику {self.name}: {e}")
+        return super().render()
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = (),
+                 buckets: tuple = LATENCY_BUCKETS) -> None:
+        super().__init__(name, help_text, labelnames)
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        counts = state[0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        state[1] += value
+        state[2] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for key, (counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{self._format_labels(key, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{self._format_labels(key, le)} {count}")
+            lines.append(f"{self.name}_sum{self._format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{self._format_labels(key)} {count}")
+        return lines
+
+
+METRICS = []
+
+UPDATE_SECONDS = Histogram(
+    "intui_update_handling_seconds", "Время обработки апдейта по обработчикам", ("handler",))
+UPDATES_IN_FLIGHT = Gauge(
+    "intui_updates_in_flight", "Апдейты в обработке по обработчикам", ("handler",))
+OPENAI_QUEUE_WAIT = Histogram(
+    "intui_openai_queue_wait_seconds", "Ожидание допуска к OpenAI в планировщике")
+OPENAI_TTFT = Histogram(
+    "intui_openai_ttft_seconds", "Время до первого токена OpenAI", ("model",))
+OPENAI_TOTAL = Histogram(
+    "intui_openai_total_seconds", "Полное время ответа OpenAI", ("model",))
+OPENAI_IN_FLIGHT = Gauge(
+    "intui_openai_in_flight", "Запросы к OpenAI: выполняются и ждут в очереди", ("state",))
+TELEGRAM_SECONDS = Histogram(
+    "intui_telegram_request_seconds", "Задержка запросов к Bot API по методам", ("method",))
+ERRORS = Counter(
+    "intui_errors_total", "Ошибки по типам", ("type",))
+TOKENS = Counter(
+    "intui_tokens_total", "Потраченные токены OpenAI", ("kind", "model"))
+FOLLOWUP_PROMPT_TOKENS = Counter(
+    "intui_followup_prompt_tokens_total",
+    "Промпт уточняющих вопросов: со сводкой и с полным контекстом (оценка)", ("context",))
+CACHE_EVENTS = Gauge(
+    "intui_cache_events", "Счётчики кэша интерпретаций", ("event",))
+EVENT_LOOP_LAG = Gauge(
+    "intui_event_loop_lag_seconds", "Запаздывание event loop (последний замер)")
+INGEST_DEPTH = Gauge(
+    "intui_ingest_queue_depth", "Принятые webhook-апдейты, ждущие обработки", ("state",))
+INGEST_DROPPED = Counter(
+    "intui_ingest_dropped_total", "Отброшенные webhook-апдейты по причинам", ("reason",))
+INGEST_WAIT = Histogram(
+    "intui_ingest_wait_seconds", "Ожидание апдейта во внутренней очереди до обработки")
+WORKER_RESPAWNS = Counter(
+    "intui_worker_respawns_total", "Перезапуски упавших процессов-обработчиков", ("worker",))
+
+
+def render_metrics() -> str:
+    """
+    Все метрики процесса в текстовом формате Prometheus.
+    """
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def instrumented(handler_name: str):
+    """
+    Декоратор обработчика: время обработки, число апдейтов в работе
+    и необработанные ошибки по типам.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+            UPDATES_IN_FLIGHT.add(1, handler=handler_name)
+            started = time.perf_counter()
+            try:
+                return await handler(update, context)
+            except Exception as e:
+                ERRORS.inc(type=type(e).__name__)
+                raise
+            finally:
+                UPDATE_SECONDS.observe(time.perf_counter() - started, handler=handler_name)
+                UPDATES_IN_FLIGHT.add(-1, handler=handler_name)
+        return wrapper
+    return decorator
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """
+    HTTPXRequest, который замеряет задержку каждого вызова Bot API
+    (sendMessage, editMessageText, ...).
+    """
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().do_request(url, method, *args, **kwargs)
+        finally:
+            TELEGRAM_SECONDS.observe(time.perf_counter() - started, method=url.rsplit("/", 1)[-1])
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """
+    GET /metrics — отдаёт метрики процесса.
+    """
+
+    def get(self) -> None:
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(render_metrics())
+
+
+async def monitor_event_loop_lag(interval: float = 0.5) -> None:
+    """
+    Фоновая задача: насколько позже запланированного просыпается event loop.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.set(max(0.0, loop.time() - expected))
 
 
 # ─────────────────────────────────────────────────────────────────────────────
@@ -66,8 +362,85 @@ def send_error_email(subject: str, body: str) -> None:
 TELEGRAM_TOKEN     = os.getenv("TELEGRAM_TOKEN")
 OPENAI_API_KEY     = os.getenv("OPENAI_API_KEY")
 WEBHOOK_URL        = os.getenv("WEBHOOK_URL")
+TELEGRAM_API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL")   # Например, http://127.0.0.1:8081
 ADMIN_TELEGRAM_ID  = 629449375   # Ваш Telegram ID для уведомлений об ошибках и usage
 
+# Пул HTTP-соединений к OpenAI: один клиент на всё приложение
+OPENAI_MAX_CONNECTIONS  = int(os.getenv("OPENAI_MAX_CONNECTIONS", "50"))
+OPENAI_MAX_KEEPALIVE    = int(os.getenv("OPENAI_MAX_KEEPALIVE", "20"))
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "30"))
+OPENAI_CONNECT_TIMEOUT  = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "5"))
+OPENAI_READ_TIMEOUT     = float(os.getenv("OPENAI_READ_TIMEOUT", "60"))
+
+# Потоковая выдача интерпретаций и троттлинг правок сообщения
+OPENAI_STREAM         = os.getenv("OPENAI_STREAM", "1") == "1"
+STREAM_EDIT_INTERVAL  = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))  # Минимум секунд между правками
+STREAM_EDIT_MIN_CHARS = int(os.getenv("STREAM_EDIT_MIN_CHARS", "80"))    # Минимум новых символов для правки
+
+# Кэш интерпретаций: LRU в памяти + опциональный SQLite на диске
+CACHE_MAX_ENTRIES     = int(os.getenv("CACHE_MAX_ENTRIES", "2000"))
+CACHE_TTL             = float(os.getenv("CACHE_TTL", str(7 * 24 * 3600)))   # Секунды
+CACHE_DB_PATH         = os.getenv("CACHE_DB_PATH")                         # Не задан — только память
+CACHE_MAX_INPUT_CHARS = int(os.getenv("CACHE_MAX_INPUT_CHARS", "300"))     # Кэшируем только короткие сны
+
+# Планировщик запросов к OpenAI: лимиты аккаунта, очередь и повторы 429
+OPENAI_RPM_LIMIT           = int(os.getenv("OPENAI_RPM_LIMIT", "500"))       # Запросов в минуту
+OPENAI_TPM_LIMIT           = int(os.getenv("OPENAI_TPM_LIMIT", "30000"))     # Токенов в минуту
+OPENAI_MAX_CONCURRENCY     = int(os.getenv("OPENAI_MAX_CONCURRENCY", "16"))  # Одновременных запросов
+SCHEDULER_MAX_QUEUE        = int(os.getenv("SCHEDULER_MAX_QUEUE", "200"))    # Всего ждущих
+SCHEDULER_MAX_PER_USER     = int(os.getenv("SCHEDULER_MAX_PER_USER", "3"))   # Ждущих от одного пользователя
+QUEUE_POSITION_INTERVAL    = float(os.getenv("QUEUE_POSITION_INTERVAL", "3"))  # Как часто обновлять позицию
+OPENAI_RATE_LIMIT_RETRIES  = int(os.getenv("OPENAI_RATE_LIMIT_RETRIES", "4"))
+OPENAI_BACKOFF_BASE        = float(os.getenv("OPENAI_BACKOFF_BASE", "1.0"))    # Секунды
+
+# Алерты: склейка, дедупликация и лимиты уведомлений
+ALERT_BATCH_DELAY       = float(os.getenv("ALERT_BATCH_DELAY", "2"))        # Окно склейки в обычном режиме
+ALERT_DIGEST_INTERVAL   = float(os.getenv("ALERT_DIGEST_INTERVAL", "60"))   # Одна сводка за интервал при шторме
+ALERT_DEDUP_WINDOW      = float(os.getenv("ALERT_DEDUP_WINDOW", "600"))     # Не повторять ту же ошибку в Telegram
+ALERT_TELEGRAM_PER_HOUR = int(os.getenv("ALERT_TELEGRAM_PER_HOUR", "20"))
+ALERT_QUEUE_SIZE        = 1000
+SMTP_TIMEOUT            = float(os.getenv("SMTP_TIMEOUT", "10"))
+
+# Уровни моделей: основная первой, дальше — дешевле/быстрее для хеджирования
+MODEL_TIERS = [m.strip() for m in os.getenv("MODEL_TIERS", "gpt-4o,gpt-4o-mini").split(",") if m.strip()]
+HEDGE_MIN_DELAY           = float(os.getenv("HEDGE_MIN_DELAY", "1.5"))  # Нижняя граница дедлайна (сек)
+HEDGE_MAX_DELAY           = float(os.getenv("HEDGE_MAX_DELAY", "8"))    # Верхняя граница и значение по умолчанию
+HEDGE_LATENCY_WINDOW      = 200                                         # Замеров для расчёта p95
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_COOLDOWN          = float(os.getenv("BREAKER_COOLDOWN", "30"))  # Секунды
+
+# Бюджет токенов: обрезка длинных снов, длина ответа и квоты пользователей.
+# Словарь tiktoken при первом запуске скачивается из сети и кэшируется;
+# для работы без сети положите его заранее в каталог TIKTOKEN_CACHE_DIR
+# (переменная окружения tiktoken), иначе токены оцениваются по длине текста.
+TOKENIZER_ENCODING         = os.getenv("TOKENIZER_ENCODING", "o200k_base")   # Кодировка gpt-4o
+MAX_INPUT_TOKENS           = int(os.getenv("MAX_INPUT_TOKENS", "800"))       # Длиннее — сокращаем
+MIN_COMPLETION_TOKENS      = 200
+ADAPTIVE_FULL_INPUT_TOKENS = 300             # С такой длины сна ответ получает полный лимит стиля
+STYLE_MAX_TOKENS = {
+    "Мастер": 500,
+    "Психоаналитик": 550,
+    "Мистик": 450
+}
+DAILY_TOKEN_QUOTA    = int(os.getenv("DAILY_TOKEN_QUOTA", "20000"))      # 0 — без лимита
+MONTHLY_TOKEN_QUOTA  = int(os.getenv("MONTHLY_TOKEN_QUOTA", "300000"))   # 0 — без лимита
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "60"))    # Секунды
+
+# Эндпоинт метрик Prometheus (0 — выключен) и пул соединений к Bot API
+METRICS_PORT       = int(os.getenv("METRICS_PORT", "9100"))
+METRICS_LISTEN     = os.getenv("METRICS_LISTEN", "127.0.0.1")   # 0.0.0.0 — открыть /metrics наружу
+TELEGRAM_POOL_SIZE = int(os.getenv("TELEGRAM_POOL_SIZE", "256"))
+
+# Сколько апдейтов PTB обрабатывает одновременно (иначе один сон держит всех)
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "64"))
+
+# Приём webhook: мгновенный ответ Telegram, очередь и пул обработчиков
+FAST_ACK_WEBHOOK     = os.getenv("FAST_ACK_WEBHOOK", "1") == "1"  # 0 — штатный run_webhook PTB
+INGEST_WORKERS       = int(os.getenv("INGEST_WORKERS", "64"))     # Одновременно обрабатываемых апдейтов
+INGEST_QUEUE_SIZE    = int(os.getenv("INGEST_QUEUE_SIZE", "1000"))  # Больше — отвечаем 503, Telegram повторит
+INGEST_DEDUP_WINDOW  = int(os.getenv("INGEST_DEDUP_WINDOW", "65536"))  # Последних update_id (бит на каждый)
+INGEST_DRAIN_TIMEOUT = float(os.getenv("INGEST_DRAIN_TIMEOUT", "30"))  # Секунды на дообработку при остановке
+
 # Уменьшенные и оптимизированные промпты для экономии токенов
 STYLE_PROMPTS = {
     "Мастер": (
@@ -93,290 +466,3203 @@ STYLE_PROMPTS = {
 }
 
 DEFAULT_STYLE = "Мастер"       # Стиль по умолчанию
-MAX_HISTORY_ENTRIES = 3       # Лимит записей истории
+MAX_HISTORY_ENTRIES = 3       # Сколько последних снов держим в user_data
+
+# Уточняющие вопросы (reply на толкование): сводка разговора вместо всей переписки
+FOLLOWUP_MAX_THREADS         = 3     # Разговоров о снах в user_data
+FOLLOWUP_SUMMARY_TOKENS      = int(os.getenv("FOLLOWUP_SUMMARY_TOKENS", "350"))
+FOLLOWUP_DREAM_TOKENS        = 80    # Сон в сводке
+FOLLOWUP_GIST_TOKENS         = 80    # Суть толкования в сводке
+FOLLOWUP_TURN_TOKENS         = 40    # Вопрос и ответ каждого хода в сводке
+FOLLOWUP_MAX_QUESTION_TOKENS = 300
+FOLLOWUP_MAX_TOKENS          = int(os.getenv("FOLLOWUP_MAX_TOKENS", "300"))
+FOLLOWUP_PROMPT = (
+    "Это уточняющий вопрос о сне, который ты уже растолковал (суть — в контексте). "
+    "Отвечай коротко, по существу вопроса; «Совет:» — только если он нужен."
+)
+
+# Постоянное хранилище: SQLite с пакетной записью
+DB_PATH                    = os.getenv("DB_PATH", "intui.db")
+PERSISTENCE_FLUSH_INTERVAL = float(os.getenv("PERSISTENCE_FLUSH_INTERVAL", "5"))  # Секунды
+MAX_STORED_HISTORY         = int(os.getenv("MAX_STORED_HISTORY", "500"))  # Снов в архиве пользователя
+HISTORY_PAGE_SIZE          = 5                                             # Снов на странице /history
+
+# Поиск по архиву снов (/search) и повторяющиеся образы (/symbols)
+SEARCH_PAGE_SIZE    = 5
+SEARCH_DREAM_WEIGHT = 2      # Слово из текста сна весит больше, чем из толкования
+BM25_K1             = 1.2
+BM25_B              = 0.75
+SYMBOLS_LIMIT       = 15     # Образов в /symbols
+SYMBOLS_MIN_DREAMS  = 2      # Образ должен встретиться хотя бы в стольких снах
+
+# Несколько процессов-обработчиков за одним приёмом webhook (1 — всё в одном процессе)
+WORKER_PROCESSES         = int(os.getenv("WORKER_PROCESSES", "1"))
+WORKER_RESPAWN_MAX_DELAY = 30   # Секунды между перезапусками процесса, который падает сразу
+if WORKER_PROCESSES > 1 and not CACHE_DB_PATH:
+    CACHE_DB_PATH = DB_PATH     # Дисковый кэш интерпретаций общий для всех процессов
 
 # ─────────────────────────────────────────────────────────────────────────────
-#                           Команда /start
+#                    Общий асинхронный клиент OpenAI
 # ─────────────────────────────────────────────────────────────────────────────
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+def create_openai_client() -> AsyncOpenAI:
     """
-    Приветственное сообщение с кнопками:
-     - 🌙 Рассказать сон
-     - 🎭 Выбрать стиль
-     - 📜 История снов
-    Инициализирует user_data.
+    Создаёт AsyncOpenAI с собственным пулом соединений (keep-alive,
+    лимит соединений, таймауты). TLS-соединения переиспользуются между снами.
     """
-    context.user_data["style"] = DEFAULT_STYLE
-    context.user_data["history"] = []
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+            keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY
+        ),
+        timeout=httpx.Timeout(OPENAI_READ_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT)
+    )
+    # Повторы (сеть, таймауты, 408/409/429/5xx) делает планировщик,
+    # чтобы они учитывались в лимитах
+    return AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=http_client, max_retries=0)
 
-    keyboard = [
-        [InlineKeyboardButton("🌙 Рассказать сон", callback_data="write_dream")],
-        [InlineKeyboardButton("🎭 Выбрать стиль", callback_data="choose_style")],
-        [InlineKeyboardButton("📜 История снов", callback_data="show_history")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
 
-    user = update.effective_user
-    await update.message.reply_html(
-        f"""Приветствую тебя, {user.mention_html()}! ✨
-Я — Интуи, твоя проводница по миру снов.
-У меня есть несколько вариантов стиля интерпретации сна.
-Ты сможешь выбрать удобный стиль или сразу рассказать сон.
-Что хочешь сделать?""",
-        reply_markup=reply_markup
+async def post_init(application: Application) -> None:
+    """
+    Вызывается PTB один раз при старте: создаём общий клиент OpenAI.
+    """
+    application.bot_data["openai"] = create_openai_client()
+    alert_pipeline.start(application.bot)
+    # Словарь токенизатора может качаться по сети — не на event loop в первом сне
+    await asyncio.to_thread(_get_encoder)
+
+    cache = InterpretationCache(CACHE_MAX_ENTRIES, CACHE_TTL, CACHE_DB_PATH)
+    cache.open()
+    application.bot_data["cache"] = cache
+    application.bot_data["inflight"] = SingleFlight()
+    application.bot_data["ledger"] = TokenLedger(DB_PATH)
+    application.bot_data["ledger"].start()
+    application.bot_data["backend"] = TieredBackend(MODEL_TIERS)
+    scheduler = application.bot_data["scheduler"] = CompletionScheduler(
+        OPENAI_RPM_LIMIT, OPENAI_TPM_LIMIT, OPENAI_MAX_CONCURRENCY,
+        SCHEDULER_MAX_QUEUE, SCHEDULER_MAX_PER_USER
     )
 
+    # Живые значения для /metrics считаются в момент запроса метрик
+    OPENAI_IN_FLIGHT.set_function(lambda: [
+        ({"state": "active"}, scheduler.active),
+        ({"state": "queued"}, scheduler.waiting)
+    ])
+    CACHE_EVENTS.set_function(lambda: [({"event": k}, v) for k, v in cache.stats.items()])
+    application.bot_data["lag_monitor"] = asyncio.create_task(monitor_event_loop_lag())
+    if METRICS_PORT:
+        server = tornado.httpserver.HTTPServer(
+            tornado.web.Application([(r"/metrics", MetricsHandler)])
+        )
+        server.listen(METRICS_PORT, METRICS_LISTEN)
+        application.bot_data["metrics_server"] = server
 
-# ─────────────────────────────────────────────────────────────────────────────
-#                         Обработчик кнопок CallbackQuery
-# ─────────────────────────────────────────────────────────────────────────────
 
-async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def post_stop(application: Application) -> None:
     """
-    Обрабатывает нажатия Inline-кнопок:
-     - write_dream      → просит пользователя написать сон
-     - choose_style     → предлагает меню выбора стиля
-     - show_history     → показывает последние 3 сна
-     - style_<имя>      → устанавливает выбран стиль
+    Вызывается PTB после остановки обработки апдейтов, пока бот ещё может
+    отправлять сообщения: досылаем накопленные алерты и сохраняем
+    счётчики токенов.
     """
-    query = update.callback_query
-    await query.answer()
+    await alert_pipeline.stop()
+    await application.bot_data["ledger"].stop()
 
-    data = query.data
 
-    if data == "write_dream":
-        await query.edit_message_text("📝 Напиши мне, что тебе приснилось...")
-        return
+async def post_shutdown(application: Application) -> None:
+    """
+    Вызывается PTB при остановке: закрываем пул соединений OpenAI, кэш
+    и базу пользователей (PTB уже сбросил в неё последнюю пачку).
+    """
+    client = application.bot_data.pop("openai", None)
+    if client is not None:
+        await client.close()
 
-    if data == "choose_style":
-        keyboard = [
-            [InlineKeyboardButton(style_name, callback_data=f"style_{style_name}")]
-            for style_name in STYLE_PROMPTS.keys()
-        ]
-        await query.edit_message_text(
-            "🎭 Выбери стиль интерпретации:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-        return
+    server = application.bot_data.pop("metrics_server", None)
+    if server is not None:
+        server.stop()
+    lag_monitor = application.bot_data.pop("lag_monitor", None)
+    if lag_monitor is not None:
+        lag_monitor.cancel()
 
-    if data == "show_history":
-        history = context.user_data.get("history", [])
-        if not history:
-            await query.edit_message_text("📜 История пока пуста.")
-        else:
-            text = "📜 Последние сны:\n\n"
-            for i, (dream_text, _, style_name) in enumerate(reversed(history), 1):
-                snippet = dream_text if len(dream_text) <= 40 else dream_text[:40] + "..."
-                text += f"{i}. 💤 *{snippet}* — _{style_name}_\n"
-            await query.edit_message_text(text, parse_mode="Markdown")
-        return
+    cache = application.bot_data.pop("cache", None)
+    if cache is not None:
+        logging.info(cache.describe().replace("\n", "; "))
+        cache.close()
 
-    if data.startswith("style_"):
-        selected_style = data.replace("style_", "")
-        context.user_data["style"] = selected_style
-        await query.edit_message_text(
-            f"✅ Стиль интерпретации установлен: *{selected_style}*. Теперь опиши свой сон.",
-            parse_mode="Markdown"
-        )
-        return
+    if application.persistence is not None:
+        application.persistence.close()
 
 
 # ─────────────────────────────────────────────────────────────────────────────
-#                       Команда /style (альтернативный вызов)
+#                          Кэш интерпретаций снов
 # ─────────────────────────────────────────────────────────────────────────────
 
-async def style_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+def normalize_dream(text: str) -> str:
     """
-    При вызове /style выводит меню выбора стилей.
+    Нормализует текст сна для ключа кэша: регистр, «ё», пунктуация, пробелы.
     """
-    keyboard = [
-        [InlineKeyboardButton(style_name, callback_data=f"style_{style_name}")]
-        for style_name in STYLE_PROMPTS.keys()
-    ]
-    await update.message.reply_text(
-        "🎭 Выбери стиль интерпретации:",
-        reply_markup=InlineKeyboardMarkup(keyboard)
-    )
+    text = text.lower().replace("ё", "е")
+    return " ".join(re.sub(r"[^\w]+", " ", text).split())
 
 
-# ─────────────────────────────────────────────────────────────────────────────
-#                    Команда /history (альтернативный вызов)
-# ─────────────────────────────────────────────────────────────────────────────
-
-async def history_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+def prompt_version(prompt: str) -> str:
     """
-    При вызове /history выводит до 3 последних снов.
+    Версия системного промпта — короткий хэш его текста. Любая правка
+    STYLE_PROMPTS меняет версию и тем самым инвалидирует старые записи кэша.
     """
-    history = context.user_data.get("history", [])
-    if not history:
-        await update.message.reply_text("📜 История пока пуста.")
-    else:
-        text = "📜 Последние сны:\n\n"
-        for i, (dream_text, _, style_name) in enumerate(reversed(history), 1):
-            snippet = dream_text if len(dream_text) <= 40 else dream_text[:40] + "..."
-            text += f"{i}. 💤 *{snippet}* — _{style_name}_\n"
-        await update.message.reply_text(text, parse_mode="Markdown")
+    return hashlib.sha1(prompt.encode("utf-8")).hexdigest()[:12]
 
 
-# ─────────────────────────────────────────────────────────────────────────────
-#                      Обработка текстовых сообщений (сны)
-# ─────────────────────────────────────────────────────────────────────────────
-
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+class InterpretationCache:
     """
-    Основная логика: принимает текст (сон), запрашивает интерпретацию у OpenAI,
-    сохраняет в историю (лимит 3), отвечает пользователю. Логирует ошибки и usage.
+    Двухуровневый кэш интерпретаций:
+     - в памяти: LRU с TTL и лимитом записей;
+     - на диске (опционально): SQLite, переживает перезапуски.
+    Ключ — (стиль, версия промпта, нормализованный текст сна).
     """
-    user_input = update.message.text
-    await update.message.reply_text("🔮 Я думаю над твоим сном...")
 
-    # Текущий стиль (по умолчанию "Мастер")
-    style_name = context.user_data.get("style", DEFAULT_STYLE)
-    prompt = STYLE_PROMPTS.get(style_name, STYLE_PROMPTS[DEFAULT_STYLE])
+    def __init__(self, max_entries: int, ttl: float, db_path: Optional[str] = None) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.db_path = db_path
+        self._memory = OrderedDict()   # key -> (expires_at, reply_text, tokens)
+        self._db = None
+        self._db_lock = threading.Lock()
+        self.stats = {
+            "hits": 0,
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "expired": 0,
+            "saved_tokens": 0
+        }
 
-    try:
-        # Инициализируем клиент OpenAI
-        client = OpenAI(api_key=OPENAI_API_KEY)
-
-        # Запрос к модели с оптимизированными параметрами
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": prompt},
-                {"role": "user", "content": user_input}
-            ],
-            temperature=0.6,   # Снижение температуры для более сдержанных ответов
-            max_tokens=500     # Ограничение длины ответа
-        )
+    @staticmethod
+    def make_key(style_name: str, prompt: str, user_input: str) -> str:
+        raw = f"{style_name}|{prompt_version(prompt)}|{normalize_dream(user_input)}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
 
-        # Логируем usage токенов
-        usage = response.usage
+    # ── Дисковый уровень ────────────────────────────────────────────────────
 
-        # Отправляем usage-статистику только администратору (не пользователю!)
-        if update.effective_user.id == ADMIN_TELEGRAM_ID:
-            await context.bot.send_message(
-                chat_id=ADMIN_TELEGRAM_ID,
-                text=(
-                    f"📊 Новый запрос:\n"
-                    f"Сон: {user_input[:30]}...\n"
-                    f"Модель: gpt-4o\n"
-                    f"Prompt tokens: {usage.prompt_tokens}\n"
-                    f"Completion tokens: {usage.completion_tokens}\n"
-                    f"Total tokens: {usage.total_tokens}"
-                )
+    def open(self) -> None:
+        """
+        Открывает SQLite-уровень и удаляет записи устаревших версий промптов.
+        """
+        if not self.db_path:
+            return
+        self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS interpretations ("
+            " key TEXT PRIMARY KEY, style TEXT, prompt_version TEXT,"
+            " reply TEXT, tokens INTEGER, expires_at REAL)"
+        )
+        versions = [prompt_version(p) for p in STYLE_PROMPTS.values()]
+        placeholders = ",".join("?" * len(versions))
+        with self._db:
+            self._db.execute(
+                f"DELETE FROM interpretations WHERE prompt_version NOT IN ({placeholders})"
+                f" OR expires_at < ?",
+                (*versions, time.time())
             )
 
-        # Логируем usage в файл
-        logging.info(
-            f"Usage — Prompt: {usage.prompt_tokens} токенов, "
-            f"Completion: {usage.completion_tokens} токенов, "
-            f"Total: {usage.total_tokens} токенов."
-        )
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
 
-        # Собираем текст ответа
-        reply_text = response.choices[0].message.content.strip()
+    def _disk_get(self, key: str):
+        with self._db_lock:
+            return self._db.execute(
+                "SELECT reply, tokens, expires_at FROM interpretations WHERE key = ?", (key,)
+            ).fetchone()
 
-        # Сохраняем в историю (только 3 записи)
-        history = context.user_data.setdefault("history", [])
-        history.append((user_input, reply_text, style_name))
-        if len(history) > MAX_HISTORY_ENTRIES:
-            history.pop(0)
+    def _disk_put(self, key: str, style_name: str, version: str,
+                  reply_text: str, tokens: int, expires_at: float) -> None:
+        with self._db_lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO interpretations VALUES (?, ?, ?, ?, ?, ?)",
+                (key, style_name, version, reply_text, tokens, expires_at)
+            )
 
-    except Exception as e:
-        # Внутренняя ошибка — логируем и уведомляем
-        error_message = f"Ошибка при обращении к OpenAI: {e}"
-        logging.error(error_message)
-        send_error_email(subject="Intui Bot Error", body=error_message)
+    # ── Публичный интерфейс ─────────────────────────────────────────────────
 
-        # Уведомляем админа в Telegram
-        try:
-            await context.bot.send_message(
-                chat_id=ADMIN_TELEGRAM_ID,
-                text=f"⚠️ Интуи поймала ошибку:\n{error_message}"
-            )
-        except Exception as tg_err:
-            logging.error(f"Ошибка при отправке Telegram-сообщения админу: {tg_err}")
+    def _remember(self, key: str, expires_at: float, reply_text: str, tokens: int) -> None:
+        self._memory[key] = (expires_at, reply_text, tokens)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self.stats["evictions"] += 1
 
-        # Случайная поэтичная заглушка
-        fallback_text = get_random_fallback()
-        await update.message.reply_text(fallback_text)
-        return  # Завершаем обработку, чтобы не шёл дальше
+    async def get(self, key: str) -> Optional[str]:
+        """
+        Возвращает закэшированную интерпретацию или None.
+        """
+        now = time.time()
+        entry = self._memory.get(key)
+        if entry is not None:
+            expires_at, reply_text, tokens = entry
+            if expires_at > now:
+                self._memory.move_to_end(key)
+                self.stats["hits"] += 1
+                self.stats["memory_hits"] += 1
+                self.stats["saved_tokens"] += tokens
+                return reply_text
+            del self._memory[key]
+            self.stats["expired"] += 1
 
-    # Форматирование ответа: выделяем блок "Совет:"
-    if "Совет:" in reply_text:
-        parts = reply_text.split("Совет:", maxsplit=1)
-        main_text = parts[0].strip()
-        advice_block = parts[1].strip()
+        if self._db is not None:
+            row = await asyncio.to_thread(self._disk_get, key)
+            if row is not None and row[2] > now:
+                reply_text, tokens, expires_at = row
+                self._remember(key, expires_at, reply_text, tokens)
+                self.stats["hits"] += 1
+                self.stats["disk_hits"] += 1
+                self.stats["saved_tokens"] += tokens
+                return reply_text
 
-        formatted_reply = (
-            f"{main_text}\n\n"
-            f"<b>📝 Совет:</b> <i>{advice_block}</i>"
+        self.stats["misses"] += 1
+        return None
+
+    async def put(self, key: str, style_name: str, prompt: str,
+                  reply_text: str, tokens: int) -> None:
+        """
+        Сохраняет интерпретацию в оба уровня кэша.
+        """
+        expires_at = time.time() + self.ttl
+        self._remember(key, expires_at, reply_text, tokens)
+        if self._db is not None:
+            await asyncio.to_thread(
+                self._disk_put, key, style_name, prompt_version(prompt),
+                reply_text, tokens, expires_at
+            )
+
+    def describe(self) -> str:
+        """
+        Сводка счётчиков кэша для администратора.
+        """
+        total = self.stats["hits"] + self.stats["misses"]
+        hit_rate = self.stats["hits"] / total * 100 if total else 0.0
+        return (
+            f"🗄 Кэш интерпретаций:\n"
+            f"Записей в памяти: {len(self._memory)} / {self.max_entries}\n"
+            f"Попаданий: {self.stats['hits']} "
+            f"(память: {self.stats['memory_hits']}, диск: {self.stats['disk_hits']})\n"
+            f"Промахов: {self.stats['misses']} (hit rate {hit_rate:.1f}%)\n"
+            f"Вытеснено: {self.stats['evictions']}, истекло: {self.stats['expired']}\n"
+            f"Сэкономлено токенов: {self.stats['saved_tokens']}"
         )
-        await update.message.reply_html(formatted_reply)
-    else:
-        await update.message.reply_text(reply_text)
 
 
 # ─────────────────────────────────────────────────────────────────────────────
-#               Функции для случайных заглушек и мониторинга ошибок
+#               Склейка одинаковых одновременных запросов (single-flight)
 # ─────────────────────────────────────────────────────────────────────────────
 
-# Список поэтичных заглушек
-fallback_replies = [
-    "🌙 Сегодня Интуи немного задумалась... Попробуй рассказать этот сон чуть позже.",
-    "✨ Иногда даже сны ускользают... Попробуй ещё раз — Интуи услышит.",
-    "💤 Интуи на мгновение ушла вглубь себя. Возвращайся через пару минут.",
-    "🔮 Сейчас Интуи на границе миров. Она скоро снова будет с тобой.",
-    "🌌 Сегодня сны запутались в облаках. Завтра всё прояснится."
-]
-
-# Очередь временных меток ошибок за последние 10 минут
-error_log = deque()
-
-def get_random_fallback() -> str:
+class CoalescedError(Exception):
     """
-    Возвращает случайную поэтичную заглушку из списка.
+    Ошибка ведущего запроса, полученная ожидающим. Алерт по ней уже отправлен
+    ведущим, поэтому ожидающие только логируют её и отвечают заглушкой.
     """
-    return random.choice(fallback_replies)
 
-def handle_error(error_message: str) -> None:
+
+class SingleFlight:
     """
-    Логирует ошибку, отправляет email и уведомление админу.
-    При >=3 ошибках за 10 минут шлёт тревожное письмо.
+    Первый запрос по ключу выполняет работу, остальные с тем же ключом
+    ждут тот же future и получают тот же результат (или ту же ошибку).
     """
-    now = time.time()
-    error_log.append(now)
 
-    while error_log and now - error_log[0] > 600:
-        error_log.popleft()
+    def __init__(self) -> None:
+        self._inflight = {}
+        self.stats = {"leaders": 0, "followers": 0}
 
-    logging.error(error_message)
-    send_error_email(subject="Intui Bot Error", body=error_message)
+    async def do(self, key: str, factory):
+        """
+        Возвращает (результат, shared), где shared=True — результат получен
+        от чужого запроса. Ошибки ведущего ожидающие получают как CoalescedError.
+        """
+        future = self._inflight.get(key)
+        if future is not None:
+            self.stats["followers"] += 1
+            try:
+                return await asyncio.shield(future), True
+            except Exception as e:
+                raise CoalescedError(str(e)) from e
 
-    if len(error_log) >= 3:
-        alert_body = (
-            f"Зафиксировано {len(error_log)} ошибок за последние 10 минут.\n"
-            f"Последняя ошибка:\n{error_message}"
-        )
-        send_error_email(subject="⚠️ Множественные сбои Intui", body=alert_body)
+        self.stats["leaders"] += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await factory()
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                future.set_exception(RuntimeError("ведущий запрос отменён"))
+            else:
+                future.set_exception(e)
+            future.exception()   # Помечаем как прочитанную, даже если ожидающих нет
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            del self._inflight[key]
 
 
 # ─────────────────────────────────────────────────────────────────────────────
-#                                  Запуск бота
+#                  Постоянное хранилище пользователей (SQLite)
 # ─────────────────────────────────────────────────────────────────────────────
 
-if __name__ == "__main__":
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+class SQLitePersistence(BasePersistence):
+    """
+    Persistence для PTB на SQLite (WAL):
+     - user_data подгружается лениво, при первом апдейте пользователя,
+       а не целиком при старте;
+     - записи копятся в памяти и сбрасываются пачкой раз в flush_interval
+       и при остановке;
+     - история снов хранится строками таблицы history (сотни снов на
+       пользователя), в user_data остаются только последние записи.
+    """
 
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("style", style_cmd))
-    application.add_handler(CommandHandler("history", history_cmd))
-    application.add_handler(CallbackQueryHandler(button_handler))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    def __init__(self, path: str, flush_interval: float) -> None:
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+            update_interval=flush_interval
+        )
+        self.path = path
+        self.flush_interval = flush_interval
+        self._db = None
+        self._db_lock = threading.Lock()
+        self._loaded = set()           # Пользователи, чьи данные уже в памяти
+        self._pending_users = {}       # user_id -> JSON user_data (None — удалить)
+        self._pending_dreams = []      # (user_id, dream, reply, style, created_at)
+        self._indexed = set()          # Пользователи, чей архив уже сверен с индексом
+        self._flush_task = None
 
-    application.run_webhook(
-        listen="0.0.0.0",
-        port=int(os.environ.get("PORT", 10000)),
-        webhook_url=WEBHOOK_URL
-    )
+    # ── Соединение ──────────────────────────────────────────────────────────
+
+    def _connect(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            columns = [row[1] for row in self._db.execute("PRAGMA table_info(search_docs)")]
+            if columns and "terms" not in columns:
+                # Индекс без сохранённых термов: удаляем, _ensure_indexed построит его заново
+                self._db.executescript(
+                    "DROP TABLE IF EXISTS search_postings; DROP TABLE IF EXISTS search_terms;"
+                    "DROP TABLE IF EXISTS search_docs; DROP TABLE IF EXISTS search_totals;"
+                )
+            self._db.executescript(
+                "CREATE TABLE IF NOT EXISTS users ("
+                " user_id INTEGER PRIMARY KEY, data TEXT NOT NULL);"
+                "CREATE TABLE IF NOT EXISTS history ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL,"
+                " dream TEXT NOT NULL, reply TEXT NOT NULL, style TEXT NOT NULL,"
+                " created_at REAL NOT NULL);"
+                "CREATE INDEX IF NOT EXISTS history_user_id ON history (user_id, id);"
+                # Инвертированный индекс для /search и /symbols
+                "CREATE TABLE IF NOT EXISTS search_postings ("
+                " user_id INTEGER NOT NULL, term TEXT NOT NULL, dream_id INTEGER NOT NULL,"
+                " tf INTEGER NOT NULL, length INTEGER NOT NULL,"
+                " PRIMARY KEY (user_id, term, dream_id)) WITHOUT ROWID;"
+                "CREATE TABLE IF NOT EXISTS search_terms ("
+                " user_id INTEGER NOT NULL, term TEXT NOT NULL, docs INTEGER NOT NULL,"
+                " dream_docs INTEGER NOT NULL, sample TEXT NOT NULL,"
+                " PRIMARY KEY (user_id, term)) WITHOUT ROWID;"
+                # terms — термы, с которыми сон попал в индекс (JSON): по ним он
+                # и удаляется, даже если стеммер с тех пор сменился
+                "CREATE TABLE IF NOT EXISTS search_docs ("
+                " dream_id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, length INTEGER NOT NULL,"
+                " terms TEXT NOT NULL);"
+                "CREATE TABLE IF NOT EXISTS search_totals ("
+                " user_id INTEGER PRIMARY KEY, docs INTEGER NOT NULL, total_length INTEGER NOT NULL);"
+            )
+        return self._db
+
+    def _execute(self, sql: str, params=()):
+        with self._db_lock:
+            return self._connect().execute(sql, params).fetchall()
+
+    def close(self) -> None:
+        with self._db_lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    # ── Пакетная запись ─────────────────────────────────────────────────────
+
+    def _schedule_flush(self) -> None:
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self) -> None:
+        await asyncio.sleep(self.flush_interval)
+        await self._write_pending()
+
+    def _write(self, users: dict, dreams: list) -> None:
+        with self._db_lock:
+            db = self._connect()
+            with db:
+                for user_id, data in users.items():
+                    if data is None:
+                        db.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+                        unindex_user(db, user_id)
+                        db.execute("DELETE FROM history WHERE user_id = ?", (user_id,))
+                    else:
+                        db.execute(
+                            "INSERT INTO users (user_id, data) VALUES (?, ?) "
+                            "ON CONFLICT (user_id) DO UPDATE SET data = excluded.data",
+                            (user_id, data)
+                        )
+                for row in dreams:
+                    dream_id = db.execute(
+                        "INSERT INTO history (user_id, dream, reply, style, created_at) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        row
+                    ).lastrowid
+                    # Индекс поиска обновляется в той же транзакции, что и история
+                    index_dream(db, row[0], dream_id, row[1], row[2])
+                # Ограничиваем архив каждого пользователя MAX_STORED_HISTORY снами
+                for user_id in {row[0] for row in dreams}:
+                    stale = db.execute(
+                        "SELECT id FROM history WHERE user_id = ? AND id <= ("
+                        " SELECT id FROM history WHERE user_id = ?"
+                        " ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                        (user_id, user_id, MAX_STORED_HISTORY)
+                    ).fetchall()
+                    for (dream_id,) in stale:
+                        unindex_dream(db, user_id, dream_id)
+                    if stale:
+                        db.execute(
+                            "DELETE FROM history WHERE user_id = ? AND id <= ?",
+                            (user_id, max(row[0] for row in stale))
+                        )
+
+    async def _write_pending(self) -> None:
+        users, self._pending_users = self._pending_users, {}
+        dreams, self._pending_dreams = self._pending_dreams, []
+        if not users and not dreams:
+            return
+        try:
+            await asyncio.to_thread(self._write, users, dreams)
+        except Exception as e:
+            # Не теряем пачку: возвращаем её в очередь и пробуем позже
+            logging.error(f"Не удалось записать данные пользователей в SQLite: {e}")
+            for user_id, data in users.items():
+                self._pending_users.setdefault(user_id, data)
+            self._pending_dreams[:0] = dreams
+            self._schedule_flush()
+
+    # ── История снов ────────────────────────────────────────────────────────
+
+    def add_dream(self, user_id: int, dream: str, reply: str, style_name: str) -> None:
+        """
+        Ставит сон в очередь на запись в историю (сбрасывается пачкой).
+        """
+        self._pending_dreams.append((user_id, dream, reply, style_name, time.time()))
+        self._schedule_flush()
+
+    async def history_page(self, user_id: int, cursor: Optional[tuple] = None,
+                           limit: int = 5):
+        """
+        Страница истории с keyset-пагинацией по id.
+        cursor: None — самые свежие; ("older", id) или ("newer", id).
+        Возвращает (строки от новых к старым, есть_новее, есть_старее).
+        """
+        if any(row[0] == user_id for row in self._pending_dreams):
+            await self._write_pending()   # Свежие сны должны попасть в выдачу
+
+        columns = "SELECT id, dream, reply, style, created_at FROM history WHERE user_id = ?"
+        if cursor is None:
+            rows = await asyncio.to_thread(
+                self._execute, f"{columns} ORDER BY id DESC LIMIT ?", (user_id, limit + 1)
+            )
+            has_newer = False
+            has_older = len(rows) > limit
+            rows = rows[:limit]
+        elif cursor[0] == "older":
+            rows = await asyncio.to_thread(
+                self._execute, f"{columns} AND id < ? ORDER BY id DESC LIMIT ?",
+                (user_id, cursor[1], limit + 1)
+            )
+            has_newer = True
+            has_older = len(rows) > limit
+            rows = rows[:limit]
+        else:
+            rows = await asyncio.to_thread(
+                self._execute, f"{columns} AND id > ? ORDER BY id ASC LIMIT ?",
+                (user_id, cursor[1], limit + 1)
+            )
+            has_older = True
+            has_newer = len(rows) > limit
+            rows = list(reversed(rows[:limit]))
+        return rows, has_newer, has_older
+
+    # ── Поиск по архиву ─────────────────────────────────────────────────────
+
+    def _ensure_indexed(self, db, user_id: int) -> None:
+        """
+        Один раз за жизнь процесса доиндексирует сны пользователя, сохранённые
+        до появления индекса. Дальше индекс обновляется только в _write.
+        """
+        if user_id in self._indexed:
+            return
+        missing = db.execute(
+            "SELECT h.id, h.dream, h.reply FROM history h"
+            " LEFT JOIN search_docs d ON d.dream_id = h.id"
+            " WHERE h.user_id = ? AND d.dream_id IS NULL",
+            (user_id,)
+        ).fetchall()
+        if missing:
+            with db:
+                for dream_id, dream, reply in missing:
+                    index_dream(db, user_id, dream_id, dream, reply)
+        self._indexed.add(user_id)
+
+    def _search(self, user_id: int, terms: list, offset: int, limit: int):
+        with self._db_lock:
+            db = self._connect()
+            self._ensure_indexed(db, user_id)
+            totals = db.execute(
+                "SELECT docs, total_length FROM search_totals WHERE user_id = ?", (user_id,)
+            ).fetchone()
+            if not totals or not totals[0]:
+                return [], 0
+            docs, avg_length = totals[0], totals[1] / totals[0]
+
+            # BM25: каждое слово запроса — один проход по его списку вхождений
+            scores = {}
+            for term in terms:
+                row = db.execute(
+                    "SELECT docs FROM search_terms WHERE user_id = ? AND term = ?", (user_id, term)
+                ).fetchone()
+                if row is None:
+                    continue
+                idf = math.log(1 + (docs - row[0] + 0.5) / (row[0] + 0.5))
+                for dream_id, tf, length in db.execute(
+                    "SELECT dream_id, tf, length FROM search_postings WHERE user_id = ? AND term = ?",
+                    (user_id, term)
+                ):
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length)
+                    scores[dream_id] = scores.get(dream_id, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+
+            # При равном счёте выше более свежий сон
+            ranked = heapq.nlargest(offset + limit, scores.items(), key=lambda item: (item[1], item[0]))
+            page = [dream_id for dream_id, _ in ranked[offset:offset + limit]]
+            if not page:
+                return [], len(scores)
+            rows = db.execute(
+                "SELECT id, dream, reply, style, created_at FROM history"
+                f" WHERE id IN ({','.join('?' * len(page))})",
+                page
+            ).fetchall()
+        by_id = {row[0]: row for row in rows}
+        return [by_id[dream_id] for dream_id in page if dream_id in by_id], len(scores)
+
+    async def search(self, user_id: int, query: str, offset: int = 0, limit: int = 5):
+        """
+        Поиск по снам и толкованиям пользователя с ранжированием BM25.
+        Возвращает (строки страницы в порядке релевантности, всего найдено).
+        """
+        terms = list(dict.fromkeys(stem for stem, _ in tokenize(query)))
+        if not terms:
+            return [], 0
+        if any(row[0] == user_id for row in self._pending_dreams):
+            await self._write_pending()   # Свежие сны должны попасть в выдачу
+        return await asyncio.to_thread(self._search, user_id, terms, offset, limit)
+
+    def _symbols(self, user_id: int, limit: int):
+        with self._db_lock:
+            db = self._connect()
+            self._ensure_indexed(db, user_id)
+            totals = db.execute("SELECT docs FROM search_totals WHERE user_id = ?", (user_id,)).fetchone()
+            rows = db.execute(
+                "SELECT sample, dream_docs FROM search_terms"
+                " WHERE user_id = ? AND dream_docs >= ? ORDER BY dream_docs DESC, term LIMIT ?",
+                (user_id, SYMBOLS_MIN_DREAMS, limit)
+            ).fetchall()
+        return rows, totals[0] if totals else 0
+
+    async def symbols(self, user_id: int, limit: int = 15):
+        """
+        Самые частые образы из текстов снов пользователя (по счётчикам индекса).
+        Возвращает ([(слово, в скольких снах)], всего снов).
+        """
+        if any(row[0] == user_id for row in self._pending_dreams):
+            await self._write_pending()
+        return await asyncio.to_thread(self._symbols, user_id, limit)
+
+    # ── Интерфейс BasePersistence ───────────────────────────────────────────
+
+    async def get_user_data(self) -> dict:
+        # Ничего не читаем при старте — данные подгружаются в refresh_user_data
+        return {}
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        if user_id in self._loaded:
+            return
+        rows = await asyncio.to_thread(
+            self._execute, "SELECT data FROM users WHERE user_id = ?", (user_id,)
+        )
+        recent = await asyncio.to_thread(
+            self._execute,
+            "SELECT dream, reply, style FROM history WHERE user_id = ? ORDER BY id DESC LIMIT ?",
+            (user_id, MAX_HISTORY_ENTRIES)
+        )
+        if user_id in self._loaded:
+            return
+        self._loaded.add(user_id)
+        if rows:
+            for key, value in json.loads(rows[0][0]).items():
+                user_data.setdefault(key, value)
+        user_data.setdefault("history", [tuple(row) for row in reversed(recent)])
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        stored = {key: value for key, value in data.items() if key != "history"}
+        self._pending_users[user_id] = json.dumps(stored, ensure_ascii=False)
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._pending_users[user_id] = None
+        self._pending_dreams = [row for row in self._pending_dreams if row[0] != user_id]
+        self._loaded.discard(user_id)
+        self._indexed.discard(user_id)
+        self._schedule_flush()
+
+    async def flush(self) -> None:
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+        await self._write_pending()
+
+    # Чаты, bot_data, callback_data и диалоги не храним
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_conversation(self, name: str, key: tuple, new_state) -> None:
+        pass
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+
+def save_dream(context: ContextTypes.DEFAULT_TYPE, user_id: int,
+               dream: str, reply: str, style_name: str) -> None:
+    """
+    Добавляет сон в историю: последние записи — в user_data,
+    полный архив — строкой в SQLite.
+    """
+    history = context.user_data.setdefault("history", [])
+    history.append((dream, reply, style_name))
+    if len(history) > MAX_HISTORY_ENTRIES:
+        history.pop(0)
+    context.application.persistence.add_dream(user_id, dream, reply, style_name)
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+#              Поиск по архиву снов: нормализация и инвертированный индекс
+# ─────────────────────────────────────────────────────────────────────────────
+
+WORD_RE = re.compile(r"[а-яa-z0-9]+")
+
+STOP_WORDS = frozenset("""
+    и в во не что он на я с со как а то все она так его но да ты к у же вы за бы по только ее мне
+    было вот от меня еще нет о из ему теперь когда даже ну вдруг ли если уже или ни быть был него до
+    вас нибудь опять уж вам ведь там потом себя ничего ей может они тут где есть надо ней для мы тебя
+    их чем была сам чтоб без будто чего раз тоже себе под будет ж тогда кто этот того потому этого
+    какой совсем ним здесь этом один почти мой тем чтобы нее сейчас были куда зачем всех никогда можно
+    при наконец два об другой хоть после над больше тот через эти нас про всего них какая много разве
+    три эту моя впрочем хорошо свою этой перед иногда лучше чуть том нельзя такой им более всегда
+    конечно всю между это твой твоя твое мое очень просто который которая которые было были
+""".split())
+
+# Слова, которые есть почти в каждом сне и толковании, — не образы
+DREAM_STOP_WORDS = ("сон", "сны", "снов", "сне", "снилось", "приснилось", "снится", "снился",
+                    "снилась", "снились", "совет")
+
+# Окончания для упрощённого стемминга, от длинных к коротким
+RUSSIAN_ENDINGS = sorted("""
+    ившись ывшись иями ями ами ией ого его ому ему ыми ими ешь ишь ете ите ила ыла ена ено ены ился
+    илась илось ились ться тся ей ой ий ый ая яя ое ее ую юю ах ях ам ям ом ем ов ев ью ия ие ии ию
+    ет ит ут ют ат ят ла ло ли ть а я о е ы и у ю ь л
+""".split(), key=len, reverse=True)
+
+_stemmers = threading.local()   # Стеммер snowball не потокобезопасен
+
+
+@functools.lru_cache(maxsize=100_000)
+def stem_word(word: str) -> str:
+    """
+    Основа слова: snowball (если установлен) или отсечение типичного окончания.
+    """
+    if snowballstemmer is not None:
+        stemmer = getattr(_stemmers, "russian", None)
+        if stemmer is None:
+            stemmer = _stemmers.russian = snowballstemmer.stemmer("russian")
+        return stemmer.stemWord(word)
+    for ending in RUSSIAN_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= 3:
+            return word[:-len(ending)]
+    return word
+
+
+STOP_STEMS = frozenset(stem_word(word) for word in DREAM_STOP_WORDS)
+
+
+def tokenize(text: str) -> list:
+    """
+    Слова текста как пары (основа, словоформа) без стоп-слов и чисел.
+    """
+    tokens = []
+    for word in WORD_RE.findall(text.lower().replace("ё", "е")):
+        if len(word) < 2 or word in STOP_WORDS or word.isdigit():
+            continue
+        stem = stem_word(word)
+        if stem not in STOP_STEMS:
+            tokens.append((stem, word))
+    return tokens
+
+
+def document_terms(dream: str, reply: str) -> tuple:
+    """
+    Термы сна для индекса: {основа: [вес, встречается_в_сне, словоформа]}
+    и длина документа (с тем же весом для текста сна).
+    """
+    terms = {}
+    dream_tokens = tokenize(dream)
+    reply_tokens = tokenize(reply)
+    for stem, word in dream_tokens:
+        entry = terms.setdefault(stem, [0, 1, word])
+        entry[0] += SEARCH_DREAM_WEIGHT
+    for stem, word in reply_tokens:
+        entry = terms.setdefault(stem, [0, 0, word])
+        entry[0] += 1
+    return terms, SEARCH_DREAM_WEIGHT * len(dream_tokens) + len(reply_tokens)
+
+
+def index_dream(db, user_id: int, dream_id: int, dream: str, reply: str) -> None:
+    """
+    Добавляет сон в индекс (внутри транзакции записи истории).
+    """
+    terms, length = document_terms(dream, reply)
+    # Длина документа хранится в каждом вхождении, чтобы ранжирование обходилось без JOIN
+    db.executemany(
+        "INSERT OR IGNORE INTO search_postings (user_id, term, dream_id, tf, length) VALUES (?, ?, ?, ?, ?)",
+        [(user_id, term, dream_id, tf, length) for term, (tf, _, _) in terms.items()]
+    )
+    db.executemany(
+        "INSERT INTO search_terms (user_id, term, docs, dream_docs, sample) VALUES (?, ?, 1, ?, ?) "
+        "ON CONFLICT (user_id, term) DO UPDATE SET docs = docs + 1,"
+        " dream_docs = dream_docs + excluded.dream_docs,"
+        # Для /symbols показываем словоформу из текста сна, а не из толкования
+        " sample = CASE WHEN dream_docs = 0 AND excluded.dream_docs = 1 THEN excluded.sample ELSE sample END",
+        [(user_id, term, in_dream, word) for term, (_, in_dream, word) in terms.items()]
+    )
+    db.execute(
+        "INSERT INTO search_docs (dream_id, user_id, length, terms) VALUES (?, ?, ?, ?)",
+        (dream_id, user_id, length,
+         json.dumps([[term, in_dream] for term, (_, in_dream, _) in terms.items()], ensure_ascii=False))
+    )
+    db.execute(
+        "INSERT INTO search_totals (user_id, docs, total_length) VALUES (?, 1, ?) "
+        "ON CONFLICT (user_id) DO UPDATE SET docs = docs + 1, total_length = total_length + excluded.total_length",
+        (user_id, length)
+    )
+
+
+def unindex_dream(db, user_id: int, dream_id: int) -> None:
+    """
+    Убирает сон из индекса. Термы берём сохранённые при индексации, а не
+    разбором текста заново: другой стеммер (snowball установили или убрали)
+    дал бы другие основы, и счётчики разошлись бы с вхождениями. Удаление
+    идёт по первичному ключу без дополнительных индексов.
+    """
+    row = db.execute("SELECT length, terms FROM search_docs WHERE dream_id = ?", (dream_id,)).fetchone()
+    if row is None:
+        return   # Сон не был проиндексирован
+    length, terms = row[0], json.loads(row[1])
+    db.execute("DELETE FROM search_docs WHERE dream_id = ?", (dream_id,))
+    db.executemany(
+        "DELETE FROM search_postings WHERE user_id = ? AND term = ? AND dream_id = ?",
+        [(user_id, term, dream_id) for term, _ in terms]
+    )
+    db.executemany(
+        "UPDATE search_terms SET docs = docs - 1, dream_docs = dream_docs - ? WHERE user_id = ? AND term = ?",
+        [(in_dream, user_id, term) for term, in_dream in terms]
+    )
+    db.executemany(
+        "DELETE FROM search_terms WHERE user_id = ? AND term = ? AND docs <= 0",
+        [(user_id, term) for term, _ in terms]
+    )
+    db.execute(
+        "UPDATE search_totals SET docs = docs - 1, total_length = total_length - ? WHERE user_id = ?",
+        (length, user_id)
+    )
+
+
+def unindex_user(db, user_id: int) -> None:
+    """
+    Удаляет весь индекс пользователя (вызывать до удаления его истории).
+    """
+    db.execute("DELETE FROM search_docs WHERE dream_id IN (SELECT id FROM history WHERE user_id = ?)", (user_id,))
+    db.execute("DELETE FROM search_postings WHERE user_id = ?", (user_id,))
+    db.execute("DELETE FROM search_terms WHERE user_id = ?", (user_id,))
+    db.execute("DELETE FROM search_totals WHERE user_id = ?", (user_id,))
+
+
+def highlight(text: str, stems: set, width: int = 90) -> str:
+    """
+    Фрагмент текста (HTML) вокруг первого найденного слова, найденные слова — жирным.
+    """
+    lowered = text.lower().replace("ё", "е")
+    matches = [m for m in WORD_RE.finditer(lowered) if stem_word(m.group()) in stems]
+    start = max(0, matches[0].start() - width // 3) if matches else 0
+    end = min(len(text), start + width)
+    parts = ["…" if start else ""]
+    position = start
+    for match in matches:
+        if match.start() < start or match.end() > end:
+            continue
+        parts.append(html.escape(text[position:match.start()]))
+        parts.append(f"<b>{html.escape(text[match.start():match.end()])}</b>")
+        position = match.end()
+    parts.append(html.escape(text[position:end]))
+    parts.append("…" if end < len(text) else "")
+    return "".join(parts)
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+#                           Команда /start
+# ─────────────────────────────────────────────────────────────────────────────
+
+@instrumented("start")
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Приветственное сообщение с кнопками:
+     - 🌙 Рассказать сон
+     - 🎭 Выбрать стиль
+     - 📜 История снов
+    Инициализирует user_data, не затирая сохранённые стиль и историю.
+    """
+    context.user_data.setdefault("style", DEFAULT_STYLE)
+    context.user_data.setdefault("history", [])
+
+    keyboard = [
+        [InlineKeyboardButton("🌙 Рассказать сон", callback_data="write_dream")],
+        [InlineKeyboardButton("🎭 Выбрать стиль", callback_data="choose_style")],
+        [InlineKeyboardButton("📜 История снов", callback_data="show_history")]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    user = update.effective_user
+    await update.message.reply_html(
+        f"""Приветствую тебя, {user.mention_html()}! ✨
+Я — Интуи, твоя проводница по миру снов.
+У меня есть несколько вариантов стиля интерпретации сна.
+Ты сможешь выбрать удобный стиль или сразу рассказать сон.
+Что хочешь сделать?""",
+        reply_markup=reply_markup
+    )
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+#                         Обработчик кнопок CallbackQuery
+# ─────────────────────────────────────────────────────────────────────────────
+
+@instrumented("button_handler")
+async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Обрабатывает нажатия Inline-кнопок:
+     - write_dream      → просит пользователя написать сон
+     - choose_style     → предлагает меню выбора стиля
+     - show_history     → показывает последние сны (с листанием)
+     - history_older_<id>/history_newer_<id> → страницы истории
+     - search_<страница> → страницы результатов /search
+     - style_<имя>      → устанавливает выбран стиль
+    """
+    query = update.callback_query
+    await query.answer()
+
+    data = query.data
+
+    if data == "write_dream":
+        await query.edit_message_text("📝 Напиши мне, что тебе приснилось...")
+        return
+
+    if data == "choose_style":
+        keyboard = [
+            [InlineKeyboardButton(style_name, callback_data=f"style_{style_name}")]
+            for style_name in STYLE_PROMPTS.keys()
+        ]
+        await query.edit_message_text(
+            "🎭 Выбери стиль интерпретации:",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+        return
+
+    if data == "show_history" or data.startswith("history_"):
+        # history_older_<id> / history_newer_<id> — листание архива
+        cursor = None
+        if data != "show_history":
+            _, direction, dream_id = data.split("_")
+            cursor = (direction, int(dream_id))
+        text, reply_markup = await render_history(update.effective_user.id, context, cursor)
+        await query.edit_message_text(text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+        return
+
+    if data.startswith("search_"):
+        search_query = context.user_data.get("search_query")
+        if not search_query:
+            await query.edit_message_text("🔎 Поиск устарел — повтори /search.")
+            return
+        text, reply_markup = await render_search(
+            update.effective_user.id, context, search_query, int(data.split("_")[1])
+        )
+        await query.edit_message_text(text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+        return
+
+    if data.startswith("style_"):
+        selected_style = data.replace("style_", "")
+        context.user_data["style"] = selected_style
+        await query.edit_message_text(
+            f"✅ Стиль интерпретации установлен: *{selected_style}*. Теперь опиши свой сон.",
+            parse_mode="Markdown"
+        )
+        return
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+#                       Команда /style (альтернативный вызов)
+# ─────────────────────────────────────────────────────────────────────────────
+
+@instrumented("style_cmd")
+async def style_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    При вызове /style выводит меню выбора стилей.
+    """
+    keyboard = [
+        [InlineKeyboardButton(style_name, callback_data=f"style_{style_name}")]
+        for style_name in STYLE_PROMPTS.keys()
+    ]
+    await update.message.reply_text(
+        "🎭 Выбери стиль интерпретации:",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+#                    Команда /history (альтернативный вызов)
+# ─────────────────────────────────────────────────────────────────────────────
+
+@instrumented("history_cmd")
+async def history_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    При вызове /history выводит последние сны с кнопками листания.
+    """
+    text, reply_markup = await render_history(update.effective_user.id, context)
+    await update.message.reply_html(text, reply_markup=reply_markup)
+
+
+async def render_history(user_id: int, context: ContextTypes.DEFAULT_TYPE,
+                         cursor: Optional[tuple] = None):
+    """
+    Готовит страницу истории снов: текст и кнопки «Раньше»/«Позже».
+    """
+    rows, has_newer, has_older = await context.application.persistence.history_page(
+        user_id, cursor, HISTORY_PAGE_SIZE
+    )
+    if not rows:
+        return "📜 История пока пуста.", None
+
+    text = "📜 Последние сны:\n\n" if cursor is None else "📜 Архив снов:\n\n"
+    for _, dream_text, _, style_name, created_at in rows:
+        snippet = dream_text if len(dream_text) <= 40 else dream_text[:40] + "..."
+        date = time.strftime("%d.%m.%Y", time.localtime(created_at))
+        # Текст сна — пользовательский: экранируем, иначе разметка в нём ломает всю страницу
+        text += f"🗓 {date} 💤 <b>{html.escape(snippet)}</b> — <i>{html.escape(style_name)}</i>\n"
+
+    buttons = []
+    if has_older:
+        buttons.append(InlineKeyboardButton("⬅️ Раньше", callback_data=f"history_older_{rows[-1][0]}"))
+    if has_newer:
+        buttons.append(InlineKeyboardButton("Позже ➡️", callback_data=f"history_newer_{rows[0][0]}"))
+    return text, InlineKeyboardMarkup([buttons]) if buttons else None
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+#                   Команды /search и /symbols (поиск по архиву)
+# ─────────────────────────────────────────────────────────────────────────────
+
+@instrumented("search_cmd")
+async def search_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    /search <слова> — ищет по архиву снов и толкований, самые подходящие сверху.
+    """
+    search_query = " ".join(context.args or []).strip()
+    if not search_query:
+        await update.message.reply_text("🔎 Напиши, что искать, например: /search вода")
+        return
+    # Запрос нужен кнопкам листания: в callback_data он не поместится
+    context.user_data["search_query"] = search_query
+    text, reply_markup = await render_search(update.effective_user.id, context, search_query, 0)
+    await update.message.reply_html(text, reply_markup=reply_markup)
+
+
+async def render_search(user_id: int, context: ContextTypes.DEFAULT_TYPE,
+                        search_query: str, page: int):
+    """
+    Готовит страницу результатов поиска: текст (HTML) и кнопки листания.
+    """
+    rows, total = await context.application.persistence.search(
+        user_id, search_query, page * SEARCH_PAGE_SIZE, SEARCH_PAGE_SIZE
+    )
+    if not rows:
+        return f"🔎 По запросу «{html.escape(search_query)}» ничего не нашлось.", None
+
+    stems = {stem for stem, _ in tokenize(search_query)}
+    text = f"🔎 «{html.escape(search_query)}» — найдено снов: {total}\n\n"
+    for _, dream_text, reply_text, style_name, created_at in rows:
+        date = time.strftime("%d.%m.%Y", time.localtime(created_at))
+        text += f"🗓 {date} — <i>{html.escape(style_name)}</i>\n💤 {highlight(dream_text, stems)}\n"
+        if not any(stem_word(word) in stems for word in WORD_RE.findall(dream_text.lower().replace("ё", "е"))):
+            # Совпало только толкование — показываем его фрагмент
+            text += f"✨ {highlight(reply_text, stems)}\n"
+        text += "\n"
+
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"search_{page - 1}"))
+    if (page + 1) * SEARCH_PAGE_SIZE < total:
+        buttons.append(InlineKeyboardButton("Ещё ➡️", callback_data=f"search_{page + 1}"))
+    return text, InlineKeyboardMarkup([buttons]) if buttons else None
+
+
+@instrumented("symbols_cmd")
+async def symbols_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    /symbols — повторяющиеся образы снов пользователя (по счётчикам индекса поиска).
+    """
+    rows, total = await context.application.persistence.symbols(update.effective_user.id, SYMBOLS_LIMIT)
+    if not rows:
+        await update.message.reply_text("🔮 Повторяющихся образов пока нет — расскажи мне ещё несколько снов.")
+        return
+    text = f"🔮 Повторяющиеся образы (всего снов: {total}):\n\n"
+    for word, dreams in rows:
+        text += f"• <b>{html.escape(word)}</b> — в {dreams} снах\n"
+    text += "\nНайти сны с образом: /search <i>слово</i>"
+    await update.message.reply_html(text)
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+#                     Команда /cache (только для администратора)
+# ─────────────────────────────────────────────────────────────────────────────
+
+@instrumented("cache_cmd")
+async def cache_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Показывает администратору счётчики кэша: попадания, промахи,
+    вытеснения и сэкономленные токены.
+    """
+    if update.effective_user.id != ADMIN_TELEGRAM_ID:
+        return
+    await update.message.reply_text(context.bot_data["cache"].describe())
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+#                     Команда /usage (только для администратора)
+# ─────────────────────────────────────────────────────────────────────────────
+
+@instrumented("usage_cmd")
+async def usage_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Показывает администратору расход токенов за день и месяц, топ
+    пользователей и экономию кэша — вместо сообщений на каждый сон.
+    """
+    if update.effective_user.id != ADMIN_TELEGRAM_ID:
+        return
+    text = await context.bot_data["ledger"].describe()
+    saved = context.bot_data["cache"].stats["saved_tokens"]
+    await update.message.reply_text(f"{text}\nСэкономлено кэшем: {saved}")
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+#                     Команда /queue (только для администратора)
+# ─────────────────────────────────────────────────────────────────────────────
+
+@instrumented("queue_cmd")
+async def queue_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Показывает администратору состояние планировщика запросов к OpenAI
+    и уровней моделей (выключатели, p95, победы).
+    """
+    if update.effective_user.id != ADMIN_TELEGRAM_ID:
+        return
+    await update.message.reply_text(
+        context.bot_data["scheduler"].describe() + "\n\n" + context.bot_data["backend"].describe()
+    )
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+#             Учёт токенов: оценка до запроса, обрезка, квоты, /usage
+# ─────────────────────────────────────────────────────────────────────────────
+
+_encoder = None
+
+def _get_encoder():
+    """
+    Офлайн-токенизатор tiktoken (если установлен и словарь доступен).
+    Первый вызов может скачивать словарь, поэтому он делается в post_init
+    в отдельном потоке, а обработчики получают уже загруженный.
+    """
+    global _encoder
+    if _encoder is None and tiktoken is not None:
+        try:
+            _encoder = tiktoken.get_encoding(TOKENIZER_ENCODING)
+        except Exception as e:
+            logging.warning(f"Токенизатор недоступен, оцениваем по символам: {e}")
+            _encoder = False
+    return _encoder or None
+
+
+def count_tokens(text: str) -> int:
+    """
+    Число токенов в тексте: точно через tiktoken, иначе — грубо по символам
+    (кириллица ≈ 2.5 символа на токен).
+    """
+    encoder = _get_encoder()
+    if encoder is not None:
+        return len(encoder.encode(text))
+    return int(len(text) / 2.5) + 1
+
+
+def count_message_tokens(messages: list) -> int:
+    """
+    Токены промпта chat-запроса (с учётом служебной разметки сообщений).
+    """
+    return sum(count_tokens(m["content"]) + 4 for m in messages) + 3
+
+
+def trim_to_tokens(text: str, limit: int):
+    """
+    Сокращает слишком длинный сон до limit токенов: оставляет начало
+    и конец (там обычно завязка и самое яркое), середину заменяет на «[…]».
+    Возвращает (текст, был_ли_сокращён).
+    """
+    encoder = _get_encoder()
+    if encoder is not None:
+        tokens = encoder.encode(text)
+        if len(tokens) <= limit:
+            return text, False
+        head = limit * 2 // 3
+        tail = limit - head
+        return encoder.decode(tokens[:head]) + " […] " + encoder.decode(tokens[-tail:]), True
+
+    if count_tokens(text) <= limit:
+        return text, False
+    chars = int(limit * 2.5)
+    head = chars * 2 // 3
+    tail = chars - head
+    return text[:head] + " […] " + text[-tail:], True
+
+
+def choose_max_tokens(style_name: str, input_tokens: int) -> int:
+    """
+    Длина ответа по стилю и длине сна: на короткий сон — короткое толкование,
+    к ADAPTIVE_FULL_INPUT_TOKENS токенам сна — полный лимит стиля.
+    """
+    ceiling = STYLE_MAX_TOKENS.get(style_name, 500)
+    share = min(1.0, input_tokens / ADAPTIVE_FULL_INPUT_TOKENS)
+    return max(MIN_COMPLETION_TOKENS, int(ceiling * (0.6 + 0.4 * share)))
+
+
+class QuotaExceededError(Exception):
+    """
+    Пользователь исчерпал дневную или месячную квоту токенов.
+    """
+
+    def __init__(self, period: str) -> None:
+        super().__init__(f"квота токенов исчерпана: {period}")
+        self.period = period
+
+
+class TokenLedger:
+    """
+    Счётчики токенов по пользователям:
+     - в памяти, с ленивой подгрузкой текущих дня и месяца из SQLite;
+     - приращения сбрасываются в SQLite раз в USAGE_FLUSH_INTERVAL и при остановке;
+     - квоты проверяются до запроса по оценке токенов.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._db = None
+        self._db_lock = threading.Lock()
+        self._usage = {}     # (user_id, period) -> токены
+        self._pending = {}   # (user_id, period) -> ещё не записанное приращение
+        self._loaded = set()
+        self._periods = None
+        self._flusher = None
+        self.totals = {"requests": 0, "prompt": 0, "completion": 0, "trimmed": 0, "rejected": 0,
+                       "followups": 0, "followup_prompt": 0, "followup_full_prompt": 0}
+        self.by_model = {}
+
+    @staticmethod
+    def periods() -> tuple:
+        now = time.localtime()
+        return time.strftime("d:%Y-%m-%d", now), time.strftime("m:%Y-%m", now)
+
+    # ── SQLite ──────────────────────────────────────────────────────────────
+
+    def _execute(self, sql: str, params=(), many: bool = False):
+        with self._db_lock:
+            if self._db is None:
+                self._db = sqlite3.connect(self.path, check_same_thread=False)
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS token_usage ("
+                    " user_id INTEGER NOT NULL, period TEXT NOT NULL,"
+                    " tokens INTEGER NOT NULL, PRIMARY KEY (user_id, period))"
+                )
+            with self._db:
+                if many:
+                    self._db.executemany(sql, params)
+                    return []
+                return self._db.execute(sql, params).fetchall()
+
+    def start(self) -> None:
+        self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(USAGE_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"Не удалось сохранить счётчики токенов: {e}")
+
+    async def flush(self) -> None:
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        await asyncio.to_thread(
+            self._execute,
+            "INSERT INTO token_usage (user_id, period, tokens) VALUES (?, ?, ?) "
+            "ON CONFLICT (user_id, period) DO UPDATE SET tokens = tokens + excluded.tokens",
+            [(user_id, period, tokens) for (user_id, period), tokens in pending.items()],
+            True
+        )
+
+    async def stop(self) -> None:
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        await self.flush()
+        with self._db_lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    # ── Квоты и учёт ────────────────────────────────────────────────────────
+
+    async def _load(self, user_id: int, periods: tuple) -> None:
+        key = (user_id, periods)
+        if key in self._loaded:
+            return
+        rows = await asyncio.to_thread(
+            self._execute,
+            "SELECT period, tokens FROM token_usage WHERE user_id = ? AND period IN (?, ?)",
+            (user_id, *periods)
+        )
+        if key in self._loaded:
+            return
+        self._loaded.add(key)
+        for period, tokens in rows:
+            # В памяти могут быть приращения, ещё не сброшенные на диск
+            self._usage[(user_id, period)] = tokens + self._pending.get((user_id, period), 0)
+
+    async def check(self, user_id: int, estimated: int) -> None:
+        """
+        Бросает QuotaExceededError, если запрос не помещается в квоту.
+        """
+        if user_id == ADMIN_TELEGRAM_ID:
+            return
+        day, month = self.periods()
+        if self._periods != (day, month):
+            # Начался новый день — старые счётчики в памяти больше не нужны
+            self._periods = (day, month)
+            self._usage = {key: value for key, value in self._usage.items() if key[1] in self._periods}
+            self._loaded.clear()
+        await self._load(user_id, (day, month))
+        for period, limit, name in ((day, DAILY_TOKEN_QUOTA, "день"),
+                                    (month, MONTHLY_TOKEN_QUOTA, "месяц")):
+            if limit and self._usage.get((user_id, period), 0) + estimated > limit:
+                self.totals["rejected"] += 1
+                raise QuotaExceededError(name)
+
+    def record(self, user_id: int, model: str, usage) -> None:
+        """
+        Учитывает фактический расход токенов запроса.
+        """
+        if usage is None:
+            return
+        self.totals["requests"] += 1
+        self.totals["prompt"] += usage.prompt_tokens
+        self.totals["completion"] += usage.completion_tokens
+        self.by_model[model] = self.by_model.get(model, 0) + usage.total_tokens
+        TOKENS.inc(usage.prompt_tokens, kind="prompt", model=model)
+        TOKENS.inc(usage.completion_tokens, kind="completion", model=model)
+        for period in self.periods():
+            key = (user_id, period)
+            self._usage[key] = self._usage.get(key, 0) + usage.total_tokens
+            self._pending[key] = self._pending.get(key, 0) + usage.total_tokens
+
+    async def describe(self) -> str:
+        """
+        Сводка расхода токенов для команды /usage.
+        """
+        await self.flush()
+        day, month = self.periods()
+        day_total = await asyncio.to_thread(
+            self._execute, "SELECT COALESCE(SUM(tokens), 0), COUNT(*) FROM token_usage WHERE period = ?", (day,)
+        )
+        month_total = await asyncio.to_thread(
+            self._execute, "SELECT COALESCE(SUM(tokens), 0) FROM token_usage WHERE period = ?", (month,)
+        )
+        top = await asyncio.to_thread(
+            self._execute,
+            "SELECT user_id, tokens FROM token_usage WHERE period = ? ORDER BY tokens DESC LIMIT 5",
+            (day,)
+        )
+        lines = [
+            "📊 Расход токенов:",
+            f"Сегодня: {day_total[0][0]} (пользователей: {day_total[0][1]})",
+            f"За месяц: {month_total[0][0]}",
+            f"С запуска: запросов {self.totals['requests']}, prompt {self.totals['prompt']}, "
+            f"completion {self.totals['completion']}",
+            f"Сокращено длинных снов: {self.totals['trimmed']}, отказов по квоте: {self.totals['rejected']}",
+            f"Уточняющих вопросов: {self.totals['followups']}, промпт {self.totals['followup_prompt']} "
+            f"(с полным контекстом было бы {self.totals['followup_full_prompt']})",
+        ]
+        if self.by_model:
+            lines.append("По моделям: " + ", ".join(f"{m} {t}" for m, t in self.by_model.items()))
+        if top:
+            lines.append("Топ за сегодня: " + ", ".join(f"{u}: {t}" for u, t in top))
+        return "\n".join(lines)
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+#            Планировщик запросов к OpenAI: лимиты, очередь, повторы
+# ─────────────────────────────────────────────────────────────────────────────
+
+class QueueFullError(Exception):
+    """
+    Очередь к OpenAI переполнена — запрос отклоняется сразу, а не копится.
+    """
+
+
+def parse_reset_seconds(value: Optional[str]) -> Optional[float]:
+    """
+    Разбирает длительность из заголовков x-ratelimit-reset-* ("1s", "6m0s", "20ms").
+    """
+    if not value:
+        return None
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", value)
+    if not parts:
+        return None
+    scale = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    return sum(float(number) * scale[unit] for number, unit in parts)
+
+
+class TokenBucket:
+    """
+    Токен-бакет на минутный лимит (запросов или токенов). Уровень может
+    уходить в минус, когда фактический расход больше оценки, — это долг,
+    который гасится пополнением.
+    """
+
+    def __init__(self, per_minute: int) -> None:
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount: float) -> None:
+        """
+        Ждёт, пока в бакете наберётся amount, и списывает его.
+        """
+        amount = min(amount, self.capacity)
+        while True:
+            self._refill()
+            now = time.monotonic()
+            if now < self.blocked_until:
+                await asyncio.sleep(self.blocked_until - now)
+                continue
+            if self.level >= amount:
+                self.level -= amount
+                return
+            await asyncio.sleep((amount - self.level) / self.rate)
+
+    def adjust(self, delta: float) -> None:
+        """
+        Корректирует уровень: delta > 0 — доплата, delta < 0 — возврат.
+        """
+        self._refill()
+        self.level = min(self.capacity, self.level - delta)
+
+    def sync(self, remaining: Optional[str], reset: Optional[str]) -> None:
+        """
+        Подстраивается под остаток, который сообщил сервер в x-ratelimit-*.
+        """
+        if remaining is None:
+            return
+        try:
+            remaining_value = float(remaining)
+        except ValueError:
+            return
+        self._refill()
+        self.level = min(self.level, remaining_value)
+        reset_seconds = parse_reset_seconds(reset)
+        if remaining_value <= 0 and reset_seconds:
+            self.blocked_until = time.monotonic() + reset_seconds
+
+
+class _Ticket:
+    """
+    Место в очереди одного запроса.
+    """
+
+    __slots__ = ("future", "shown_position")
+
+    def __init__(self, future: asyncio.Future) -> None:
+        self.future = future
+        self.shown_position = None
+
+
+class CompletionScheduler:
+    """
+    Допуск запросов к OpenAI:
+     - токен-бакеты на запросы/мин и токены/мин (подпитываются usage и x-ratelimit-*);
+     - глобальный лимит одновременных запросов;
+     - справедливая очередь по пользователям (round-robin), чтобы один
+       активный пользователь не вытеснял остальных;
+     - ограниченная очередь: при переполнении — QueueFullError;
+     - повтор 429/5xx с экспоненциальной задержкой внутри планировщика.
+    """
+
+    def __init__(self, rpm: int, tpm: int, max_concurrency: int,
+                 max_queue: int, max_queue_per_user: int) -> None:
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_queue_per_user = max_queue_per_user
+        self.active = 0
+        self.waiting = 0
+        self._queues = OrderedDict()   # user_id -> deque[_Ticket], порядок — очередь round-robin
+        self.stats = {"admitted": 0, "queued": 0, "rejected": 0, "retries": 0}
+
+    # ── Справедливая очередь ────────────────────────────────────────────────
+
+    def position(self, ticket: _Ticket) -> Optional[int]:
+        """
+        Позиция билета в порядке обслуживания round-robin (1 — следующий).
+        """
+        position = 0
+        depth = 0
+        while True:
+            advanced = False
+            for tickets in self._queues.values():
+                if depth < len(tickets):
+                    advanced = True
+                    position += 1
+                    if tickets[depth] is ticket:
+                        return position
+            if not advanced:
+                return None
+            depth += 1
+
+    def _dispatch(self) -> None:
+        while self.active < self.max_concurrency and self._queues:
+            user_id, tickets = next(iter(self._queues.items()))
+            ticket = tickets.popleft()
+            if tickets:
+                self._queues.move_to_end(user_id)
+            else:
+                del self._queues[user_id]
+            self.waiting -= 1
+            if ticket.future.done():
+                continue
+            self.active += 1
+            ticket.future.set_result(None)
+
+    def _release(self) -> None:
+        self.active -= 1
+        self._dispatch()
+
+    async def _acquire_slot(self, user_id: int, on_position) -> None:
+        if self.active < self.max_concurrency and not self._queues:
+            self.active += 1
+            return
+
+        tickets = self._queues.get(user_id)
+        if self.waiting >= self.max_queue or (tickets and len(tickets) >= self.max_queue_per_user):
+            self.stats["rejected"] += 1
+            raise QueueFullError(f"очередь переполнена: {self.waiting} ожидающих")
+
+        ticket = _Ticket(asyncio.get_running_loop().create_future())
+        self._queues.setdefault(user_id, deque()).append(ticket)
+        self.waiting += 1
+        self.stats["queued"] += 1
+
+        notifier = asyncio.create_task(self._report_position(ticket, on_position))
+        try:
+            await ticket.future
+            if ticket.shown_position is not None:
+                await on_position(None)   # Очередь дошла — сообщаем, что начали
+        except asyncio.CancelledError:
+            if ticket.future.done() and not ticket.future.cancelled():
+                self._release()   # Место уже выдали, но запрос отменён — отдаём его дальше
+            else:
+                tickets = self._queues.get(user_id)
+                if tickets and ticket in tickets:
+                    tickets.remove(ticket)
+                    self.waiting -= 1
+                    if not tickets:
+                        del self._queues[user_id]
+            raise
+        finally:
+            notifier.cancel()
+
+    async def _report_position(self, ticket: _Ticket, on_position) -> None:
+        """
+        Пока билет ждёт, периодически сообщает пользователю его позицию.
+        """
+        while not ticket.future.done():
+            position = self.position(ticket)
+            if position is not None and position != ticket.shown_position:
+                ticket.shown_position = position
+                await on_position(position)
+            await asyncio.sleep(QUEUE_POSITION_INTERVAL)
+
+    # ── Лимиты OpenAI ───────────────────────────────────────────────────────
+
+    def observe_headers(self, headers) -> None:
+        """
+        Синхронизирует бакеты с x-ratelimit-* заголовками ответа OpenAI.
+        """
+        self.requests.sync(
+            headers.get("x-ratelimit-remaining-requests"),
+            headers.get("x-ratelimit-reset-requests")
+        )
+        self.tokens.sync(
+            headers.get("x-ratelimit-remaining-tokens"),
+            headers.get("x-ratelimit-reset-tokens")
+        )
+
+    @staticmethod
+    def _retryable(error: Exception) -> bool:
+        """
+        Те же ошибки, что повторяет сам клиент openai (у нас max_retries=0):
+        сбой соединения и таймаут, 408, 409, 429 и 5xx.
+        """
+        if isinstance(error, APIConnectionError):
+            return True
+        return error.status_code in (408, 409, 429) or error.status_code >= 500
+
+    @staticmethod
+    def _backoff(error: Exception, attempt: int) -> float:
+        response = getattr(error, "response", None)
+        if response is not None:
+            retry_after = response.headers.get("retry-after")
+            if retry_after:
+                try:
+                    return float(retry_after)
+                except ValueError:
+                    pass
+        return OPENAI_BACKOFF_BASE * (2 ** attempt) + random.uniform(0, OPENAI_BACKOFF_BASE)
+
+    async def run(self, user_id: int, estimated_tokens: int, call, on_position):
+        """
+        Выполняет call() с соблюдением всех лимитов. call возвращает
+        Interpretation; по его usage бакет токенов уточняется после ответа.
+        """
+        waiting_since = time.monotonic()
+        await self._acquire_slot(user_id, on_position)
+        OPENAI_QUEUE_WAIT.observe(time.monotonic() - waiting_since)
+        self.stats["admitted"] += 1
+        try:
+            attempt = 0
+            while True:
+                await self.requests.acquire(1)
+                await self.tokens.acquire(estimated_tokens)
+                try:
+                    result = await call()
+                except (APIConnectionError, APIStatusError) as e:
+                    if not self._retryable(e):
+                        raise
+                    self.tokens.adjust(-estimated_tokens)   # Отклонённый запрос токенов не тратит
+                    response = getattr(e, "response", None)
+                    if response is not None:
+                        self.observe_headers(response.headers)
+                    if attempt >= OPENAI_RATE_LIMIT_RETRIES:
+                        raise
+                    delay = self._backoff(e, attempt)
+                    attempt += 1
+                    self.stats["retries"] += 1
+                    reason = getattr(e, "status_code", None) or type(e).__name__
+                    logging.warning(f"OpenAI {reason}: повтор {attempt} через {delay:.1f} сек")
+                    await asyncio.sleep(delay)
+                    continue
+
+                if result.usage is not None:
+                    self.tokens.adjust(result.usage.total_tokens - estimated_tokens)
+                return result
+        finally:
+            self._release()
+
+    def charge(self, estimated_tokens: int) -> None:
+        """
+        Списывает дополнительный запрос без ожидания (хедж уже в пути).
+        """
+        self.requests.adjust(1)
+        self.tokens.adjust(estimated_tokens)
+
+    def describe(self) -> str:
+        """
+        Сводка состояния планировщика для администратора.
+        """
+        return (
+            f"🚦 Очередь OpenAI:\n"
+            f"В работе: {self.active} / {self.max_concurrency}, ждут: {self.waiting}\n"
+            f"Допущено: {self.stats['admitted']}, через очередь: {self.stats['queued']}\n"
+            f"Отклонено: {self.stats['rejected']}, повторов: {self.stats['retries']}\n"
+            f"Бакеты: запросы {self.requests.level:.0f}/{self.requests.capacity:.0f}, "
+            f"токены {self.tokens.level:.0f}/{self.tokens.capacity:.0f}"
+        )
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+#          Уровни моделей: хеджирование запросов и автоматический выключатель
+# ─────────────────────────────────────────────────────────────────────────────
+
+class CircuitOpenError(Exception):
+    """
+    Все уровни моделей временно выключены автоматическим выключателем.
+    """
+
+
+class CircuitBreaker:
+    """
+    Выключатель для одной модели: после BREAKER_FAILURE_THRESHOLD ошибок подряд
+    модель пропускается BREAKER_COOLDOWN секунд, затем пропускается один
+    пробный запрос (half-open): успех включает модель, ошибка — снова выключает.
+    """
+
+    def __init__(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if self.probing else "open"
+
+    def available(self) -> bool:
+        """
+        Можно ли сейчас запустить модель; в отличие от allow() пробный
+        запрос не занимает.
+        """
+        if self.opened_at is None:
+            return True
+        return not self.probing and time.monotonic() - self.opened_at >= BREAKER_COOLDOWN
+
+    def allow(self) -> bool:
+        """
+        Вызывается, когда запрос к модели действительно уходит: после
+        паузы этот запрос становится пробным.
+        """
+        if not self.available():
+            return False
+        if self.opened_at is not None:
+            self.probing = True
+        return True
+
+    def release_probe(self) -> None:
+        """
+        Пробный запрос отменён, не дав исхода: следующий запрос снова
+        станет пробным (иначе модель так и осталась бы в half-open).
+        """
+        self.probing = False
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.probing or self.failures >= BREAKER_FAILURE_THRESHOLD:
+            self.opened_at = time.monotonic()
+            self.probing = False
+
+
+class ModelTier:
+    """
+    Уровень модели: имя, выключатель и окно последних задержек
+    (до первого токена в потоковом режиме, до полного ответа — иначе).
+    """
+
+    def __init__(self, model: str) -> None:
+        self.model = model
+        self.breaker = CircuitBreaker()
+        self.latencies = deque(maxlen=HEDGE_LATENCY_WINDOW)
+        self.stats = {"requests": 0, "wins": 0, "failures": 0, "skipped": 0}
+
+    def p95(self) -> Optional[float]:
+        if len(self.latencies) < 20:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[int(len(ordered) * 0.95) - 1]
+
+    def hedge_delay(self) -> float:
+        """
+        Бюджет задержки: p95 этой модели в пределах [HEDGE_MIN_DELAY, HEDGE_MAX_DELAY];
+        пока замеров мало — HEDGE_MAX_DELAY.
+        """
+        p95 = self.p95()
+        if p95 is None:
+            return HEDGE_MAX_DELAY
+        return min(HEDGE_MAX_DELAY, max(HEDGE_MIN_DELAY, p95))
+
+
+class TieredBackend:
+    """
+    Запрос идёт к первой доступной модели. Если к дедлайну (p95) она не дала
+    ответа (или первого токена в потоке), параллельно запускается следующий
+    уровень; побеждает первый, остальные отменяются. Упавшая модель сразу
+    передаёт ход следующему уровню — кроме 429: его получает планировщик.
+    """
+
+    def __init__(self, models: list) -> None:
+        self.tiers = [ModelTier(model) for model in models]
+        self.hedges = 0
+
+    async def complete(self, attempt) -> "Interpretation":
+        """
+        attempt(model, claim, hedged) — корутина одного запроса. В потоковом
+        режиме она вызывает claim() на первом токене: True — этот запрос
+        победил, False — уже есть победитель и запрос надо прекратить.
+        """
+        tiers = []
+        for tier in self.tiers:
+            if tier.breaker.available():
+                tiers.append(tier)
+            else:
+                tier.stats["skipped"] += 1
+        if not tiers:
+            raise CircuitOpenError("все модели временно выключены")
+
+        started = time.monotonic()
+        tasks = {}   # task -> (уровень, пробный ли это запрос)
+        winner = []
+        first_token = []
+        errors = []
+        rate_limited = []   # 429 — лимит общий для всех моделей аккаунта
+        next_index = 0
+
+        def launch() -> bool:
+            """
+            Запускает следующий уровень. Выключатель занимается только
+            здесь, когда запрос действительно уходит. False — уровней
+            больше нет.
+            """
+            nonlocal next_index
+            while next_index < len(tiers):
+                tier = tiers[next_index]
+                hedged = next_index > 0
+                next_index += 1
+                probe = tier.breaker.opened_at is not None
+                if not tier.breaker.allow():
+                    tier.stats["skipped"] += 1   # Пробный запрос уже занят другим сном
+                    continue
+                tier.stats["requests"] += 1
+
+                def claim(tier=tier) -> bool:
+                    if not winner:
+                        winner.append(tier)
+                        first_token.append(time.monotonic() - started)
+                        tier.latencies.append(first_token[-1])
+                        for task, (other, _) in tasks.items():
+                            if other is not tier:
+                                task.cancel()
+                    return winner[0] is tier
+
+                task = asyncio.create_task(attempt(tier.model, claim, hedged))
+                tasks[task] = (tier, probe)
+                return True
+            return False
+
+        if not launch():
+            raise CircuitOpenError("все модели временно выключены")
+        launched = 1
+        try:
+            while tasks:
+                timeout = None
+                if next_index < len(tiers) and not winner and not rate_limited:
+                    timeout = max(0.0, tiers[0].hedge_delay() - (time.monotonic() - started))
+                done, _ = await asyncio.wait(tasks, timeout=timeout,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # Дедлайн основной модели прошёл — хеджируем следующим уровнем
+                    if launch():
+                        self.hedges += 1
+                        launched += 1
+                    continue
+
+                for task in done:
+                    tier, probe = tasks.pop(task)
+                    if task.cancelled():
+                        if probe:
+                            tier.breaker.release_probe()
+                        continue
+                    error = task.exception()
+                    if error is None:
+                        result = task.result()
+                        tier.breaker.record_success()
+                        tier.stats["wins"] += 1
+                        if not winner:
+                            tier.latencies.append(time.monotonic() - started)
+                        result.model = tier.model
+                        result.tier = self.tiers.index(tier)
+                        result.hedged = launched > 1
+                        result.api_ttft = first_token[-1] if first_token else None
+                        result.api_total = time.monotonic() - started
+                        return result
+
+                    # 429 — общий лимит аккаунта, а не сбой модели: следующий
+                    # уровень упрётся в тот же лимит, повтор с паузой делает планировщик
+                    if not isinstance(error, RateLimitError):
+                        tier.breaker.record_failure()
+                    else:
+                        rate_limited.append(error)
+                        if probe:
+                            tier.breaker.release_probe()
+                    tier.stats["failures"] += 1
+                    errors.append(error)
+                    if winner and winner[0] is tier:
+                        winner.clear()   # Победитель упал посреди потока — продолжаем гонку
+
+                # Упали все запущенные, а уровни ещё есть — не ждём дедлайна
+                if not tasks and not rate_limited and launch():
+                    launched += 1
+            raise rate_limited[0] if rate_limited else errors[0]
+        finally:
+            for task, (tier, probe) in tasks.items():
+                task.cancel()
+                if probe:
+                    tier.breaker.release_probe()
+
+    def describe(self) -> str:
+        """
+        Сводка по уровням моделей для администратора.
+        """
+        lines = [f"🧭 Уровни моделей (хеджей: {self.hedges}):"]
+        for index, tier in enumerate(self.tiers):
+            p95 = tier.p95()
+            lines.append(
+                f"{index}. {tier.model} — {tier.breaker.state}, "
+                f"p95: {format_seconds(p95)}, запросов: {tier.stats['requests']}, "
+                f"побед: {tier.stats['wins']}, ошибок: {tier.stats['failures']}, "
+                f"пропусков: {tier.stats['skipped']}"
+            )
+        return "\n".join(lines)
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+#                   Потоковый ответ с прогрессивным редактированием
+# ─────────────────────────────────────────────────────────────────────────────
+
+class StreamingEditor:
+    """
+    Прогрессивно редактирует сообщение-заглушку по мере прихода токенов.
+    Правки объединяются по времени и по объёму нового текста, чтобы не
+    упираться в лимиты Telegram на editMessageText.
+    """
+
+    def __init__(self, message: Message, started: float) -> None:
+        self.message = message
+        self.started = started
+        self.text = ""
+        self.shown_len = 0
+        self.next_edit_at = 0.0
+        self.first_visible = None   # Время до первого видимого текста (сек)
+
+    def _due(self, now: float) -> bool:
+        if now < self.next_edit_at:
+            return False
+        if self.shown_len == 0:
+            return True   # Первый фрагмент показываем сразу — это и есть TTFT для пользователя
+        return len(self.text) - self.shown_len >= STREAM_EDIT_MIN_CHARS
+
+    async def feed(self, delta: str) -> None:
+        """
+        Добавляет фрагмент ответа и при необходимости обновляет сообщение.
+        """
+        self.text += delta
+        now = time.monotonic()
+        if not self.text.strip() or not self._due(now):
+            return
+        try:
+            await self.message.edit_text(self.text + " ▌")
+            self.shown_len = len(self.text)
+            if self.first_visible is None:
+                self.first_visible = time.monotonic() - self.started
+            self.next_edit_at = time.monotonic() + STREAM_EDIT_INTERVAL
+        except RetryAfter as e:
+            self.next_edit_at = time.monotonic() + float(e.retry_after)
+        except TelegramError as e:
+            logging.warning(f"Не удалось обновить сообщение при стриминге: {e}")
+            self.next_edit_at = time.monotonic() + STREAM_EDIT_INTERVAL
+
+
+async def stream_interpretation(client: AsyncOpenAI, model: str, messages: list, max_tokens: int,
+                                editor: StreamingEditor, scheduler: CompletionScheduler, claim):
+    """
+    Запрашивает интерпретацию в потоковом режиме и передаёт фрагменты в editor.
+    На первом токене вызывает claim(): проигравший хедж-запрос прекращается,
+    не тронув сообщение. Возвращает (текст, usage, ttft), где ttft — время
+    до первого токена.
+    """
+    raw = await client.chat.completions.with_raw_response.create(
+        model=model,
+        messages=messages,
+        temperature=0.6,
+        max_tokens=max_tokens,
+        stream=True,
+        stream_options={"include_usage": True}
+    )
+    scheduler.observe_headers(raw.headers)
+    stream = raw.parse()
+    usage = None
+    ttft = None
+    try:
+        async for chunk in stream:
+            if chunk.usage is not None:
+                usage = chunk.usage
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                if ttft is None:
+                    if not claim():
+                        raise asyncio.CancelledError()
+                    ttft = time.monotonic() - editor.started
+                await editor.feed(delta)
+    finally:
+        # При отмене или ошибке посреди потока ответ сам не закрывается,
+        # и соединение не возвращается в пул
+        await stream.close()
+    return editor.text, usage, ttft
+
+
+def format_seconds(value) -> str:
+    """
+    Человекочитаемое время для логов: "1.23 сек" или "—", если замера нет.
+    """
+    return "—" if value is None else f"{value:.2f} сек"
+
+
+def format_reply(reply_text: str):
+    """
+    Форматирование ответа: выделяем блок "Совет:".
+    Возвращает (текст, parse_mode).
+    """
+    if "Совет:" in reply_text:
+        parts = reply_text.split("Совет:", maxsplit=1)
+        main_text = html.escape(parts[0].strip())
+        advice_block = html.escape(parts[1].strip())
+
+        formatted_reply = (
+            f"{main_text}\n\n"
+            f"<b>📝 Совет:</b> <i>{advice_block}</i>"
+        )
+        return formatted_reply, ParseMode.HTML
+    return reply_text, None
+
+
+@dataclass
+class Interpretation:
+    """
+    Результат запроса интерпретации: текст, usage и замеры задержек.
+    """
+    text: str
+    usage: Optional[object] = None
+    model: Optional[str] = None
+    tier: Optional[int] = None     # Номер уровня модели, который ответил
+    hedged: bool = False           # Запускался ли хедж-запрос
+    ttft: Optional[float] = None
+    first_visible: Optional[float] = None
+    api_ttft: Optional[float] = None    # От начала запроса к OpenAI до первого токена
+    api_total: Optional[float] = None   # От начала запроса к OpenAI до полного ответа
+    cached: bool = False
+    shared: bool = False   # Получен от одновременного одинакового запроса
+
+
+async def request_interpretation(client: AsyncOpenAI, model: str, messages: list, max_tokens: int,
+                                 placeholder: Message, started: float,
+                                 scheduler: CompletionScheduler, claim) -> Interpretation:
+    """
+    Запрашивает интерпретацию у модели model: потоково (с правками заглушки)
+    или целиком. Заголовки x-ratelimit-* передаются планировщику.
+    """
+    if OPENAI_STREAM:
+        # Потоковый режим: пользователь видит текст по мере генерации
+        editor = StreamingEditor(placeholder, started)
+        reply_text, usage, ttft = await stream_interpretation(
+            client, model, messages, max_tokens, editor, scheduler, claim
+        )
+        return Interpretation(reply_text.strip(), usage, ttft=ttft,
+                              first_visible=editor.first_visible)
+
+    # Запрос к модели с оптимизированными параметрами (не блокирует event loop)
+    raw = await client.chat.completions.with_raw_response.create(
+        model=model,
+        messages=messages,
+        temperature=0.6,   # Снижение температуры для более сдержанных ответов
+        max_tokens=max_tokens   # Ограничение длины ответа (по стилю и длине сна)
+    )
+    scheduler.observe_headers(raw.headers)
+    response = raw.parse()
+    return Interpretation(response.choices[0].message.content.strip(), response.usage)
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+#                      Обработка текстовых сообщений (сны)
+# ─────────────────────────────────────────────────────────────────────────────
+
+async def complete_with_scheduler(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                                  messages: list, max_tokens: int, placeholder: Message,
+                                  started: float) -> Interpretation:
+    """
+    Запрос к OpenAI через планировщик и уровни моделей; расход токенов
+    записывается в ledger. Пока запрос ждёт в очереди, в заглушке видна позиция.
+    """
+    placeholder_text = placeholder.text
+
+    async def show_position(position: Optional[int]) -> None:
+        # Пока ждём в очереди — показываем позицию вместо «думаю»
+        try:
+            if position is None:
+                await placeholder.edit_text(placeholder_text)
+            else:
+                await placeholder.edit_text(
+                    f"⏳ Сейчас много снов. Ты в очереди: {position}-й. "
+                    f"Интуи скоро займётся твоим."
+                )
+        except TelegramError as e:
+            logging.warning(f"Не удалось показать позицию в очереди: {e}")
+
+    # Общий клиент OpenAI, созданный в post_init; допуск — через планировщик
+    client = context.bot_data["openai"]
+    scheduler = context.bot_data["scheduler"]
+    estimated = count_message_tokens(messages) + max_tokens
+
+    async def attempt(model: str, claim, hedged: bool) -> Interpretation:
+        if hedged:
+            scheduler.charge(estimated)   # Хедж — отдельный запрос, учитываем в лимитах
+        return await request_interpretation(
+            client, model, messages, max_tokens, placeholder, started, scheduler, claim
+        )
+
+    fresh = await scheduler.run(
+        update.effective_user.id,
+        estimated,
+        lambda: context.bot_data["backend"].complete(attempt),
+        show_position
+    )
+    context.bot_data["ledger"].record(update.effective_user.id, fresh.model, fresh.usage)
+    return fresh
+
+
+def log_interpretation(result: Interpretation, total_time: float) -> None:
+    """
+    Логирует задержки (TTFT, первый видимый текст, общее время), уровень
+    модели и usage ответа; пишет задержки OpenAI в метрики.
+    """
+    logging.info(
+        f"Latency — TTFT: {format_seconds(result.ttft)}, "
+        f"First visible: {format_seconds(result.first_visible)}, "
+        f"Total: {format_seconds(total_time)}, Stream: {OPENAI_STREAM}, "
+        f"Cache: {'hit' if result.cached else 'miss'}, Shared: {result.shared}."
+    )
+    if result.model is not None and not result.shared:
+        OPENAI_TOTAL.observe(result.api_total, model=result.model)
+        if result.api_ttft is not None:
+            OPENAI_TTFT.observe(result.api_ttft, model=result.model)
+        # Какой уровень ответил и за сколько — для настройки цены и хвостовых задержек
+        logging.info(
+            f"Tier — модель: {result.model} (уровень {result.tier}), "
+            f"хедж: {result.hedged}, TTFT: {format_seconds(result.ttft)}, "
+            f"Total: {format_seconds(total_time)}."
+        )
+
+    usage = result.usage
+    if usage is not None:
+        # cached_tokens — часть промпта, попавшая в кэш промптов OpenAI
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached = getattr(details, "cached_tokens", None) or 0
+        logging.info(
+            f"Usage — Prompt: {usage.prompt_tokens} токенов (из кэша: {cached}), "
+            f"Completion: {usage.completion_tokens} токенов, "
+            f"Total: {usage.total_tokens} токенов."
+        )
+
+
+async def report_failure(update: Update, placeholder: Message, error: Exception) -> None:
+    """
+    Отвечает пользователю, если толкование получить не удалось: квота,
+    перегрузка очереди или ошибка OpenAI (с алертом администратору).
+    """
+    ERRORS.inc(type=type(error).__name__)
+
+    if isinstance(error, QuotaExceededError):
+        logging.info(f"Запрос пользователя {update.effective_user.id} отклонён: {error}")
+        await placeholder.edit_text(
+            f"🌙 На этот {error.period} Интуи уже растолковала тебе много снов. "
+            f"Возвращайся чуть позже — она будет ждать."
+        )
+        return
+
+    if isinstance(error, (QueueFullError, CoalescedError)):
+        if isinstance(error, QueueFullError) or isinstance(error.__cause__, QueueFullError):
+            # Перегрузка — честно говорим об этом, без алертов администратору
+            logging.warning(f"Запрос отклонён планировщиком: {error}")
+            await placeholder.edit_text(
+                "🌊 Сейчас Интуи толкует слишком много снов сразу. "
+                "Пожалуйста, расскажи свой сон через пару минут."
+            )
+            return
+
+        # Ошибка склеенного запроса: алерт уже отправил ведущий
+        logging.error(f"Ошибка при обращении к OpenAI (склеенный запрос): {error}")
+        await update.message.reply_text(get_random_fallback())
+        return
+
+    # Внутренняя ошибка — логируем и уведомляем
+    # Email и сообщение админу уходят в фоне, обработчик не ждёт SMTP
+    handle_error(f"Ошибка при обращении к OpenAI: {error}")
+
+    # Случайная поэтичная заглушка
+    fallback_text = get_random_fallback()
+    await update.message.reply_text(fallback_text)
+
+
+async def send_interpretation(update: Update, placeholder: Message, reply_text: str) -> Message:
+    """
+    Отправляет готовый ответ и возвращает сообщение с ним.
+    """
+    # Форматирование ответа выполняется один раз — на финальном тексте
+    formatted_reply, parse_mode = format_reply(reply_text)
+    if OPENAI_STREAM:
+        # В потоковом режиме заменяем заглушку финальной версией
+        message = await placeholder.edit_text(formatted_reply, parse_mode=parse_mode)
+        return message if isinstance(message, Message) else placeholder
+    return await update.message.reply_text(formatted_reply, parse_mode=parse_mode)
+
+
+@instrumented("handle_message")
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Основная логика: принимает текст (сон), ищет интерпретацию в кэше или
+    запрашивает у OpenAI, сохраняет в историю, отвечает пользователю.
+    Логирует ошибки, usage и задержки (TTFT и общее время).
+    """
+    user_input = update.message.text
+    started = time.monotonic()
+    placeholder = await update.message.reply_text("🔮 Я думаю над твоим сном...")
+
+    # Текущий стиль (по умолчанию "Мастер")
+    style_name = context.user_data.get("style", DEFAULT_STYLE)
+    prompt = STYLE_PROMPTS.get(style_name, STYLE_PROMPTS[DEFAULT_STYLE])
+
+    # Слишком длинный сон сокращаем до MAX_INPUT_TOKENS, длину ответа подбираем под сон
+    request_input, trimmed = trim_to_tokens(user_input, MAX_INPUT_TOKENS)
+    input_tokens = count_tokens(request_input)
+    max_tokens = choose_max_tokens(style_name, input_tokens)
+    messages = [
+        {"role": "system", "content": prompt},
+        {"role": "user", "content": request_input}
+    ]
+    ledger = context.bot_data["ledger"]
+    if trimmed:
+        ledger.totals["trimmed"] += 1
+        logging.info(f"Сон сокращён до {input_tokens} токенов (был {len(user_input)} символов)")
+
+    # Короткие сны ищем в кэше — повторяющиеся сюжеты не стоят нового запроса
+    cache = context.bot_data["cache"]
+    request_key = cache.make_key(style_name, prompt, user_input)
+    cache_key = request_key if len(user_input) <= CACHE_MAX_INPUT_CHARS else None
+
+    async def fetch() -> Interpretation:
+        fresh = await complete_with_scheduler(update, context, messages, max_tokens, placeholder, started)
+        # Свежий ответ кладём в кэш (вместе с ценой в токенах — для учёта экономии)
+        if cache_key:
+            tokens = fresh.usage.total_tokens if fresh.usage is not None else 0
+            await cache.put(cache_key, style_name, prompt, fresh.text, tokens)
+        return fresh
+
+    try:
+        cached_text = await cache.get(cache_key) if cache_key else None
+        if cached_text is not None:
+            result = Interpretation(cached_text, cached=True)
+        else:
+            # Квота проверяется до запроса — по локальной оценке токенов
+            await ledger.check(
+                update.effective_user.id, count_message_tokens(messages) + max_tokens
+            )
+            # Одинаковые одновременные сны ждут один и тот же запрос к OpenAI
+            result, shared = await context.bot_data["inflight"].do(request_key, fetch)
+            if shared:
+                result = replace(result, usage=None, ttft=None, first_visible=None, shared=True)
+
+        log_interpretation(result, time.monotonic() - started)
+
+        # Собираем текст ответа
+        reply_text = result.text
+
+        # Сохраняем в историю: последние записи в user_data, архив — в SQLite
+        save_dream(context, update.effective_user.id, user_input, reply_text, style_name)
+
+    except Exception as e:
+        await report_failure(update, placeholder, e)
+        return  # Завершаем обработку, чтобы не шёл дальше
+
+    message = await send_interpretation(update, placeholder, reply_text)
+    # Ответ (reply) на это сообщение станет уточняющим вопросом об этом сне
+    start_thread(context, message.message_id, user_input, reply_text, style_name)
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+#             Уточняющие вопросы о толковании (сводка вместо контекста)
+# ─────────────────────────────────────────────────────────────────────────────
+
+class ReplyToBotFilter(filters.MessageFilter):
+    """
+    Сообщение — ответ (reply) на сообщение бота. Дешёвая предварительная
+    проверка: к какому разговору относится ответ (и относится ли вообще),
+    решает find_thread по user_data.
+    """
+
+    def filter(self, message: Message) -> bool:
+        replied = message.reply_to_message
+        return replied is not None and replied.from_user is not None and replied.from_user.is_bot
+
+
+REPLY_TO_BOT = ReplyToBotFilter()
+
+
+def gist(text: str, limit: int) -> str:
+    """
+    Короткая выжимка ответа для сводки: первые предложения в пределах limit
+    токенов и, если есть, блок «Совет:».
+    """
+    sentences = [s for s in re.split(r"(?<=[.!?…])\s+", text.strip()) if s]
+    advice = next((s for s in sentences if s.lstrip("*_ ").startswith("Совет")), None)
+    used = count_tokens(advice) if advice else 0
+    picked = []
+    for sentence in sentences:
+        if sentence is advice:
+            continue
+        tokens = count_tokens(sentence)
+        if used + tokens > limit:
+            break
+        picked.append(sentence)
+        used += tokens
+    if advice:
+        picked.append(advice)
+    return trim_to_tokens(" ".join(picked) or text, limit)[0]
+
+
+def thread_summary(thread: dict) -> str:
+    """
+    Текст сводки разговора: сон, суть толкования и последние вопросы.
+    """
+    return "\n".join([thread["base"], *thread["turns"]])
+
+
+def start_thread(context: ContextTypes.DEFAULT_TYPE, message_id: int,
+                 dream: str, reply: str, style_name: str) -> tuple:
+    """
+    Заводит разговор о сне, привязанный к сообщению с толкованием.
+    В user_data хранятся только FOLLOWUP_MAX_THREADS последних разговоров.
+    """
+    threads = context.user_data.setdefault("threads", {})
+    links = context.user_data.setdefault("thread_messages", {})
+    thread_id = str(message_id)
+    threads[thread_id] = {
+        "style": style_name,
+        "base": (f"Сон: {trim_to_tokens(dream, FOLLOWUP_DREAM_TOKENS)[0]}\n"
+                 f"Толкование (кратко): {gist(reply, FOLLOWUP_GIST_TOKENS)}"),
+        "turns": [],
+        "count": 0,
+        # Сколько токенов занял бы весь разговор, если пересылать его целиком
+        "naive_tokens": count_message_tokens([
+            {"role": "user", "content": dream}, {"role": "assistant", "content": reply}
+        ])
+    }
+    links[thread_id] = thread_id
+    while len(threads) > FOLLOWUP_MAX_THREADS:
+        oldest = next(iter(threads))
+        del threads[oldest]
+        for linked in [m for m, t in links.items() if t == oldest]:
+            del links[linked]
+    return thread_id, threads[thread_id]
+
+
+def find_thread(context: ContextTypes.DEFAULT_TYPE, message_id: int) -> tuple:
+    """
+    Разговор, к которому относится ответ на сообщение message_id. Уточнением
+    считается только ответ на толкование или на ответ по уточнению: reply на
+    приветствие, «Напиши мне, что тебе приснилось...», страницу истории или
+    заглушку — это новый сон. Возвращает (thread_id, thread) или (None, None).
+    """
+    threads = context.user_data.get("threads", {})
+    thread_id = context.user_data.get("thread_messages", {}).get(str(message_id))
+    if thread_id in threads:
+        return thread_id, threads[thread_id]
+    return None, None
+
+
+@instrumented("handle_followup")
+async def handle_followup(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Уточняющий вопрос — ответ (reply) на сообщение Интуи.
+
+    В OpenAI уходят системный промпт стиля (первым и неизменным — чтобы
+    срабатывал кэш промптов на стороне провайдера), сводка разговора
+    и новый вопрос, а не вся переписка. Сводка обновляется локально:
+    к ней добавляется выжимка вопроса и ответа, старые ходы вытесняются
+    при превышении FOLLOWUP_SUMMARY_TOKENS.
+    """
+    thread_id, thread = find_thread(context, update.message.reply_to_message.message_id)
+    if thread is None:
+        # Ответ не на толкование — это новый сон
+        await handle_message(update, context)
+        return
+
+    question = update.message.text
+    started = time.monotonic()
+    placeholder = await update.message.reply_text("🔮 Вспоминаю твой сон...")
+
+    prompt = STYLE_PROMPTS.get(thread["style"], STYLE_PROMPTS[DEFAULT_STYLE])
+    request_question, _ = trim_to_tokens(question, FOLLOWUP_MAX_QUESTION_TOKENS)
+    messages = [
+        {"role": "system", "content": f"{prompt}\n\n{FOLLOWUP_PROMPT}"},
+        {"role": "system", "content": f"Контекст разговора:\n{thread_summary(thread)}"},
+        {"role": "user", "content": request_question}
+    ]
+    prompt_tokens = count_message_tokens(messages)
+    naive_tokens = thread["naive_tokens"] + count_message_tokens([
+        {"role": "system", "content": prompt}, {"role": "user", "content": question}
+    ])
+
+    ledger = context.bot_data["ledger"]
+    try:
+        await ledger.check(update.effective_user.id, prompt_tokens + FOLLOWUP_MAX_TOKENS)
+        result = await complete_with_scheduler(
+            update, context, messages, FOLLOWUP_MAX_TOKENS, placeholder, started
+        )
+        log_interpretation(result, time.monotonic() - started)
+    except Exception as e:
+        await report_failure(update, placeholder, e)
+        return
+
+    # Промпт хода со сводкой против полного контекста — для проверки экономии
+    thread["count"] += 1
+    FOLLOWUP_PROMPT_TOKENS.inc(prompt_tokens, context="summary")
+    FOLLOWUP_PROMPT_TOKENS.inc(naive_tokens, context="full")
+    ledger.totals["followups"] += 1
+    ledger.totals["followup_prompt"] += prompt_tokens
+    ledger.totals["followup_full_prompt"] += naive_tokens
+    logging.info(
+        f"Follow-up — ход {thread['count']}: промпт {prompt_tokens} токенов "
+        f"вместо {naive_tokens} с полным контекстом "
+        f"(экономия {100 - prompt_tokens * 100 // max(naive_tokens, 1)}%)."
+    )
+
+    thread["naive_tokens"] += count_message_tokens([
+        {"role": "user", "content": question}, {"role": "assistant", "content": result.text}
+    ])
+    thread["turns"].append(
+        f"Вопрос: {trim_to_tokens(question, FOLLOWUP_TURN_TOKENS)[0]}\n"
+        f"Ответ: {gist(result.text, FOLLOWUP_TURN_TOKENS)}"
+    )
+    while len(thread["turns"]) > 1 and count_tokens(thread_summary(thread)) > FOLLOWUP_SUMMARY_TOKENS:
+        thread["turns"].pop(0)
+
+    message = await send_interpretation(update, placeholder, result.text)
+    links = context.user_data.setdefault("thread_messages", {})
+    links[str(message.message_id)] = thread_id
+    while len(links) > FOLLOWUP_MAX_THREADS * 10:
+        del links[next(iter(links))]
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+#               Функции для случайных заглушек и мониторинга ошибок
+# ─────────────────────────────────────────────────────────────────────────────
+
+# Список поэтичных заглушек
+fallback_replies = [
+    "🌙 Сегодня Интуи немного задумалась... Попробуй рассказать этот сон чуть позже.",
+    "✨ Иногда даже сны ускользают... Попробуй ещё раз — Интуи услышит.",
+    "💤 Интуи на мгновение ушла вглубь себя. Возвращайся через пару минут.",
+    "🔮 Сейчас Интуи на границе миров. Она скоро снова будет с тобой.",
+    "🌌 Сегодня сны запутались в облаках. Завтра всё прояснится."
+]
+
+# Очередь временных меток ошибок за последние 10 минут
+error_log = deque()
+
+def get_random_fallback() -> str:
+    """
+    Возвращает случайную поэтичную заглушку из списка.
+    """
+    return random.choice(fallback_replies)
+
+
+class AlertPipeline:
+    """
+    Асинхронные алерты: handle_error только кладёт ошибку в очередь, а фоновый
+    обработчик отправляет письма (через одно SMTP-соединение) и уведомления
+    администратору в Telegram.
+     - ошибки, пришедшие почти одновременно, склеиваются в одну сводку;
+     - при шторме (>=3 ошибок за 10 минут по error_log) — одна сводка
+       за ALERT_DIGEST_INTERVAL;
+     - в Telegram одинаковые сводки не повторяются в течение
+       ALERT_DEDUP_WINDOW, а всего сообщений не больше ALERT_TELEGRAM_PER_HOUR в час.
+    """
+
+    def __init__(self) -> None:
+        self.queue = asyncio.Queue(maxsize=ALERT_QUEUE_SIZE)
+        self.mailer = None
+        self.bot = None
+        self._worker = None
+        self._telegram_sent = deque()   # Время отправки сообщений админу
+        self._recent = {}               # Текст ошибки -> когда последний раз уходил в Telegram
+        self.stats = {"alerts": 0, "digests": 0, "dropped": 0, "telegram_suppressed": 0}
+
+    def start(self, bot) -> None:
+        self.bot = bot
+        self.mailer = SMTPMailer()
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        Досылает накопленное и закрывает SMTP-соединение.
+        """
+        if self._worker is None:
+            return
+        await self.queue.put(None)
+        try:
+            await asyncio.wait_for(self._worker, timeout=SMTP_TIMEOUT * 2)
+        except asyncio.TimeoutError:
+            logging.error("Обработчик алертов не успел досылать сводку при остановке")
+        self._worker = None
+        await asyncio.to_thread(self.mailer.close)
+
+    def submit(self, error_message: str) -> None:
+        """
+        Ставит ошибку в очередь; никогда не блокирует вызывающего.
+        """
+        if self._worker is None:
+            return
+        try:
+            self.queue.put_nowait(error_message)
+            self.stats["alerts"] += 1
+        except asyncio.QueueFull:
+            self.stats["dropped"] += 1
+
+    async def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            first = await self.queue.get()
+            if first is None:
+                break
+            batch = [first]
+
+            # Во время шторма копим сводку дольше, иначе — лишь короткое окно
+            storm = len(error_log) >= 3
+            window = ALERT_DIGEST_INTERVAL if storm else ALERT_BATCH_DELAY
+            deadline = time.monotonic() + window
+            while True:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            try:
+                await self._deliver(batch, storm or len(error_log) >= 3)
+            except Exception as e:
+                logging.error(f"Ошибка в обработчике алертов: {e}")
+
+    async def _deliver(self, batch: list, storm: bool) -> None:
+        counts = OrderedDict()
+        for message in batch:
+            counts[message] = counts.get(message, 0) + 1
+
+        if len(batch) == 1 and not storm:
+            subject = "Intui Bot Error"
+            body = batch[0]
+        else:
+            subject = "⚠️ Множественные сбои Intui" if storm else "Intui Bot Error"
+            body = (
+                f"Зафиксировано {len(error_log)} ошибок за последние 10 минут.\n"
+                f"В этой сводке: {len(batch)} (разных: {len(counts)}).\n\n"
+                + "\n".join(f"×{count} {message}" for message, count in counts.items())
+            )
+            self.stats["digests"] += 1
+
+        await asyncio.to_thread(self.mailer.send, subject, body)
+        await self._notify_admin(counts, body)
+
+    async def _notify_admin(self, counts: OrderedDict, body: str) -> None:
+        now = time.monotonic()
+        for message, sent_at in list(self._recent.items()):
+            if now - sent_at > ALERT_DEDUP_WINDOW:
+                del self._recent[message]
+        while self._telegram_sent and now - self._telegram_sent[0] > 3600:
+            self._telegram_sent.popleft()
+
+        # Те же ошибки админ уже видел, или лимит сообщений исчерпан — молчим
+        if all(message in self._recent for message in counts) or \
+                len(self._telegram_sent) >= ALERT_TELEGRAM_PER_HOUR:
+            self.stats["telegram_suppressed"] += 1
+            return
+
+        for message in counts:
+            self._recent[message] = now
+        self._telegram_sent.append(now)
+        try:
+            await self.bot.send_message(
+                chat_id=ADMIN_TELEGRAM_ID,
+                text=f"⚠️ Интуи поймала ошибку:\n{body}"[:4000]
+            )
+        except Exception as tg_err:
+            logging.error(f"Ошибка при отправке Telegram-сообщения админу: {tg_err}")
+
+
+# Единый конвейер алертов процесса (запускается в post_init)
+alert_pipeline = AlertPipeline()
+
+
+def handle_error(error_message: str) -> None:
+    """
+    Логирует ошибку, отмечает её в окне error_log и передаёт конвейеру
+    алертов (email и уведомление админу уходят в фоне).
+    При >=3 ошибках за 10 минут алерты склеиваются в тревожную сводку.
+    """
+    now = time.time()
+    error_log.append(now)
+
+    while error_log and now - error_log[0] > 600:
+        error_log.popleft()
+
+    logging.error(error_message)
+    alert_pipeline.submit(error_message)
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+#                        Быстрый приём апдейтов webhook
+# ─────────────────────────────────────────────────────────────────────────────
+
+class UpdateIdWindow:
+    """
+    Скользящее окно недавних update_id: по биту на id в кольцевом буфере.
+    Telegram нумерует апдейты подряд, поэтому 65536 последних id занимают
+    8 КБ. Id старше окна считаются началом новой последовательности
+    (Telegram сбрасывает нумерацию после долгого простоя).
+    """
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self.bits = bytearray((size + 7) // 8)
+        self.highest = None
+
+    def _slot(self, update_id: int) -> tuple:
+        index = update_id % self.size
+        return index >> 3, 1 << (index & 7)
+
+    def __contains__(self, update_id: int) -> bool:
+        if self.highest is None or update_id > self.highest or update_id <= self.highest - self.size:
+            return False
+        byte, mask = self._slot(update_id)
+        return bool(self.bits[byte] & mask)
+
+    def add(self, update_id: int) -> None:
+        if self.highest is None or update_id <= self.highest - self.size \
+                or update_id - self.highest >= self.size:
+            self.bits[:] = bytes(len(self.bits))
+            self.highest = update_id
+        elif update_id > self.highest:
+            # Освобождаем слоты, которые теперь достались новым id
+            for stale in range(self.highest + 1, update_id):
+                byte, mask = self._slot(stale)
+                self.bits[byte] &= ~mask
+            self.highest = update_id
+        byte, mask = self._slot(update_id)
+        self.bits[byte] |= mask
+
+
+class UpdateIngestor:
+    """
+    Очередь принятых апдейтов и пул обработчиков.
+
+    Webhook только кладёт апдейт сюда и сразу отвечает Telegram 200, поэтому
+    долгий сон не задерживает ответ и Telegram не присылает апдейт повторно.
+    Апдейты одного чата обрабатываются строго по порядку: пока чат занят,
+    его новые апдейты ждут в очереди чата, а свободные обработчики берут
+    апдейты других чатов.
+    """
+
+    def __init__(self, application: Application, workers: int, max_pending: int,
+                 dedup_window: int, on_done=None) -> None:
+        self.application = application
+        self.workers = workers
+        self.on_done = on_done   # Вызывается с update_id после обработки апдейта
+        self.max_pending = max_pending
+        self.seen = UpdateIdWindow(dedup_window)
+        self.queue = asyncio.Queue()
+        self.chat_backlog = {}   # chat_id -> deque апдейтов, пока чат в обработке
+        self.pending = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self._tasks = []
+
+    def start(self) -> None:
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        INGEST_DEPTH.set_function(lambda: [
+            ({"state": "queued"}, self.queue.qsize()),
+            ({"state": "chat_backlog"}, sum(len(b) for b in self.chat_backlog.values())),
+            ({"state": "pending"}, self.pending)
+        ])
+
+    async def stop(self, timeout: float) -> None:
+        """
+        Дожидается обработки уже принятых апдейтов (не дольше timeout)
+        и останавливает обработчики.
+        """
+        try:
+            await asyncio.wait_for(self.idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Остановка: не обработано {self.pending} апдейтов за {timeout} сек")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def submit(self, data: dict) -> str:
+        """
+        Принимает апдейт (JSON от Telegram). Возвращает "accepted",
+        "duplicate" или "full".
+        """
+        if data["update_id"] in self.seen:
+            INGEST_DROPPED.inc(reason="duplicate")
+            return "duplicate"
+        if self.pending >= self.max_pending:
+            # Не запоминаем id: Telegram повторит апдейт, и мы его примем
+            INGEST_DROPPED.inc(reason="queue_full")
+            return "full"
+        update = Update.de_json(data, self.application.bot)
+        self.seen.add(update.update_id)
+        self.pending += 1
+        self.idle.clear()
+        self.queue.put_nowait((update, time.monotonic()))
+        return "accepted"
+
+    @staticmethod
+    def _chat_key(update: Update):
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        if update.effective_user is not None:
+            return update.effective_user.id
+        return None
+
+    async def _process(self, update: Update, accepted: float) -> None:
+        INGEST_WAIT.observe(time.monotonic() - accepted)
+        try:
+            await self.application.process_update(update)
+        except Exception as e:
+            logging.error(f"Апдейт {update.update_id} не обработан: {e}")
+        finally:
+            self.pending -= 1
+            if not self.pending:
+                self.idle.set()
+            if self.on_done is not None:
+                self.on_done(update.update_id)
+
+    async def _worker(self) -> None:
+        while True:
+            update, accepted = await self.queue.get()
+            key = self._chat_key(update)
+            if key is None:
+                await self._process(update, accepted)
+                continue
+            backlog = self.chat_backlog.get(key)
+            if backlog is not None:
+                # Чат уже обрабатывает другой обработчик — он доберёт и этот апдейт
+                backlog.append((update, accepted))
+                continue
+            backlog = self.chat_backlog[key] = deque()
+            try:
+                await self._process(update, accepted)
+                while backlog:
+                    await self._process(*backlog.popleft())
+            finally:
+                del self.chat_backlog[key]
+
+
+class WebhookHandler(tornado.web.RequestHandler):
+    """
+    POST от Telegram: разбираем апдейт, кладём в очередь и сразу отвечаем.
+    """
+
+    def initialize(self, ingestor) -> None:
+        # UpdateIngestor в одном процессе или ShardRouter перед процессами-обработчиками
+        self.ingestor = ingestor
+
+    def post(self) -> None:
+        try:
+            status = self.ingestor.submit(json.loads(self.request.body))
+        except Exception as e:
+            INGEST_DROPPED.inc(reason="invalid")
+            logging.warning(f"Некорректный апдейт в webhook: {e}")
+            self.set_status(400)
+            return
+        if status == "full":
+            self.set_status(503)
+
+
+def start_webhook_server(ingestor, listen: str, port: int, webhook_url: str):
+    """
+    HTTP-сервер приёма webhook. Метрики сюда не выносим: порт публичный,
+    /metrics отдаётся только на METRICS_PORT.
+    """
+    path = urlparse(webhook_url).path.rstrip("/") if webhook_url else ""
+    server = tornado.httpserver.HTTPServer(tornado.web.Application([
+        (rf"{re.escape(path)}/?", WebhookHandler, {"ingestor": ingestor})
+    ]))
+    server.listen(port, listen)
+    return server
+
+
+def stop_signals() -> asyncio.Event:
+    """
+    Событие, которое выставляют SIGINT и SIGTERM.
+    """
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    return stop_event
+
+
+async def start_application(application: Application) -> None:
+    """
+    Запуск Application без Updater в том же порядке, что и в run_webhook PTB.
+    """
+    await application.initialize()
+    await post_init(application)
+    await application.start()
+
+
+async def stop_application(application: Application, ingestor: UpdateIngestor) -> None:
+    """
+    Дообрабатывает принятые апдейты и останавливает Application
+    с вызовом post_stop и post_shutdown.
+    """
+    await ingestor.stop(INGEST_DRAIN_TIMEOUT)
+    await application.stop()
+    await post_stop(application)
+    await application.shutdown()
+    await post_shutdown(application)
+
+
+async def run_fast_webhook(application: Application, listen: str, port: int, webhook_url: str) -> None:
+    """
+    Запуск бота с собственным приёмом webhook (вместо application.run_webhook).
+    По SIGINT/SIGTERM перестаём принимать апдейты и дообрабатываем очередь.
+    """
+    stop_event = stop_signals()
+    await start_application(application)
+
+    ingestor = UpdateIngestor(application, INGEST_WORKERS, INGEST_QUEUE_SIZE, INGEST_DEDUP_WINDOW)
+    ingestor.start()
+    server = start_webhook_server(ingestor, listen, port, webhook_url)
+    if webhook_url:
+        await application.bot.set_webhook(url=webhook_url)
+    logging.info(f"Webhook принимается на {listen}:{port}, обработчиков: {INGEST_WORKERS}")
+
+    try:
+        await stop_event.wait()
+    finally:
+        server.stop()
+        await stop_application(application, ingestor)
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+#               Несколько процессов-обработчиков (шардирование по чатам)
+# ─────────────────────────────────────────────────────────────────────────────
+
+def chat_id_of(data: dict) -> Optional[int]:
+    """
+    chat_id апдейта (или id отправителя) прямо из JSON, без разбора в объекты PTB.
+    """
+    for body in data.values():
+        if not isinstance(body, dict):
+            continue
+        chat = body.get("chat") or (body.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+        sender = body.get("from")
+        if sender:
+            return sender["id"]
+    return None
+
+
+class WorkerProcess:
+    """
+    Процесс-обработчик и апдейты, которые ему отправлены, но ещё не обработаны.
+    """
+
+    def __init__(self, index: int) -> None:
+        self.index = index
+        self.process = None
+        self.conn = None
+        self.outbox = None
+        self.sender = None
+        self.unacked = OrderedDict()   # update_id -> апдейт (JSON), в порядке приёма
+        self.started_at = 0.0
+        self.failures = 0              # Падений подряд вскоре после запуска
+
+
+class ShardRouter:
+    """
+    Приёмный процесс: раздаёт апдейты N процессам-обработчикам по chat_id.
+
+    Апдейты одного чата всегда попадают в один процесс, поэтому сохраняют
+    порядок, а user_data чата живёт в памяти одного процесса. Обработчик
+    подтверждает каждый апдейт после обработки; если процесс упал, его
+    перезапускаем и пересылаем всё неподтверждённое в исходном порядке
+    (апдейт, который обрабатывался в момент падения, будет обработан ещё раз).
+    """
+
+    def __init__(self, processes: int, max_pending: int, dedup_window: int) -> None:
+        self.workers = [WorkerProcess(i) for i in range(processes)]
+        self.max_pending = max_pending   # Неподтверждённых апдейтов на процесс
+        self.seen = UpdateIdWindow(dedup_window)
+        self.stopping = False
+        self._context = multiprocessing.get_context("spawn")
+        self._loop = None
+
+    def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        for worker in self.workers:
+            self._spawn(worker)
+        INGEST_DEPTH.set_function(lambda: [
+            ({"state": f"worker_{worker.index}"}, len(worker.unacked)) for worker in self.workers
+        ])
+
+    def _spawn(self, worker: WorkerProcess) -> None:
+        if self.stopping:
+            return
+        parent_conn, child_conn = self._context.Pipe()
+        worker.process = self._context.Process(
+            target=run_worker, args=(worker.index, child_conn), name=f"intui-worker-{worker.index}"
+        )
+        worker.process.start()
+        child_conn.close()
+        worker.conn = parent_conn
+        worker.started_at = time.monotonic()
+        worker.outbox = asyncio.Queue()
+        for item in worker.unacked.items():
+            worker.outbox.put_nowait(item)
+        worker.sender = asyncio.create_task(self._send_loop(worker.conn, worker.outbox))
+        self._loop.add_reader(parent_conn.fileno(), self._on_acks, worker)
+        self._loop.add_reader(worker.process.sentinel, self._on_exit, worker)
+
+    @staticmethod
+    async def _send_loop(conn, outbox: asyncio.Queue) -> None:
+        # Запись в канал может блокироваться, пока обработчик не прочитал
+        # предыдущее, поэтому пишем из потока, а не из event loop
+        while True:
+            message = await outbox.get()
+            try:
+                await asyncio.to_thread(conn.send, message)
+            except (OSError, ValueError):
+                return   # Процесс упал — после перезапуска перешлём неподтверждённое
+            if message is None:
+                return
+
+    def _on_acks(self, worker: WorkerProcess) -> None:
+        try:
+            while worker.conn.poll():
+                worker.unacked.pop(worker.conn.recv(), None)
+        except (EOFError, OSError):
+            self._loop.remove_reader(worker.conn.fileno())
+
+    def _detach(self, worker: WorkerProcess) -> None:
+        if worker.conn is None:
+            return
+        self._loop.remove_reader(worker.conn.fileno())
+        self._loop.remove_reader(worker.process.sentinel)
+        worker.sender.cancel()
+        worker.conn.close()
+        worker.conn = None
+        worker.process.join(0)
+
+    def _on_exit(self, worker: WorkerProcess) -> None:
+        self._on_acks(worker)   # Дочитываем подтверждения, отправленные перед выходом
+        self._detach(worker)
+        if self.stopping:
+            return
+        lifetime = time.monotonic() - worker.started_at
+        worker.failures = worker.failures + 1 if lifetime < 10 else 0
+        delay = min(WORKER_RESPAWN_MAX_DELAY, 0.5 * 2 ** worker.failures)
+        WORKER_RESPAWNS.inc(worker=str(worker.index))
+        handle_error(
+            f"Процесс-обработчик {worker.index} завершился (код {worker.process.exitcode}), "
+            f"перезапуск через {delay:.1f} сек, неподтверждённых апдейтов: {len(worker.unacked)}"
+        )
+        self._loop.call_later(delay, self._spawn, worker)
+
+    def submit(self, data: dict) -> str:
+        """
+        Принимает апдейт (JSON от Telegram). Возвращает "accepted",
+        "duplicate" или "full".
+        """
+        update_id = data["update_id"]
+        if update_id in self.seen:
+            INGEST_DROPPED.inc(reason="duplicate")
+            return "duplicate"
+        chat_id = chat_id_of(data)
+        worker = self.workers[(update_id if chat_id is None else chat_id) % len(self.workers)]
+        if len(worker.unacked) >= self.max_pending:
+            INGEST_DROPPED.inc(reason="queue_full")
+            return "full"
+        self.seen.add(update_id)
+        worker.unacked[update_id] = data
+        if worker.conn is not None:
+            worker.outbox.put_nowait((update_id, data))
+        return "accepted"
+
+    async def stop(self, timeout: float) -> None:
+        """
+        Просит процессы дообработать свои апдейты и завершиться.
+        """
+        self.stopping = True
+        for worker in self.workers:
+            if worker.conn is not None:
+                worker.outbox.put_nowait(None)
+        deadline = time.monotonic() + timeout
+        for worker in self.workers:
+            if worker.process is None:
+                continue
+            await asyncio.to_thread(worker.process.join, max(0.0, deadline - time.monotonic()))
+            if worker.process.is_alive():
+                logging.warning(f"Процесс-обработчик {worker.index} не завершился за {timeout} сек")
+                worker.process.terminate()
+                await asyncio.to_thread(worker.process.join, 5)
+            self._detach(worker)
+        lost = sum(len(worker.unacked) for worker in self.workers)
+        if lost:
+            logging.warning(f"Остановка: не подтверждено {lost} апдейтов")
+
+
+def run_worker(index: int, conn) -> None:
+    """
+    Точка входа процесса-обработчика: свой Application, апдейты приходят
+    из канала от приёмного процесса.
+    """
+    # Ctrl+C получает вся группа процессов, а останавливает обработчиков приёмный процесс
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    global METRICS_PORT
+    if METRICS_PORT:
+        METRICS_PORT += 1 + index
+    asyncio.run(serve_worker(build_application(), conn))
+
+
+async def serve_worker(application: Application, conn) -> None:
+    loop = asyncio.get_running_loop()
+    stop_event = asyncio.Event()
+    loop.add_signal_handler(signal.SIGTERM, stop_event.set)
+    await start_application(application)
+
+    def ack(update_id: int) -> None:
+        try:
+            conn.send(update_id)
+        except OSError:
+            pass   # Приёмный процесс уже закрыл канал
+
+    # Размер очереди ограничивает приёмный процесс
+    ingestor = UpdateIngestor(application, INGEST_WORKERS, sys.maxsize, INGEST_DEDUP_WINDOW, on_done=ack)
+    ingestor.start()
+
+    def on_readable() -> None:
+        try:
+            while conn.poll():
+                message = conn.recv()
+                if message is None:
+                    raise EOFError
+                update_id, data = message
+                try:
+                    accepted = ingestor.submit(data) == "accepted"
+                except Exception as e:
+                    logging.warning(f"Некорректный апдейт {update_id}: {e}")
+                    accepted = False
+                if not accepted:
+                    ack(update_id)
+        except (EOFError, OSError):
+            loop.remove_reader(conn.fileno())
+            stop_event.set()
+
+    loop.add_reader(conn.fileno(), on_readable)
+    try:
+        await stop_event.wait()
+    finally:
+        await stop_application(application, ingestor)
+        conn.close()
+
+
+async def run_sharded_webhook(listen: str, port: int, webhook_url: str) -> None:
+    """
+    Приёмный процесс: webhook, маршрутизация по чатам, перезапуск
+    обработчиков и алерты об их падениях. Сам апдейты не обрабатывает.
+    """
+    stop_event = stop_signals()
+    bot = Bot(TELEGRAM_TOKEN, base_url=f"{TELEGRAM_API_BASE_URL}/bot" if TELEGRAM_API_BASE_URL else None)
+    await bot.initialize()
+    alert_pipeline.start(bot)
+
+    router = ShardRouter(WORKER_PROCESSES, INGEST_QUEUE_SIZE, INGEST_DEDUP_WINDOW)
+    router.start()
+    lag_monitor = asyncio.create_task(monitor_event_loop_lag())
+    metrics_server = None
+    if METRICS_PORT:
+        metrics_server = tornado.httpserver.HTTPServer(
+            tornado.web.Application([(r"/metrics", MetricsHandler)])
+        )
+        metrics_server.listen(METRICS_PORT, METRICS_LISTEN)
+
+    server = start_webhook_server(router, listen, port, webhook_url)
+    if webhook_url:
+        await bot.set_webhook(url=webhook_url)
+    logging.info(f"Webhook принимается на {listen}:{port}, процессов-обработчиков: {WORKER_PROCESSES}")
+
+    try:
+        await stop_event.wait()
+    finally:
+        server.stop()
+        # Обработчикам нужно время на дообработку очереди и остановку PTB
+        await router.stop(INGEST_DRAIN_TIMEOUT + 15)
+        lag_monitor.cancel()
+        if metrics_server is not None:
+            metrics_server.stop()
+        await alert_pipeline.stop()
+        await bot.shutdown()
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+#                                  Запуск бота
+# ─────────────────────────────────────────────────────────────────────────────
+
+def build_application() -> Application:
+    """
+    Собирает Application со всеми обработчиками. Используется и при запуске,
+    и нагрузочным стендом bench/loadtest.py.
+    """
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .request(InstrumentedRequest(connection_pool_size=TELEGRAM_POOL_SIZE))
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .persistence(SQLitePersistence(DB_PATH, PERSISTENCE_FLUSH_INTERVAL))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+    )
+    if TELEGRAM_API_BASE_URL:
+        # Локальный Bot API (или его заглушка на стенде)
+        builder = builder.base_url(f"{TELEGRAM_API_BASE_URL}/bot")
+    application = builder.build()
+
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("style", style_cmd))
+    application.add_handler(CommandHandler("history", history_cmd))
+    application.add_handler(CommandHandler("search", search_cmd))
+    application.add_handler(CommandHandler("symbols", symbols_cmd))
+    application.add_handler(CommandHandler("cache", cache_cmd))
+    application.add_handler(CommandHandler("queue", queue_cmd))
+    application.add_handler(CommandHandler("usage", usage_cmd))
+    application.add_handler(CallbackQueryHandler(button_handler))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & REPLY_TO_BOT, handle_followup))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    return application
+
+
+if __name__ == "__main__":
+    port = int(os.environ.get("PORT", 10000))
+
+    if WORKER_PROCESSES > 1:
+        # Приёмный процесс; обработчики создают свои Application в run_worker
+        asyncio.run(run_sharded_webhook(listen="0.0.0.0", port=port, webhook_url=WEBHOOK_URL))
+    elif FAST_ACK_WEBHOOK:
+        asyncio.run(run_fast_webhook(
+            build_application(),
+            listen="0.0.0.0",
+            port=port,
+            webhook_url=WEBHOOK_URL
+        ))
+    else:
+        build_application().run_webhook(
+            listen="0.0.0.0",
+            port=port,
+            webhook_url=WEBHOOK_URL
+        )